@@ -3,14 +3,29 @@ from .parsers import *
 from .models import (
 	Chunk,
 	BrokenChunk,
+	PieceResult,
 	Torrent,
-	TorrentInfo
+	TorrentInfo,
+	Progress,
+	Peer,
+	Scoreboard,
+	SeedManager
 )
 from .threading import (
-	max_threads,
-	create_worker,
-	get_number_of_workers_running,
-	start_next_worker,
-	close_all_workers
+	max_threads
 )
-from .logger import log
\ No newline at end of file
+from .engines import (
+	ProcessEngine,
+	AsyncEngine,
+	Endgame,
+	SequentialPicker,
+	PriorityPicker,
+	WindowPicker,
+	PICKERS,
+	create_engine,
+	create_picker
+)
+from .logger import log
+from . import metrics
+from . import tracing
+from . import network
\ No newline at end of file
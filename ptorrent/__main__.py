@@ -9,6 +9,8 @@ import os
 import sys
 import argparse
 import multiprocessing
+import queue
+import cProfile
 
 # https://wiki.theory.org/BitTorrentSpecification
 # https://fileformats.fandom.com/wiki/Torrent_file
@@ -18,14 +20,69 @@ import multiprocessing
 # http://www.bittorrent.org/beps/bep_0019.html
 # https://blog.thelifeofkenneth.com/2019/09/adding-webseed-urls-to-torrent-files.html
 
+def parse_priority(value :str):
+	byte_range, separator, level = value.partition('=')
+	start, dash, end = byte_range.partition('-')
+	try:
+		return int(start), int(end) + 1 if end else 1 << 63, int(level) if separator else 1
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"Expected START-END=LEVEL, got {value}")
+
 common_parameters = argparse.ArgumentParser(description="A set of common parameters for the tooling", add_help=True)
 common_parameters.add_argument("--torrent", nargs="?", type=pathlib.Path, help="Which torrent to download.", required=True)
 common_parameters.add_argument("--debug", action="store_true", default=False, help="Turn on debugging.", required=False)
+common_parameters.add_argument("--verify-workers", nargs="?", type=int, default=os.cpu_count() or 1, help="How many threads to hash local data with on startup, 1 reads the file sequentially.", required=False)
+common_parameters.add_argument("--recheck", action="store_true", default=False, help="Re-hash all local data even if the resume state says it's intact.", required=False)
+common_parameters.add_argument("--engine", nargs="?", choices=["process", "asyncio"], default="process", help="Download every piece in a process of its own (process), or all of them from a single asyncio event loop (asyncio).", required=False)
+common_parameters.add_argument("--connections", nargs="?", type=int, default=64, help="How many downloads may run at the same time at most, the actual number adapts to how well they do.", required=False)
+common_parameters.add_argument("--connections-per-seed", nargs="?", type=int, default=8, help="How many requests may run against a single web seed at the same time at most, each seed's limit adapts to how well it does.", required=False)
+common_parameters.add_argument("--max-request-size", nargs="?", type=int, default=8 * 1024 * 1024, help="How many bytes of adjacent missing pieces the asyncio engine merges into a single request at most.", required=False)
+common_parameters.add_argument("--block-size", nargs="?", type=int, default=0, help="Split pieces larger than this many bytes into blocks the asyncio engine fetches from several seeds at once (0 turns this off).", required=False)
+common_parameters.add_argument("--endgame-pieces", nargs="?", type=int, default=16, help="Once this few pieces are left, slow pieces are requested from another seed as well (0 turns this off).", required=False)
+common_parameters.add_argument("--picker", nargs="?", choices=list(ptorrent.PICKERS), default="sequential", help="Download the missing pieces in order (sequential), or keep a window ahead of the first missing piece downloaded first for reading the torrent while it downloads (window).", required=False)
+common_parameters.add_argument("--window", nargs="?", type=int, default=16, help="How many pieces the window picker keeps ahead of the first missing piece.", required=False)
+common_parameters.add_argument("--stream-rate", nargs="?", type=float, default=0, help="Bytes/s the torrent is read at while it downloads, pieces in the window that won't make it in time are requested from another seed as well (0 turns this off).", required=False)
+common_parameters.add_argument("--priority", action="append", type=parse_priority, default=[], metavar="START-END=LEVEL", help="Download the bytes START to END (inclusive, END may be left out) before those with a lower LEVEL, 1 being the default and 0 skipping them. Can be given more than once.", required=False)
+common_parameters.add_argument("--timeout-limits", nargs=3, type=float, default=[1.0, 0.2, 60.0], metavar=("INITIAL", "MINIMUM", "MAXIMUM"), help="Request timeouts adapt to each seed's measured round-trip time and throughput. These are the seconds used before anything is known about a seed, and the bounds they're kept within.", required=False)
+common_parameters.add_argument("--rate-limit", nargs="?", type=ptorrent.parse_size, default=0, help="Download at most this many bytes/s in total (K/M/G suffixes are allowed, 0 is unlimited).", required=False)
+common_parameters.add_argument("--rate-limit-per-seed", nargs="?", type=ptorrent.parse_size, default=0, help="Download at most this many bytes/s from any single web seed host (0 is unlimited).", required=False)
+common_parameters.add_argument("--stats", nargs="?", type=pathlib.Path, default=None, help="Write the throughput, time to the first piece and piece latencies of the download to this file as JSON when done.", required=False)
+common_parameters.add_argument("--metrics-file", nargs="?", type=pathlib.Path, default=None, help="Keep the metrics in this file in the Prometheus text format, rewritten every second.", required=False)
+common_parameters.add_argument("--metrics-port", nargs="?", type=int, default=None, help="Serve the metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics.", required=False)
+common_parameters.add_argument("--metrics-json", nargs="?", type=pathlib.Path, default=None, help="Write a snapshot of all metrics to this file as JSON on exit.", required=False)
+common_parameters.add_argument("--trace", nargs="?", type=pathlib.Path, default=None, help="Record when every piece goes through each stage, in every process, to this file as Chrome trace events (open it in https://ui.perfetto.dev).", required=False)
+common_parameters.add_argument("--profile", nargs="?", type=pathlib.Path, default=None, help="Profile the coordinator with cProfile and write the stats to this file (see python -m pstats).", required=False)
+common_parameters.add_argument("--no-cache", action="store_true", default=False, help="Always parse the torrent instead of using the cached metadata.", required=False)
 arguments, unknown = common_parameters.parse_known_args()
 ptorrent.storage['arguments'] = arguments
 
+def export_metrics(final :bool = False):
+	if arguments.metrics_file:
+		ptorrent.metrics.registry.write_prometheus(arguments.metrics_file)
+	if final and arguments.metrics_json:
+		with arguments.metrics_json.open('w') as fh:
+			json.dump(ptorrent.metrics.registry.snapshot(), fh, indent=4)
+
+# Started before anything is forked, so the workers record as well
+if arguments.trace:
+	ptorrent.tracing.start(arguments.trace)
+
+profiler = cProfile.Profile() if arguments.profile else None
+if profiler:
+	profiler.enable()
+
+def finish_diagnostics():
+	if profiler:
+		profiler.disable()
+		profiler.dump_stats(arguments.profile)
+		ptorrent.log(f"Wrote the coordinator's profile to {arguments.profile}")
+	if arguments.trace:
+		ptorrent.log(f"Wrote the trace to {ptorrent.tracing.finish()}")
+
 def handler(signum, frame):
-	ptorrent.close_all_workers()
+	export_metrics(final=True)
+	engine.close()
+	finish_diagnostics()
 	for uuid in ptorrent.storage['torrents']:
 		try:
 			ptorrent.storage['torrents'][uuid]['peers'].close()
@@ -37,20 +94,44 @@ def handler(signum, frame):
 			pass
 
 	torrent.close()
+	if seed_manager:
+		seed_manager.shutdown()
 	exit(0)
 	
 signal.signal(signal.SIGINT, handler)
 
-chunks_queue = multiprocessing.Queue()
-peers_queue = multiprocessing.Queue()
+# The buckets live in shared memory, so they have to exist before the workers are forked
+rate_limits = ptorrent.network.rate_limits()
+rate_limits.total.set_rate(arguments.rate_limit)
+rate_limits.set_seed_rate(arguments.rate_limit_per_seed)
+
+engine = ptorrent.create_engine(arguments.engine, max_connections=arguments.connections, max_per_seed=arguments.connections_per_seed, max_request_bytes=arguments.max_request_size, block_size=arguments.block_size)
 
-torrent_internal_uuid = ptorrent.load_torrent(arguments.torrent, chunks_queue, peers_queue)
+# The asyncio engine reports back from a thread in this process,
+# so there's no need to pickle the results through a multiprocessing.Queue()
+chunks_queue = multiprocessing.Queue() if arguments.engine == 'process' else queue.Queue()
+
+timeout_limits = dict(zip(('initial', 'minimum', 'maximum'), arguments.timeout_limits))
+
+# Worker processes share the seed scoreboard through a manager process,
+# the asyncio engine lives in this process and can use it directly.
+if arguments.engine == 'process':
+	seed_manager = ptorrent.SeedManager()
+	seed_manager.start()
+	scoreboard = seed_manager.Scoreboard(max_active=arguments.connections_per_seed, timeout_limits=timeout_limits)
+else:
+	seed_manager = None
+	scoreboard = ptorrent.Scoreboard(max_active=arguments.connections_per_seed, timeout_limits=timeout_limits)
+
+torrent_internal_uuid = ptorrent.load_torrent(arguments.torrent, chunks_queue, scoreboard, use_cache=not arguments.no_cache)
 torrent = ptorrent.storage['torrents'][torrent_internal_uuid]['torrent']
+rate_limits.register(torrent_internal_uuid, [score.target for score in scoreboard.scores()])
 chunks_count = torrent.info.length / torrent.info.piece_length
 chunks_h = int(chunks_count * 100) / 100
 
 
 ptorrent.log(f"Downloading: {torrent.info.name}")
+ptorrent.log(f"Info hash: {torrent.info.info_hash.hex()}")
 ptorrent.log(f"Filesize: {torrent.info.length / 1024 / 1024}MB ({torrent.info.length} bytes)")
 ptorrent.log(f"Chunk size: {torrent.info.piece_length / 1024}KB ({torrent.info.piece_length} bytes)")
 ptorrent.log(f"Chunks: {chunks_h}")
@@ -58,90 +139,128 @@ ptorrent.log(f"Download location: {pathlib.Path('~/').expanduser().resolve()}")
 # ptorrent.log(json.dumps(torrent, cls=ptorrent.JSON, indent=4))
 
 torrent.set_download_location(pathlib.Path('~/'))
-chunks = list(torrent.verify_local_data())
+chunks = list(torrent.load_local_data(workers=arguments.verify_workers, recheck=arguments.recheck))
+torrent.open_target()
+
+progress = ptorrent.Progress(piece_count=len(chunks), length=torrent.info.length)
+for chunk in chunks:
+	if type(chunk) == ptorrent.Chunk:
+		progress.mark_done(chunk.index, torrent.info.piece_size(chunk.index), downloaded=False)
+
+del chunks
 
-for index, chunk in enumerate(chunks):
-	if type(chunk) == ptorrent.BrokenChunk:
-		ptorrent.create_worker(
-			func=chunk.download
-		)
+# Pieces are only handed to the engine once it has room for them, so whatever
+# the picker ranks highest always goes out next. In debug mode, only a few pieces are downloaded.
+picker = ptorrent.create_picker(arguments.picker, torrent.info.piece_length, torrent.info.length, priorities=arguments.priority, window=arguments.window, rate=arguments.stream_rate)
+pieces_per_request = engine.pieces_per_request(torrent.info.piece_length)
+pick_budget = 6 if ptorrent.storage['arguments'].debug else progress.piece_count
 
-	if ptorrent.storage['arguments'].debug:
-		if index >= 5:
-			break
+results = ptorrent.storage['torrents'][torrent_internal_uuid]['chunks']
 
-	if ptorrent.storage['arguments'].debug:
-		ptorrent.log(f"Created worker for index {index}")
+ptorrent.metrics.track_progress(progress)
+ptorrent.metrics.track_engine(engine, results)
+ptorrent.metrics.track_scoreboard(scoreboard)
+if arguments.metrics_port:
+	ptorrent.metrics.registry.serve(arguments.metrics_port)
+	ptorrent.log(f"Serving metrics at http://127.0.0.1:{arguments.metrics_port}/metrics")
 
+endgame = ptorrent.Endgame(threshold=arguments.endgame_pieces)
 last_output = time.time()
-last_num_done = 0
-for chunk_index in range(len(chunks)):
-	chunk = chunks[chunk_index]
-
-	# ptorrent.log(f'On: {chunk}')
-	if type(chunk) == ptorrent.BrokenChunk:
-		# ptorrent.log(f"Waiting for {chunk} to download.")
-		while chunk.is_downloaded is False or chunk.is_complete is False:
-			if chunk._broken_download:
-				# Retry and hopefully a good peer will come along.
-				# ptorrent.log(f"{chunk} was corrupt, re-inserting into pool.")
-				# Reset the chunk so we don't get false flags
-				chunk = ptorrent.BrokenChunk(torrent=chunk.torrent, index=chunk.index, expected_hash=chunk.expected_hash, data=None, actual_hash=None)
-				ptorrent.create_worker(
-					func=chunk.download
-				)
-
-			alive, next_worker_id = ptorrent.get_number_of_workers_running()
-			if next_worker_id is not None and alive < ptorrent.max_threads():
-				ptorrent.start_next_worker(next_worker_id)
-
-			if ptorrent.storage['torrents'][torrent_internal_uuid]['chunks'].empty() is False:
-				finished_chunk = ptorrent.storage['torrents'][torrent_internal_uuid]['chunks'].get(block=True)
-
-				for _index, _chunk in list(enumerate(chunks)):
-					if _chunk.index == finished_chunk.index:
-						chunks = chunks[:_index] + [finished_chunk] + chunks[_index+1:]
-
-				if finished_chunk.index == chunk.index:
-					chunk = finished_chunk
-
-			if time.time() - last_output > 1:
-				done = 0
-				for _chunk in chunks:
-					if type(_chunk) == ptorrent.Chunk:
-						done += 1
-
-				if done != last_num_done:
-					last_num_done = done
-					last_output = time.time()
-
-					ptorrent.log(f"{done}/{len(chunks)} has finished downloading.")
-
-					if ptorrent.storage['arguments'].debug:
-						if last_num_done > 5:
-							break
-
-			time.sleep(0.0001)
+last_num_done = progress.done
+while True:
+	# Wait for a whole request's worth of room, so the asyncio engine can still merge adjacent pieces
+	ceiling = engine.controller.limit * pieces_per_request
+	if (backlog := rate_limits.backlog(torrent_internal_uuid)) is not None:
+		# Under a rate limit, pieces requested beyond what it lets through in a moment would only wait for their turn
+		ceiling = min(ceiling, max(int(backlog // torrent.info.piece_length), 1))
+	free = min(ceiling - progress.requested, pick_budget)
+	missing = progress.piece_count - progress.done - progress.requested
+	if free > 0 and free >= min(pieces_per_request, ceiling, missing, pick_budget) and not picker.exhausted(progress):
+		with ptorrent.tracing.span('pick'):
+			picked = picker.pick(progress, free)
+			pick_budget -= len(picked)
+			for index in picked:
+				ptorrent.tracing.begin('piece', index)
+			engine.submit_many(ptorrent.BrokenChunk(torrent=torrent, index=index, expected_hash=torrent.info.piece_hash(index), data=None, actual_hash=None) for index in picked)
+
+	if not progress.requested:
+		break
+
+	engine.pump()
+
+	# Wake up now and then even if nothing arrives, the process
+	# engine needs pump() to start the next workers.
+	try:
+		with ptorrent.tracing.span('wait for results'):
+			result = results.get(timeout=0.1 if endgame.active or arguments.stream_rate else 0.5)
+	except queue.Empty:
+		result = None
+
+	if result is not None:
+		engine.on_result(result)
+
+		if progress.is_done(result.index):
+			# A duplicate from the endgame that lost
+			progress.mark_wasted(result.size)
+		elif result.ok:
+			with ptorrent.tracing.span('store', piece=result.index, written=result.written):
+				torrent.store_result(result)
+			progress.mark_done(result.index, result.size, duration=result.connect_time + result.transfer_time)
+			ptorrent.tracing.end('piece', result.index, seed=result.seed)
+			if endgame.completed(result.index):
+				engine.cancel(result.torrent_uuid, result.index)
+		elif endgame.copy_failed(result.index):
+			# Another copy of it is still on its way
+			progress.mark_failed(result.index, retried=False)
+		else:
+			# Retry and hopefully a good peer will come along.
+			progress.mark_failed(result.index)
+			ptorrent.tracing.end('piece', result.index, status=result.status)
+			ptorrent.tracing.begin('piece', result.index, retry=True)
+			engine.submit(ptorrent.BrokenChunk(torrent=torrent, index=result.index, expected_hash=torrent.info.piece_hash(result.index), data=None, actual_hash=None))
+
+	# Pieces the reader will need before they arrive, and once there's nothing left to pick, the slowest ones
+	hedges = [index for index in picker.overdue(progress) if endgame.may_hedge(index)]
+	if pick_budget == 0 or picker.exhausted(progress):
+		hedges += [index for index in endgame.candidates(progress) if index not in hedges]
+
+	for index in hedges:
+		endgame.hedging(index)
+		ptorrent.tracing.instant('hedge', piece=index)
+		engine.hedge(ptorrent.BrokenChunk(torrent=torrent, index=index, expected_hash=torrent.info.piece_hash(index), data=None, actual_hash=None))
 
 	if time.time() - last_output > 1:
-		done = 0
-		for _chunk in chunks:
-			if type(_chunk) == ptorrent.Chunk:
-				done += 1
-				
-		if done != last_num_done:
-			last_num_done = done
-			last_output = time.time()
+		last_output = time.time()
+		progress.sample(last_output)
+		export_metrics()
+
+		if progress.done != last_num_done:
+			last_num_done = progress.done
+
+			ptorrent.log(f"{progress.describe()} ({engine.controller.describe()}, {endgame.describe()}).")
+
+			if ptorrent.storage['arguments'].debug:
+				ptorrent.log(f"Seeds: {scoreboard.describe()}")
+				ptorrent.log(f"Picking: {picker.describe()}")
+				ptorrent.log(f"Rate limits: {rate_limits.describe()}")
 
-			ptorrent.log(f"{done}/{len(chunks)} has finished downloading.")
+ptorrent.log(f"{progress.describe()} ({engine.controller.describe()}).")
+ptorrent.log(f"Downloaded {progress.downloaded_bytes / 1024 / 1024:.2f}MB in {ptorrent.models.progress.format_duration(time.time() - progress.started)} ({progress.average_rate / 1024 / 1024:.2f}MB/s on average).")
+if ptorrent.storage['arguments'].debug:
+	ptorrent.log(f"Seeds: {scoreboard.describe()}")
+if endgame.hedged:
+	ptorrent.log(f"The endgame requested {endgame.hedged} piece(s) twice, {progress.wasted_bytes / 1024 / 1024:.2f}MB of duplicates were thrown away.")
 
-	if ptorrent.storage['arguments'].debug:
-		if last_num_done > 5:
-			break
+export_metrics(final=True)
 
-if len(chunks) == chunks_count:
- 	torrent.feed(chunks)
+if arguments.stats:
+	with arguments.stats.open('w') as fh:
+		json.dump({'engine' : arguments.engine, 'picker' : arguments.picker, 'hedged' : endgame.hedged, **progress.summary()}, fh, indent=4)
 
-ptorrent.close_all_workers()
+# Workers that are still around write their part of the trace on the way out
+engine.close(grace=1.0 if arguments.trace else 0.0)
+finish_diagnostics()
 torrent.close()
+if seed_manager:
+	seed_manager.shutdown()
 exit(0)
\ No newline at end of file
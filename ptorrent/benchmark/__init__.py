@@ -0,0 +1,14 @@
+from .seed import (
+	SeedProfile,
+	Throttle,
+	WebSeedServer
+)
+from .fixtures import (
+	Fixture,
+	make_fixture,
+	parse_size
+)
+from .runner import (
+	BenchmarkResult,
+	run_download
+)
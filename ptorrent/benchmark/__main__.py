@@ -0,0 +1,80 @@
+import json
+import time
+import pathlib
+import argparse
+import tempfile
+import subprocess
+import ptorrent
+from . import SeedProfile, WebSeedServer, make_fixture, parse_size, run_download
+
+# Runs ptorrent against local stand-ins for web seeds, e.g.:
+#   python -m ptorrent.benchmark --size 256M --seeds 3 --latency 0.02 --bandwidth 40M --output results.jsonl
+# Anything not recognised here is passed on to ptorrent, e.g. --connections 16 or --block-size 1048576.
+
+parameters = argparse.ArgumentParser(description="Measures ptorrent downloading synthetic torrents from local web seeds.", add_help=True)
+parameters.add_argument("--size", nargs="?", type=parse_size, default=parse_size("64M"), help="How much data to download (K/M/G suffixes are allowed).", required=False)
+parameters.add_argument("--piece-length", nargs="?", type=parse_size, default=parse_size("256K"), help="The piece length of the torrent.", required=False)
+parameters.add_argument("--files", nargs="?", type=int, default=1, help="How many files the data is split over, more than one makes a multi-file torrent.", required=False)
+parameters.add_argument("--seeds", nargs="?", type=int, default=2, help="How many web seeds to serve the data from.", required=False)
+parameters.add_argument("--latency", nargs="?", type=float, default=0.0, help="Seconds every seed waits before responding.", required=False)
+parameters.add_argument("--bandwidth", nargs="?", type=parse_size, default=0, help="Bytes/s every seed can send in total (0 is unlimited).", required=False)
+parameters.add_argument("--error-rate", nargs="?", type=float, default=0.0, help="Share of requests the seeds answer with a 503.", required=False)
+parameters.add_argument("--truncate-rate", nargs="?", type=float, default=0.0, help="Share of responses the seeds cut off part way through.", required=False)
+parameters.add_argument("--slow-start", nargs="?", type=float, default=0.0, help="Seconds until a new connection reaches full speed.", required=False)
+parameters.add_argument("--seed-profile", action="append", type=SeedProfile.parse, default=[], metavar="SPEC", help="Give the seeds different profiles (e.g. latency=0.1,bandwidth=5M,error_rate=0.05), one per seed in order, the rest use the options above.", required=False)
+parameters.add_argument("--engines", nargs="+", choices=["process", "asyncio"], default=["process", "asyncio"], help="Which engines to benchmark.", required=False)
+parameters.add_argument("--repeat", nargs="?", type=int, default=1, help="How many times to download with every engine.", required=False)
+parameters.add_argument("--random-seed", nargs="?", type=int, default=0, help="Seeds the data and every seed's misbehaviour, so runs can be repeated.", required=False)
+parameters.add_argument("--timeout", nargs="?", type=float, default=600, help="Seconds a single download may take.", required=False)
+parameters.add_argument("--output", nargs="?", type=pathlib.Path, default=None, help="Append the results to this file, one JSON object per download.", required=False)
+arguments, ptorrent_arguments = parameters.parse_known_args()
+ptorrent.storage['arguments'] = arguments
+
+def revision() -> str:
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pathlib.Path(__file__).parent, capture_output=True, text=True).stdout.strip()
+	except OSError:
+		return ''
+
+default_profile = SeedProfile(
+	latency=arguments.latency,
+	bandwidth=arguments.bandwidth,
+	error_rate=arguments.error_rate,
+	truncate_rate=arguments.truncate_rate,
+	slow_start=arguments.slow_start
+)
+profiles = (arguments.seed_profile + [default_profile] * arguments.seeds)[:max(arguments.seeds, len(arguments.seed_profile))]
+
+with tempfile.TemporaryDirectory(prefix='ptorrent-benchmark-data-') as directory:
+	directory = pathlib.Path(directory)
+	(directory / 'seed').mkdir()
+
+	ptorrent.log(f"Generating {arguments.size / 1024 / 1024:.1f}MB in {arguments.files} file(s) with {arguments.piece_length / 1024:.0f}KB pieces")
+	fixture = make_fixture(directory / 'seed', 'benchmark.bin', arguments.size, arguments.piece_length, files=arguments.files, seed=arguments.random_seed)
+
+	for run in range(arguments.repeat):
+		for engine in arguments.engines:
+			# Fresh servers for every download, so they all see the same misbehaviour
+			servers = [WebSeedServer(fixture.root, profile, seed=arguments.random_seed + index).start() for index, profile in enumerate(profiles)]
+			try:
+				torrent = fixture.write_torrent(directory / 'benchmark.torrent', [server.url for server in servers])
+				result = run_download(fixture, torrent, engine, ptorrent_arguments, timeout=arguments.timeout)
+			finally:
+				for server in servers:
+					server.stop()
+			result.seeds = [dict(server.counters) for server in servers]
+
+			ptorrent.log(result.describe(), fg="green" if result.intact else "red")
+
+			if arguments.output:
+				with arguments.output.open('a') as fh:
+					fh.write(json.dumps({
+						'time' : time.time(),
+						'revision' : revision(),
+						'run' : run,
+						'size' : arguments.size,
+						'piece_length' : arguments.piece_length,
+						'files' : arguments.files,
+						'profiles' : [str(profile) for profile in profiles],
+						**result.__json__()
+					}) + '\n')
@@ -0,0 +1,95 @@
+import random
+import typing
+import hashlib
+import pathlib
+from dataclasses import dataclass, field
+from ..parsers import torrent_encode, parse_size
+
+@dataclass
+class Fixture:
+	"""
+	Synthetic data to download: the files under root/name, and the piece hashes over them.
+	"""
+	root :pathlib.Path
+	name :str
+	piece_length :int
+	files :typing.List[typing.Tuple[int, typing.List[str]]] = field(default_factory=list)
+	pieces :bytes = b''
+
+	@property
+	def length(self) -> int:
+		return sum(length for length, path in self.files)
+
+	@property
+	def is_multi_file(self) -> bool:
+		return len(self.files) > 1
+
+	def paths(self, root :typing.Optional[pathlib.Path] = None) -> typing.List[pathlib.Path]:
+		"""
+		Where the files are under root (the served directory by default), as ptorrent lays them out.
+		"""
+		root = pathlib.Path(root or self.root) / self.name
+		if not self.is_multi_file:
+			return [root]
+		return [root.joinpath(*path) for length, path in self.files]
+
+	def write_torrent(self, path :pathlib.Path, seeds :typing.List[str]) -> pathlib.Path:
+		"""
+		Writes a .torrent with the given web seeds, which are expected to serve root.
+		"""
+		info = {
+			'name' : self.name.encode('UTF-8'),
+			'piece length' : self.piece_length,
+			'pieces' : self.pieces
+		}
+		if self.is_multi_file:
+			info['files'] = [{'length' : length, 'path' : [part.encode('UTF-8') for part in file_path]} for length, file_path in self.files]
+		else:
+			info['length'] = self.files[0][0]
+
+		path = pathlib.Path(path)
+		path.write_bytes(torrent_encode({
+			'info' : info,
+			'url-list' : [seed.encode('UTF-8') for seed in seeds],
+			'comment' : b'ptorrent benchmark'
+		}))
+		return path
+
+def make_fixture(root :pathlib.Path, name :str, size :int, piece_length :int, files :int = 1, seed :int = 0) -> Fixture:
+	"""
+	Creates size bytes of pseudo random data (the same for the same seed) under root,
+	split over files files, and hashes it into pieces while writing it.
+	"""
+	generator = random.Random(seed)
+	root = pathlib.Path(root)
+	lengths = [size // files + (1 if index < size % files else 0) for index in range(files)]
+	fixture = Fixture(
+		root=root,
+		name=name,
+		piece_length=piece_length,
+		files=[(length, [f"part-{index:04d}.bin"]) for index, length in enumerate(lengths)]
+	)
+
+	pieces = []
+	piece = hashlib.sha1()
+	piece_filled = 0
+	for (length, file_path), target in zip(fixture.files, fixture.paths()):
+		target.parent.mkdir(parents=True, exist_ok=True)
+		with target.open('wb') as fh:
+			remaining = length
+			while remaining:
+				data = memoryview(generator.randbytes(min(remaining, piece_length - piece_filled, 1024 * 1024)))
+				fh.write(data)
+				piece.update(data)
+				piece_filled += len(data)
+				remaining -= len(data)
+
+				if piece_filled == piece_length:
+					pieces.append(piece.digest())
+					piece, piece_filled = hashlib.sha1(), 0
+
+	if piece_filled:
+		pieces.append(piece.digest())
+
+	fixture.pieces = b''.join(pieces)
+	return fixture
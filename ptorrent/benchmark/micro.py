@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import typing
+import hashlib
+import pathlib
+import argparse
+import tempfile
+import platform
+from dataclasses import dataclass
+from .fixtures import parse_size
+
+# Micro-benchmarks of the hot paths in isolation, e.g.:
+#   python -m ptorrent.benchmark.micro --output baseline.json
+#   python -m ptorrent.benchmark.micro --baseline baseline.json
+# The second run exits with 1 if anything got slower than the baseline by more than --tolerance.
+
+@dataclass
+class MicroResult:
+	"""
+	The best of repeat runs of a benchmark, operations being how much work one run does
+	(pieces parsed, bytes hashed, seeds picked) so results of different scales compare.
+	"""
+	name :str
+	parameters :typing.Dict[str, typing.Any]
+	seconds :float
+	operations :int
+	unit :str
+	repeat :int
+
+	@property
+	def key(self) -> str:
+		return f"{self.name}[{','.join(f'{name}={value}' for name, value in self.parameters.items())}]"
+
+	@property
+	def rate(self) -> float:
+		return self.operations / max(self.seconds, 0.000000001)
+
+	def __json__(self):
+		return {
+			'name' : self.name,
+			'parameters' : self.parameters,
+			'seconds' : self.seconds,
+			'operations' : self.operations,
+			'unit' : self.unit,
+			'rate' : self.rate,
+			'repeat' : self.repeat
+		}
+
+	def describe(self) -> str:
+		return f"{self.key}: {self.seconds * 1000:.1f}ms, {self.rate:,.0f} {self.unit}/s"
+
+def best_of(repeat :int, run :typing.Callable[[], typing.Any], setup :typing.Optional[typing.Callable[[], typing.Any]] = None, number :int = 1) -> float:
+	"""
+	The fastest of repeat runs in seconds, setup (if any) is called before each one and not timed.
+	Runs too short to time reliably can be made of number calls to run, the time of one call is returned.
+	"""
+	best = float('inf')
+	for attempt in range(repeat):
+		if setup:
+			setup()
+		started = time.perf_counter()
+		for call in range(number):
+			run()
+		best = min(best, (time.perf_counter() - started) / number)
+	return best
+
+BENCHMARKS :typing.Dict[str, typing.Callable[..., typing.List[MicroResult]]] = {}
+
+def benchmark(name :str):
+	def register(function :typing.Callable[..., typing.List[MicroResult]]) -> typing.Callable[..., typing.List[MicroResult]]:
+		BENCHMARKS[name] = function
+		return function
+	return register
+
+@benchmark('parse_torrent')
+def bench_parse_torrent(repeat :int, generator :random.Random, **options) -> typing.List[MicroResult]:
+	from ..parsers import parse_torrent, torrent_encode
+
+	results = []
+	for piece_count in (10_000, 100_000, 1_000_000):
+		data = torrent_encode({
+			'info' : {
+				'name' : b'benchmark.bin',
+				'piece length' : 256 * 1024,
+				'length' : piece_count * 256 * 1024,
+				'pieces' : generator.randbytes(20 * piece_count)
+			},
+			'url-list' : [f"http://seed-{index}.example/".encode('UTF-8') for index in range(16)],
+			'comment' : b'ptorrent benchmark'
+		})
+		seconds = best_of(repeat, lambda: parse_torrent(data, spans={}), number=max(10_000_000 // piece_count, 1))
+		results.append(MicroResult(name='parse_torrent', parameters={'pieces' : piece_count}, seconds=seconds, operations=piece_count, unit='pieces', repeat=repeat))
+
+	return results
+
+@benchmark('verify_local_data')
+def bench_verify_local_data(repeat :int, generator :random.Random, verify_size :int = 2 * 1024 ** 3, **options) -> typing.List[MicroResult]:
+	"""
+	Hashes a sparse file of verify_size bytes (all zeroes, so every piece matches), as one file and split over 16.
+	"""
+	from ..models import Torrent, TorrentInfo
+
+	piece_length = 4 * 1024 * 1024
+	piece_count = -(-verify_size // piece_length)
+	zero_hash = hashlib.sha1(bytes(piece_length)).digest()
+
+	results = []
+	with tempfile.TemporaryDirectory(prefix='ptorrent-micro-') as directory:
+		for files in (1, 16):
+			name = f"verify-{files}"
+			if files == 1:
+				info = TorrentInfo(name=name.encode('UTF-8'), piece_length=piece_length, pieces=zero_hash * piece_count, length=piece_count * piece_length)
+			else:
+				length = piece_count * piece_length // files
+				info = TorrentInfo(name=name.encode('UTF-8'), piece_length=piece_length, pieces=zero_hash * piece_count, files=[
+					{'length' : length + (piece_count * piece_length - length * files if index == files - 1 else 0), 'path' : [f"part-{index:02d}.bin".encode('UTF-8')]}
+					for index in range(files)
+				])
+
+			torrent = Torrent(info=info, uuid=uuid.uuid4(), download_location=pathlib.Path(directory))
+			torrent.open_target()
+			torrent.target_files.close()
+
+			for workers in sorted({1, os.cpu_count() or 1}):
+				def verify() -> None:
+					if sum(1 for chunk in torrent.verify_local_data(workers=workers) if chunk.actual_hash != zero_hash):
+						raise ValueError("The sparse file should only have zeroes in it")
+
+				seconds = best_of(repeat, verify)
+				results.append(MicroResult(name='verify_local_data', parameters={'bytes' : verify_size, 'files' : files, 'workers' : workers}, seconds=seconds, operations=piece_count * piece_length, unit='bytes', repeat=repeat))
+
+	return results
+
+@benchmark('scoreboard')
+def bench_scoreboard(repeat :int, generator :random.Random, **options) -> typing.List[MicroResult]:
+	"""
+	Picks and reports back a seed like every download does, and the same while excluding
+	the seeds already working on a piece like endgame hedges and block retries do.
+	"""
+	from ..models import Scoreboard
+
+	results = []
+	rounds = 20_000
+	for seed_count in (10, 100, 500):
+		seeds = [f"http://seed-{index}.example/" for index in range(seed_count)]
+		samples = [(generator.randrange(64 * 1024, 1024 * 1024), generator.uniform(0.001, 0.1), generator.uniform(0.01, 1.0)) for sample in range(1024)]
+
+		for excluded in (0, 8):
+			scoreboard = Scoreboard(max_active=8)
+
+			def setup() -> None:
+				for target in seeds:
+					scoreboard.remove_seed(target)
+				for target in seeds:
+					scoreboard.add_seed(target)
+				# Every seed starts out measured, so the heap is ordered by something real
+				for index, target in enumerate(seeds):
+					if scoreboard.pick() is not None:
+						size, connect_time, transfer_time = samples[index % len(samples)]
+						scoreboard.report(target, size, connect_time, transfer_time, first_byte_time=connect_time)
+
+			def run() -> None:
+				exclude = None
+				for round_index in range(rounds):
+					if excluded:
+						exclude = set(scoreboard.top(excluded))
+					if (target := scoreboard.pick(exclude)) is None:
+						continue
+					size, connect_time, transfer_time = samples[round_index % len(samples)]
+					if round_index % 50 == 0:
+						scoreboard.report_error(target)
+					else:
+						scoreboard.report(target, size, connect_time, transfer_time, first_byte_time=connect_time)
+
+			seconds = best_of(repeat, run, setup)
+			results.append(MicroResult(name='scoreboard', parameters={'seeds' : seed_count, 'excluded' : excluded}, seconds=seconds, operations=rounds, unit='picks', repeat=repeat))
+
+	return results
+
+@benchmark('coordinator')
+def bench_coordinator(repeat :int, generator :random.Random, **options) -> typing.List[MicroResult]:
+	"""
+	The bookkeeping the __main__ loop does per piece (picking, marking it requested and done,
+	the endgame checks and progress sampling) with an engine that finishes pieces instantly, in random order.
+	"""
+	from ..models import Progress
+	from ..engines import Endgame, create_picker
+
+	results = []
+	for piece_count in (100_000, 1_000_000):
+		for picker_name in ('sequential', 'window'):
+			def run() -> None:
+				progress = Progress(piece_count=piece_count, length=piece_count * 16384)
+				picker = create_picker(picker_name, 16384, piece_count * 16384, window=64, rate=1024 * 1024)
+				endgame = Endgame()
+				outstanding = []
+
+				while True:
+					free = 256 - progress.requested
+					if free > 0 and not picker.exhausted(progress):
+						outstanding += picker.pick(progress, free)
+
+					if not progress.requested:
+						break
+
+					index = outstanding.pop(generator.randrange(len(outstanding)))
+					progress.mark_done(index, 16384, duration=0.01)
+					endgame.completed(index)
+
+					for overdue in picker.overdue(progress):
+						endgame.may_hedge(overdue)
+					if picker.exhausted(progress):
+						endgame.candidates(progress)
+					if progress.done % 1024 == 0:
+						progress.sample()
+
+			seconds = best_of(repeat, run)
+			results.append(MicroResult(name='coordinator', parameters={'pieces' : piece_count, 'picker' : picker_name}, seconds=seconds, operations=piece_count, unit='pieces', repeat=repeat))
+
+	return results
+
+def compare(results :typing.List[MicroResult], baseline :typing.Dict[str, typing.Any], tolerance :float) -> typing.List[str]:
+	"""
+	Returns a line for every result that's slower than the baseline by more than tolerance (0.25 being 25%).
+	"""
+	regressions = []
+	for result in results:
+		if (previous := baseline.get('results', {}).get(result.key)) is None:
+			continue
+		if result.seconds > previous['seconds'] * (1 + tolerance):
+			regressions.append(f"{result.key}: {result.seconds * 1000:.1f}ms, was {previous['seconds'] * 1000:.1f}ms ({(result.seconds / previous['seconds'] - 1) * 100:+.0f}%)")
+	return regressions
+
+def main() -> int:
+	import ptorrent
+
+	parameters = argparse.ArgumentParser(description="Micro-benchmarks of ptorrent's hot paths.", add_help=True)
+	parameters.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="Which benchmarks to run.", required=False)
+	parameters.add_argument("--repeat", nargs="?", type=int, default=3, help="Runs per benchmark, the fastest one counts.", required=False)
+	parameters.add_argument("--verify-size", nargs="?", type=parse_size, default=parse_size("2G"), help="Size of the sparse file verify_local_data hashes.", required=False)
+	parameters.add_argument("--random-seed", nargs="?", type=int, default=0, help="Seeds the generated inputs.", required=False)
+	parameters.add_argument("--output", nargs="?", type=pathlib.Path, default=None, help="Write the results to this file as JSON, which can be used as a --baseline later.", required=False)
+	parameters.add_argument("--baseline", nargs="?", type=pathlib.Path, default=None, help="Compare against the results in this file, and exit with 1 on a regression.", required=False)
+	parameters.add_argument("--tolerance", nargs="?", type=float, default=0.25, help="How much slower than the baseline (0.25 being 25%%) counts as a regression.", required=False)
+	arguments = parameters.parse_args()
+	ptorrent.storage['arguments'] = arguments
+
+	results = []
+	for name in arguments.only:
+		for result in BENCHMARKS[name](repeat=arguments.repeat, generator=random.Random(arguments.random_seed), verify_size=arguments.verify_size):
+			ptorrent.log(result.describe())
+			results.append(result)
+
+	if arguments.output:
+		arguments.output.write_text(json.dumps({
+			'time' : time.time(),
+			'python' : platform.python_version(),
+			'machine' : platform.machine(),
+			'cpus' : os.cpu_count(),
+			'results' : {result.key : result.__json__() for result in results}
+		}, indent=4))
+
+	if arguments.baseline:
+		if regressions := compare(results, json.loads(arguments.baseline.read_text()), arguments.tolerance):
+			for line in regressions:
+				ptorrent.log(f"Regression in {line}", fg="red")
+			return 1
+		ptorrent.log(f"No regressions compared to {arguments.baseline}", fg="green")
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import typing
+import filecmp
+import pathlib
+import resource
+import tempfile
+import subprocess
+from dataclasses import dataclass, field
+from .fixtures import Fixture
+
+@dataclass
+class BenchmarkResult:
+	"""
+	One download of a fixture by ptorrent, as reported by its --stats together with what it cost.
+	cpu_seconds covers ptorrent and every process it started (workers, the seed manager).
+	"""
+	engine :str
+	arguments :typing.List[str]
+	returncode :int
+	intact :bool # Whether the downloaded files match the fixture
+	seconds :float
+	stats :typing.Dict[str, typing.Any] = field(default_factory=dict)
+	cpu_seconds :float = 0.0
+	seeds :typing.List[typing.Dict[str, int]] = field(default_factory=list)
+
+	@property
+	def megabytes(self) -> float:
+		return self.stats.get('downloaded_bytes', 0) / 1024 / 1024
+
+	@property
+	def throughput(self) -> float:
+		return self.stats.get('throughput', 0.0)
+
+	@property
+	def cpu_per_mb(self) -> typing.Optional[float]:
+		return self.cpu_seconds / self.megabytes if self.megabytes else None
+
+	def __json__(self):
+		return {
+			'engine' : self.engine,
+			'arguments' : self.arguments,
+			'returncode' : self.returncode,
+			'intact' : self.intact,
+			'seconds' : self.seconds,
+			'cpu_seconds' : self.cpu_seconds,
+			'cpu_per_mb' : self.cpu_per_mb,
+			'stats' : self.stats,
+			'seeds' : self.seeds
+		}
+
+	def describe(self) -> str:
+		if self.returncode != 0 or not self.stats:
+			return f"{self.engine}: failed with exit code {self.returncode} after {self.seconds:.2f}s"
+
+		latency = self.stats['piece_latency']
+		first_piece = self.stats['time_to_first_piece']
+		return (
+			f"{self.engine}: {self.megabytes:.1f}MB in {self.seconds:.2f}s, {self.throughput / 1024 / 1024:.2f}MB/s,"
+			f" first piece {first_piece * 1000 if first_piece is not None else 0:.0f}ms,"
+			f" piece latency p50 {(latency['p50'] or 0) * 1000:.0f}ms p99 {(latency['p99'] or 0) * 1000:.0f}ms max {(latency['p100'] or 0) * 1000:.0f}ms,"
+			f" {self.cpu_per_mb or 0:.3f} CPU s/MB{'' if self.intact else ', FILES DIFFER'}"
+		)
+
+def _cpu_seconds() -> float:
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime + usage.ru_stime
+
+def run_download(fixture :Fixture, torrent :pathlib.Path, engine :str, arguments :typing.Optional[typing.List[str]] = None, timeout :float = 600) -> BenchmarkResult:
+	"""
+	Downloads torrent with `python -m ptorrent` into an empty home directory
+	(the full download path, nothing cached or resumed), and checks the result against the fixture.
+	"""
+	arguments = list(arguments or [])
+
+	with tempfile.TemporaryDirectory(prefix='ptorrent-benchmark-') as home:
+		home = pathlib.Path(home)
+		stats_path = home / 'stats.json'
+		environment = {
+			**os.environ,
+			'HOME' : str(home),
+			'PYTHONPATH' : os.pathsep.join(filter(None, [str(pathlib.Path(__file__).resolve().parents[2]), os.environ.get('PYTHONPATH')]))
+		}
+
+		cpu_before = _cpu_seconds()
+		started = time.time()
+		try:
+			process = subprocess.run(
+				[sys.executable, '-m', 'ptorrent', '--torrent', str(torrent), '--engine', engine, '--no-cache', '--stats', str(stats_path), *arguments],
+				env=environment,
+				cwd=home,
+				stdout=subprocess.DEVNULL,
+				stderr=subprocess.PIPE,
+				timeout=timeout
+			)
+			returncode = process.returncode
+		except subprocess.TimeoutExpired:
+			returncode = -1
+		seconds = time.time() - started
+		cpu_seconds = _cpu_seconds() - cpu_before
+
+		stats = json.loads(stats_path.read_text()) if stats_path.exists() else {}
+		intact = returncode == 0 and all(
+			downloaded.is_file() and filecmp.cmp(downloaded, original, shallow=False)
+			for downloaded, original in zip(fixture.paths(home), fixture.paths())
+		)
+
+	return BenchmarkResult(engine=engine, arguments=arguments, returncode=returncode, intact=intact, seconds=seconds, stats=stats, cpu_seconds=cpu_seconds)
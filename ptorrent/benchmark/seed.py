@@ -0,0 +1,206 @@
+import re
+import sys
+import time
+import random
+import typing
+import pathlib
+import threading
+import http.server
+import urllib.parse
+from dataclasses import dataclass, fields
+
+@dataclass
+class SeedProfile:
+	"""
+	How a simulated web seed behaves. Rates are in bytes/s, 0 meaning unlimited.
+	bandwidth is shared by every connection to the seed. A connection starts at initial_rate and
+	doubles it every quarter of slow_start seconds, after which only the bandwidth limits it.
+	"""
+	latency :float = 0.0 # Seconds before every response
+	bandwidth :float = 0.0
+	error_rate :float = 0.0 # Share of requests answered with a 503
+	truncate_rate :float = 0.0 # Share of responses cut off part way through the body
+	slow_start :float = 0.0
+	initial_rate :float = 256 * 1024
+
+	@classmethod
+	def parse(cls, spec :str) -> 'SeedProfile':
+		"""
+		Parses "latency=0.05,bandwidth=10M,error_rate=0.01" style specs,
+		rates and sizes may use K/M/G suffixes.
+		"""
+		from .fixtures import parse_size
+
+		names = {field_obj.name for field_obj in fields(cls)}
+		values = {}
+		for option in filter(None, spec.split(',')):
+			name, separator, value = option.partition('=')
+			if name not in names or not separator:
+				raise ValueError(f"Unknown seed option {option}, expected one of: {', '.join(sorted(names))}")
+			values[name] = float(parse_size(value)) if name in ('bandwidth', 'initial_rate') else float(value)
+
+		return cls(**values)
+
+	def __str__(self) -> str:
+		values = {field_obj.name : getattr(self, field_obj.name) for field_obj in fields(self)}
+		return ','.join(f"{name}={int(value) if value == int(value) else value}" for name, value in values.items())
+
+class Throttle:
+	"""
+	Hands out transmission time at rate bytes/s to the threads sharing it, in the order they ask.
+	"""
+	def __init__(self, rate :float):
+		self.rate = rate
+		self._free_at = 0.0
+		self._lock = threading.Lock()
+
+	def wait(self, size :int) -> None:
+		if self.rate <= 0:
+			return None
+
+		with self._lock:
+			now = time.monotonic()
+			self._free_at = max(now, self._free_at) + size / self.rate
+			until = self._free_at
+
+		time.sleep(max(until - now, 0))
+
+class SeedRequestHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Serves files from the server's root with Range support, misbehaving according to its SeedProfile.
+	There's one handler per connection, so slow start is tracked on it.
+	"""
+	protocol_version = 'HTTP/1.1'
+	block_size = 16 * 1024
+
+	def log_message(self, *args) -> None:
+		pass
+
+	def setup(self) -> None:
+		super().setup()
+		self.connected_at = time.monotonic()
+
+	def connection_rate(self) -> float:
+		profile = self.server.profile
+		if profile.slow_start <= 0 or (elapsed := time.monotonic() - self.connected_at) >= profile.slow_start:
+			return 0.0
+		return profile.initial_rate * 2 ** int(elapsed / (profile.slow_start / 4))
+
+	def send_empty(self, status :int) -> None:
+		self.send_response(status)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def do_GET(self) -> None:
+		server = self.server
+		profile = server.profile
+		server.count('requests')
+
+		if profile.latency:
+			time.sleep(profile.latency)
+
+		path = (server.root / urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip('/')).resolve()
+		if server.root not in path.parents or not path.is_file():
+			return self.send_empty(404)
+
+		if server.chance(profile.error_rate):
+			server.count('errors')
+			return self.send_empty(503)
+
+		size = path.stat().st_size
+		if byte_range := re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', '')):
+			start = int(byte_range.group(1))
+			end = min(int(byte_range.group(2) or size - 1), size - 1)
+			if start > end:
+				return self.send_empty(416)
+			self.send_response(206)
+			self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+		else:
+			start, end = 0, size - 1
+			self.send_response(200)
+
+		length = end - start + 1
+		self.send_header('Content-Length', str(length))
+		self.end_headers()
+
+		# The response claims the full length, but the connection is closed after send bytes
+		send = length
+		if server.chance(profile.truncate_rate):
+			server.count('truncated')
+			send = int(length * server.uniform())
+			self.close_connection = True
+
+		with path.open('rb') as fh:
+			fh.seek(start)
+			while send > 0:
+				block = fh.read(min(self.block_size, send))
+				if not block:
+					break
+
+				server.throttle.wait(len(block))
+				if rate := self.connection_rate():
+					time.sleep(len(block) / rate)
+
+				try:
+					self.wfile.write(block)
+				except (BrokenPipeError, ConnectionResetError):
+					self.close_connection = True
+					return None
+
+				send -= len(block)
+				server.count('bytes_sent', len(block))
+
+class WebSeedServer(http.server.ThreadingHTTPServer):
+	"""
+	A local stand-in for a web seed, serving root on a port of its own in a background thread.
+	Misbehaviour is drawn from a random.Random(seed), so a run can be repeated.
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, root :pathlib.Path, profile :typing.Optional[SeedProfile] = None, seed :int = 0, host :str = '127.0.0.1', port :int = 0):
+		super().__init__((host, port), SeedRequestHandler)
+		self.root = pathlib.Path(root).resolve()
+		self.profile = profile or SeedProfile()
+		self.throttle = Throttle(self.profile.bandwidth)
+		self.counters = {'requests' : 0, 'errors' : 0, 'truncated' : 0, 'bytes_sent' : 0}
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._thread :typing.Optional[threading.Thread] = None
+
+	@property
+	def url(self) -> str:
+		host, port = self.server_address[:2]
+		return f"http://{host}:{port}/"
+
+	def chance(self, rate :float) -> bool:
+		if rate <= 0:
+			return False
+		with self._lock:
+			return self._random.random() < rate
+
+	def uniform(self) -> float:
+		with self._lock:
+			return self._random.random()
+
+	def count(self, name :str, amount :int = 1) -> None:
+		with self._lock:
+			self.counters[name] += amount
+
+	def handle_error(self, request, client_address) -> None:
+		# Clients drop kept-alive connections whenever they're done with them, or cancel a request,
+		# which isn't worth a traceback. Anything else still gets one.
+		if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+			return None
+		super().handle_error(request, client_address)
+
+	def start(self) -> 'WebSeedServer':
+		self._thread = threading.Thread(target=self.serve_forever, name=f"ptorrent-seed-{self.server_address[1]}", daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self) -> None:
+		self.shutdown()
+		self.server_close()
+		if self._thread:
+			self._thread.join()
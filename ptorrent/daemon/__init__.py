@@ -0,0 +1,13 @@
+from .download import (
+	Download,
+	STATE_DOWNLOADING,
+	STATE_PAUSED,
+	STATE_DONE
+)
+from .control import (
+	COMMANDS,
+	ControlServer,
+	default_socket,
+	send_command
+)
+from .service import Daemon
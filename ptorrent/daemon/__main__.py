@@ -0,0 +1,75 @@
+import os
+import signal
+import pathlib
+import argparse
+import ptorrent
+from . import Daemon, default_socket
+
+# Downloads many torrents at once through one engine, e.g.:
+#   python -m ptorrent.daemon --connections 128 first.torrent second.torrent
+# More can be added (and paused, re-prioritised or removed) while it runs:
+#   python -m ptorrent.daemon.client add third.torrent --priority 2
+
+parameters = argparse.ArgumentParser(description="Downloads any number of torrents through a single engine, controlled over a unix socket.", add_help=True)
+parameters.add_argument("torrents", nargs="*", type=pathlib.Path, help="Torrents to start downloading right away.")
+parameters.add_argument("--control", nargs="?", type=pathlib.Path, default=default_socket(), help="Where to put the control socket.", required=False)
+parameters.add_argument("--download-location", nargs="?", type=pathlib.Path, default=pathlib.Path('~/'), help="Where torrents are downloaded to, unless they're added with a --location of their own.", required=False)
+parameters.add_argument("--exit-when-done", action="store_true", default=False, help="Exit once every torrent is downloaded instead of waiting for more.", required=False)
+parameters.add_argument("--remove-when-done", action="store_true", default=False, help="Remove torrents from the daemon as soon as they're downloaded, instead of keeping them until they're removed by hand.", required=False)
+parameters.add_argument("--debug", action="store_true", default=False, help="Turn on debugging.", required=False)
+parameters.add_argument("--verify-workers", nargs="?", type=int, default=os.cpu_count() or 1, help="How many threads to hash local data with when a torrent is added.", required=False)
+parameters.add_argument("--recheck", action="store_true", default=False, help="Re-hash all local data even if the resume state says it's intact.", required=False)
+parameters.add_argument("--engine", nargs="?", choices=["process", "asyncio"], default="process", help="Download every piece in a process of its own (process), or all of them from a single asyncio event loop (asyncio).", required=False)
+parameters.add_argument("--connections", nargs="?", type=int, default=64, help="How many downloads may run at the same time at most, for all torrents together.", required=False)
+parameters.add_argument("--connections-per-seed", nargs="?", type=int, default=8, help="How many requests may run against a single web seed of a torrent at the same time at most.", required=False)
+parameters.add_argument("--max-request-size", nargs="?", type=int, default=8 * 1024 * 1024, help="How many bytes of adjacent missing pieces the asyncio engine merges into a single request at most.", required=False)
+parameters.add_argument("--block-size", nargs="?", type=int, default=0, help="Split pieces larger than this many bytes into blocks the asyncio engine fetches from several seeds at once (0 turns this off).", required=False)
+parameters.add_argument("--endgame-pieces", nargs="?", type=int, default=16, help="Once this few pieces of a torrent are left, slow pieces are requested from another seed as well (0 turns this off).", required=False)
+parameters.add_argument("--timeout-limits", nargs=3, type=float, default=[1.0, 0.2, 60.0], metavar=("INITIAL", "MINIMUM", "MAXIMUM"), help="The request timeouts used before anything is known about a seed, and the bounds they're kept within.", required=False)
+parameters.add_argument("--rate-limit", nargs="?", type=ptorrent.parse_size, default=0, help="Download at most this many bytes/s for all torrents together (K/M/G suffixes are allowed, 0 is unlimited).", required=False)
+parameters.add_argument("--rate-limit-per-torrent", nargs="?", type=ptorrent.parse_size, default=0, help="Download at most this many bytes/s for any single torrent (0 is unlimited).", required=False)
+parameters.add_argument("--rate-limit-per-seed", nargs="?", type=ptorrent.parse_size, default=0, help="Download at most this many bytes/s from any single web seed host, for all torrents together (0 is unlimited).", required=False)
+parameters.add_argument("--metrics-port", nargs="?", type=int, default=None, help="Serve the engine's metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics.", required=False)
+parameters.add_argument("--no-cache", action="store_true", default=False, help="Always parse the torrents instead of using the cached metadata.", required=False)
+arguments = parameters.parse_args()
+ptorrent.storage['arguments'] = arguments
+
+daemon = Daemon(
+	engine=arguments.engine,
+	max_connections=arguments.connections,
+	max_per_seed=arguments.connections_per_seed,
+	max_request_bytes=arguments.max_request_size,
+	block_size=arguments.block_size,
+	endgame_pieces=arguments.endgame_pieces,
+	timeout_limits=dict(zip(('initial', 'minimum', 'maximum'), arguments.timeout_limits)),
+	verify_workers=arguments.verify_workers,
+	recheck=arguments.recheck,
+	use_cache=not arguments.no_cache,
+	download_location=arguments.download_location,
+	rate_limit=arguments.rate_limit,
+	torrent_rate_limit=arguments.rate_limit_per_torrent,
+	seed_rate_limit=arguments.rate_limit_per_seed,
+	remove_when_done=arguments.remove_when_done
+)
+
+def handler(signum, frame):
+	daemon.running = False
+
+signal.signal(signal.SIGINT, handler)
+signal.signal(signal.SIGTERM, handler)
+
+try:
+	daemon.serve(arguments.control)
+	ptorrent.log(f"Listening for commands on {arguments.control}")
+
+	ptorrent.metrics.track_engine(daemon.engine, daemon.results)
+	if arguments.metrics_port:
+		ptorrent.metrics.registry.serve(arguments.metrics_port)
+		ptorrent.log(f"Serving metrics at http://127.0.0.1:{arguments.metrics_port}/metrics")
+
+	for path in arguments.torrents:
+		daemon.add(path)
+
+	daemon.run(exit_when_done=arguments.exit_when_done)
+finally:
+	daemon.close()
@@ -0,0 +1,67 @@
+import sys
+import json
+import pathlib
+import argparse
+from .control import default_socket, send_command
+from ..parsers import parse_size
+
+# Sends a command to a running daemon, e.g.:
+#   python -m ptorrent.daemon.client add file.torrent --priority 2
+#   python -m ptorrent.daemon.client status
+
+def main() -> int:
+	import ptorrent
+
+	parameters = argparse.ArgumentParser(description="Controls a running ptorrent daemon, see python -m ptorrent.daemon.", add_help=True)
+	parameters.add_argument("--control", nargs="?", type=pathlib.Path, default=default_socket(), help="The daemon's control socket.", required=False)
+	commands = parameters.add_subparsers(dest="command", required=True)
+
+	add = commands.add_parser("add", help="Start downloading a torrent.")
+	add.add_argument("torrent", type=pathlib.Path)
+	add.add_argument("--priority", nargs="?", type=int, default=1, help="The torrent's share of the connections compared to the others, 2 getting twice as many as 1.", required=False)
+	add.add_argument("--location", nargs="?", type=pathlib.Path, default=None, help="Where to download it to, instead of the daemon's --download-location.", required=False)
+	add.add_argument("--paused", action="store_true", default=False, help="Only verify the local data, and wait with the download until it's resumed.", required=False)
+
+	for name, description in (('pause', "Stop requesting pieces of a torrent, the ones already requested still arrive."), ('resume', "Continue a paused torrent."), ('remove', "Stop downloading a torrent, the data downloaded so far is kept.")):
+		command = commands.add_parser(name, help=description)
+		command.add_argument("id", help="The torrent's id or info hash, see status.")
+
+	priority = commands.add_parser("priority", help="Change a torrent's share of the connections.")
+	priority.add_argument("id", help="The torrent's id or info hash, see status.")
+	priority.add_argument("priority", type=int)
+
+	limit = commands.add_parser("limit", help="Change how many downloads may run at the same time at most, for all torrents together.")
+	limit.add_argument("connections", type=int)
+
+	rate = commands.add_parser("rate", help="Change how many bytes/s may be downloaded at most, 0 being unlimited.")
+	rate.add_argument("scope", choices=["total", "torrent", "seed"], help="Everything together, a torrent or a seed host.")
+	rate.add_argument("rate", type=parse_size, help="Bytes/s, K/M/G suffixes are allowed.")
+	rate.add_argument("target", nargs="?", default=None, help="The torrent's id or info hash, or the seed's host (or URL). Every torrent or seed host if left out.")
+
+	commands.add_parser("status", help="Show every torrent and the engine.")
+	commands.add_parser("shutdown", help="Stop the daemon.")
+
+	arguments = parameters.parse_args()
+	ptorrent.storage['arguments'] = arguments
+
+	options = {name : value for name, value in vars(arguments).items() if name not in ('control', 'command')}
+	for name in ('torrent', 'location'):
+		if options.get(name) is not None:
+			# The daemon may well have another working directory
+			options[name] = str(options[name].expanduser().resolve())
+
+	try:
+		reply = send_command(arguments.control, arguments.command, **options)
+	except OSError as error:
+		ptorrent.log(f"Could not reach the daemon on {arguments.control}: {error}", fg="red")
+		return 1
+
+	if not reply.get('ok'):
+		ptorrent.log(reply.get('error', 'Unknown error'), fg="red")
+		return 1
+
+	print(json.dumps(reply.get('result'), indent=4))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
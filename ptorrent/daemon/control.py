@@ -0,0 +1,91 @@
+import os
+import json
+import queue
+import socket
+import typing
+import pathlib
+import socketserver
+from ..storage import storage
+
+# The daemon is controlled over a unix socket, one JSON object per line in both directions:
+#   {"command" : "add", "torrent" : "/path/to/file.torrent", "priority" : 2}
+#   {"ok" : true, "result" : {...}}
+# python -m ptorrent.daemon.client sends them from the command line.
+
+COMMANDS = ('add', 'pause', 'resume', 'priority', 'remove', 'status', 'limit', 'rate', 'shutdown')
+
+def default_socket() -> pathlib.Path:
+	return pathlib.Path(storage.get('CONTROL_SOCKET', '~/.cache/ptorrent/control.sock')).expanduser()
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+	"""
+	Hands every request to the daemon's loop through the server's commands queue,
+	so the downloads are only ever touched from the loop's thread, and waits for the reply.
+	"""
+	def handle(self) -> None:
+		for line in self.rfile:
+			if not line.strip():
+				continue
+
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict):
+					raise ValueError(f"Expected a JSON object, got {line!r}")
+			except ValueError as error:
+				reply = {'ok' : False, 'error' : str(error)}
+			else:
+				replies = queue.Queue(maxsize=1)
+				self.server.commands.put((request, replies))
+				try:
+					reply = replies.get(timeout=self.server.reply_timeout)
+				except queue.Empty:
+					reply = {'ok' : False, 'error' : f"The daemon did not reply within {self.server.reply_timeout}s"}
+
+			self.wfile.write(json.dumps(reply).encode('UTF-8') + b'\n')
+			self.wfile.flush()
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path :pathlib.Path, commands :queue.Queue, reply_timeout :float = 600):
+		self.path = pathlib.Path(path)
+		self.commands = commands
+		self.reply_timeout = reply_timeout
+
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		if self.path.exists():
+			# Left behind by a daemon that didn't exit cleanly, unless it's still around
+			try:
+				send_command(self.path, 'status', timeout=5)
+			except OSError:
+				self.path.unlink()
+			else:
+				raise FileExistsError(f"Another daemon is already listening on {self.path}")
+
+		# Only the user running the daemon may talk to it
+		umask = os.umask(0o077)
+		try:
+			super().__init__(str(self.path), ControlRequestHandler)
+		finally:
+			os.umask(umask)
+
+	def server_close(self) -> None:
+		super().server_close()
+		try:
+			self.path.unlink()
+		except FileNotFoundError:
+			pass
+
+def send_command(path :pathlib.Path, command :str, timeout :typing.Optional[float] = None, **arguments) -> typing.Dict[str, typing.Any]:
+	"""
+	Sends a command to the daemon listening on path and returns its reply.
+	"""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+		connection.settimeout(timeout)
+		connection.connect(str(path))
+		connection.sendall(json.dumps({'command' : command, **arguments}).encode('UTF-8') + b'\n')
+
+		with connection.makefile('rb') as fh:
+			if not (line := fh.readline()):
+				raise ConnectionResetError(f"The daemon on {path} closed the connection without replying.")
+			return json.loads(line)
@@ -0,0 +1,122 @@
+import time
+import typing
+from dataclasses import dataclass, field
+from ..models import Torrent, Progress, BrokenChunk, PieceResult
+from ..engines import Endgame
+
+STATE_DOWNLOADING = 'downloading'
+STATE_PAUSED = 'paused'
+STATE_DONE = 'done'
+
+@dataclass
+class Download:
+	"""
+	A torrent the Daemon() downloads, together with what the __main__ loop keeps
+	around for a single torrent (its progress, picker and endgame).
+	priority is its weight when sharing the engine with the other downloads,
+	one with priority 2 gets twice the requests in flight of one with priority 1.
+	"""
+	torrent :Torrent
+	progress :Progress
+	picker :typing.Any
+	endgame :Endgame
+	pieces_per_request :int = 1
+	priority :int = 1
+	paused :bool = False
+	added :float = field(default_factory=time.time)
+	finished_at :typing.Optional[float] = None
+
+	@property
+	def state(self) -> str:
+		if self.finished_at is not None:
+			return STATE_DONE
+		if self.paused:
+			return STATE_PAUSED
+		return STATE_DOWNLOADING
+
+	@property
+	def in_flight(self) -> float:
+		"""
+		How many of the engine's requests the download occupies.
+		"""
+		return self.progress.requested / self.pieces_per_request
+
+	@property
+	def requested_bytes(self) -> int:
+		return self.progress.requested * self.torrent.info.piece_length
+
+	@property
+	def share(self) -> float:
+		return self.in_flight / self.priority
+
+	@property
+	def wants_pieces(self) -> bool:
+		return self.state == STATE_DOWNLOADING and not self.picker.exhausted(self.progress)
+
+	def chunk(self, index :int) -> BrokenChunk:
+		return BrokenChunk(torrent=self.torrent, index=index, expected_hash=self.torrent.info.piece_hash(index), data=None, actual_hash=None)
+
+	def pick(self, engine, count :int) -> typing.List[int]:
+		picked = self.picker.pick(self.progress, count)
+		engine.submit_many(self.chunk(index) for index in picked)
+		return picked
+
+	def handle(self, engine, result :PieceResult) -> None:
+		"""
+		Stores, retries or throws away what the engine reported for one of the download's pieces.
+		"""
+		if self.progress.is_done(result.index):
+			# A duplicate from the endgame that lost
+			self.progress.mark_wasted(result.size)
+		elif result.ok:
+			self.torrent.store_result(result)
+			self.progress.mark_done(result.index, result.size, duration=result.connect_time + result.transfer_time)
+			if self.endgame.completed(result.index):
+				engine.cancel(result.torrent_uuid, result.index)
+		elif self.endgame.copy_failed(result.index):
+			# Another copy of it is still on its way
+			self.progress.mark_failed(result.index, retried=False)
+		else:
+			# Paused downloads finish what they already asked for, so failures are retried either way
+			self.progress.mark_failed(result.index)
+			engine.submit(self.chunk(result.index))
+
+	def hedge(self, engine) -> None:
+		if self.state != STATE_DOWNLOADING:
+			return None
+
+		hedges = [index for index in self.picker.overdue(self.progress) if self.endgame.may_hedge(index)]
+		if self.picker.exhausted(self.progress):
+			hedges += [index for index in self.endgame.candidates(self.progress) if index not in hedges]
+
+		for index in hedges:
+			self.endgame.hedging(index)
+			engine.hedge(self.chunk(index))
+
+	def cancel(self, engine) -> None:
+		"""
+		Drops every outstanding request of the download that the engine can still drop.
+		"""
+		for index in list(self.progress.requested_at):
+			engine.cancel(self.torrent.uuid, index)
+
+	def status(self) -> typing.Dict[str, typing.Any]:
+		return {
+			'id' : str(self.torrent.uuid),
+			'name' : self.torrent.info.name.decode('UTF-8', errors='replace'),
+			'info_hash' : self.torrent.info.info_hash.hex(),
+			'location' : str(self.torrent.target_path),
+			'state' : self.state,
+			'priority' : self.priority,
+			'pieces' : self.progress.piece_count,
+			'done' : self.progress.done,
+			'requested' : self.progress.requested,
+			'done_bytes' : self.progress.done_bytes,
+			'length' : self.progress.length,
+			'rate' : self.progress.rate,
+			'eta' : self.progress.eta(),
+			'hedged' : self.endgame.hedged
+		}
+
+	def describe(self) -> str:
+		return f"{self.torrent.info.name.decode('UTF-8', errors='replace')} [{self.state}, priority {self.priority}]: {self.progress.describe()}"
@@ -0,0 +1,345 @@
+import time
+import uuid
+import queue
+import heapq
+import typing
+import logging
+import threading
+import pathlib
+import multiprocessing
+from ..models import Chunk, Progress, Scoreboard, SeedManager
+from ..engines import Endgame, create_engine, create_picker
+from ..parsers import load_torrent, open_torrent
+from ..network import rate_limits, seed_host
+from ..storage import storage
+from ..logger import log
+from .download import Download, STATE_DOWNLOADING, STATE_PAUSED, STATE_DONE
+from .control import ControlServer
+
+class Daemon:
+	"""
+	Downloads any number of torrents at the same time through a single engine.
+
+	The engine's AIMDController() caps the requests in flight for all torrents together
+	(at most max_connections), and whenever there's room the download with the fewest
+	requests in flight for its priority gets to fill it, so torrents share the
+	connections in proportion to their priority. Torrents can be added, paused, resumed,
+	re-prioritised and removed while running, through handle_command() or the control socket.
+	With remove_when_done, finished torrents are removed right away instead of being kept around
+	(and listed) until they're removed by hand, for daemons that go through many of them.
+	"""
+	def __init__(self, engine :str = 'process', max_connections :int = 64, max_per_seed :int = 8, max_request_bytes :int = 8 * 1024 * 1024, block_size :int = 0, endgame_pieces :int = 16, timeout_limits :typing.Optional[typing.Dict[str, float]] = None, verify_workers :int = 1, recheck :bool = False, use_cache :bool = True, download_location :pathlib.Path = pathlib.Path('~/'), rate_limit :float = 0.0, torrent_rate_limit :float = 0.0, seed_rate_limit :float = 0.0, remove_when_done :bool = False):
+		# The buckets live in shared memory, so they have to exist before the workers are forked
+		self.rate_limits = rate_limits()
+		self.rate_limits.total.set_rate(rate_limit)
+		self.rate_limits.set_torrent_rate(torrent_rate_limit)
+		self.rate_limits.set_seed_rate(seed_rate_limit)
+
+		self.engine = create_engine(engine, max_connections=max_connections, max_per_seed=max_per_seed, max_request_bytes=max_request_bytes, block_size=block_size)
+		self.max_per_seed = max_per_seed
+		self.endgame_pieces = endgame_pieces
+		self.timeout_limits = timeout_limits
+		self.verify_workers = verify_workers
+		self.recheck = recheck
+		self.use_cache = use_cache
+		self.download_location = download_location
+		self.remove_when_done = remove_when_done
+
+		# One results queue for every torrent, PieceResult()s say which torrent they belong to
+		self.results = multiprocessing.Queue() if engine == 'process' else queue.Queue()
+
+		# Worker processes share the scoreboards through a manager process, see __main__
+		if engine == 'process':
+			self.seed_manager = SeedManager()
+			self.seed_manager.start()
+		else:
+			self.seed_manager = None
+
+		self.downloads :typing.Dict[uuid.UUID, Download] = {}
+		self.commands :queue.Queue = queue.Queue()
+		self.control :typing.Optional[ControlServer] = None
+		self.running = True
+
+	def _scoreboard(self) -> Scoreboard:
+		if self.seed_manager:
+			return self.seed_manager.Scoreboard(max_active=self.max_per_seed, timeout_limits=self.timeout_limits)
+		return Scoreboard(max_active=self.max_per_seed, timeout_limits=self.timeout_limits)
+
+	def add(self, path :pathlib.Path, priority :int = 1, paused :bool = False, location :typing.Optional[pathlib.Path] = None) -> Download:
+		"""
+		Loads a torrent and verifies what's already on disk of it, which blocks the other downloads while it runs.
+		"""
+		if priority < 1:
+			raise ValueError(f"The priority has to be at least 1, got {priority}.")
+
+		# Duplicates are turned away before anything (a scoreboard, rate limits) is set up for them
+		opened = open_torrent(pathlib.Path(path), use_cache=self.use_cache)
+		location = pathlib.Path(location or self.download_location).expanduser().resolve()
+		name = opened['info'].name.decode('UTF-8', errors='replace')
+
+		for download in self.downloads.values():
+			if download.torrent.info.info_hash == opened['info'].info_hash and download.torrent.target_path == location / name:
+				raise ValueError(f"{name} is already being downloaded to {location / name} ({download.torrent.uuid}).")
+
+		torrent_uuid = load_torrent(pathlib.Path(path), self.results, self._scoreboard(), use_cache=self.use_cache, opened=opened)
+		torrent = storage['torrents'][torrent_uuid]['torrent']
+		torrent.set_download_location(location)
+		scoreboard = storage['torrents'][torrent_uuid]['peers']
+
+		self.rate_limits.register(torrent_uuid, [score.target for score in scoreboard.scores()])
+
+		progress = Progress(piece_count=torrent.info.piece_count, length=torrent.info.length)
+		for chunk in torrent.load_local_data(workers=self.verify_workers, recheck=self.recheck):
+			if type(chunk) == Chunk:
+				progress.mark_done(chunk.index, torrent.info.piece_size(chunk.index), downloaded=False)
+		torrent.open_target()
+
+		download = self.downloads[torrent_uuid] = Download(
+			torrent=torrent,
+			progress=progress,
+			picker=create_picker('sequential', torrent.info.piece_length, torrent.info.length),
+			endgame=Endgame(threshold=self.endgame_pieces),
+			pieces_per_request=self.engine.pieces_per_request(torrent.info.piece_length),
+			priority=priority,
+			paused=paused
+		)
+
+		log(f"Added {download.describe()} ({torrent_uuid})")
+		if progress.finished:
+			self._finish(download)
+
+		return download
+
+	def find(self, identifier :str) -> Download:
+		"""
+		Looks a download up by its id, or by the info hash of its torrent.
+		"""
+		for download in self.downloads.values():
+			if identifier in (str(download.torrent.uuid), download.torrent.info.info_hash.hex()):
+				return download
+		raise ValueError(f"No torrent with the id or info hash {identifier}")
+
+	def pause(self, download :Download) -> None:
+		download.paused = True
+
+	def resume(self, download :Download) -> None:
+		download.paused = False
+
+	def prioritise(self, download :Download, priority :int) -> None:
+		if priority < 1:
+			raise ValueError(f"The priority has to be at least 1, got {priority}.")
+		download.priority = priority
+
+	def remove(self, download :Download) -> None:
+		"""
+		Stops the download, what was downloaded so far stays on disk and is picked up again if it's added back.
+		Requests that are already running finish in the background and are thrown away.
+		"""
+		download.cancel(self.engine)
+		if download.state != STATE_DONE:
+			download.torrent.close(queues=False)
+
+		del self.downloads[download.torrent.uuid]
+		del storage['torrents'][download.torrent.uuid]
+		self.rate_limits.forget(download.torrent.uuid)
+		log(f"Removed {download.describe()}")
+
+	def limit(self, connections :int) -> None:
+		self.engine.controller.set_maximum(connections)
+
+	def set_rate(self, scope :str, rate :float, target :typing.Optional[str] = None) -> None:
+		"""
+		Changes the rate limit (bytes/s, 0 being unlimited) of everything (total), of a torrent
+		or a seed host, or with no target, of every torrent or seed host.
+		"""
+		if scope == 'total':
+			self.rate_limits.total.set_rate(rate)
+		elif scope == 'torrent':
+			self.rate_limits.set_torrent_rate(rate, self.find(target).torrent.uuid if target else None)
+		elif scope == 'seed':
+			self.rate_limits.set_seed_rate(rate, (seed_host(target) if '://' in target else target.lower()) if target else None)
+		else:
+			raise ValueError(f"Unknown rate limit {scope}, expected one of: total, torrent, seed")
+
+		log(f"Rate limits: {self.rate_limits.describe()}")
+
+	def status(self) -> typing.Dict[str, typing.Any]:
+		return {
+			'engine' : {**self.engine.occupancy(), 'describe' : self.engine.controller.describe()},
+			'rate_limits' : self.rate_limits.status(),
+			'torrents' : [download.status() for download in self.downloads.values()]
+		}
+
+	def _finish(self, download :Download) -> None:
+		download.finished_at = time.time()
+		download.torrent.close(queues=False)
+		log(f"Finished {download.describe()}", fg="green")
+
+		if self.remove_when_done:
+			self.remove(download)
+
+	def _room(self, download :Download) -> typing.Optional[int]:
+		"""
+		How many more pieces of download the rate limits are worth requesting, None if nothing limits it.
+		Pieces requested beyond that would only wait for their turn in the buckets (see RateLimits.backlog()),
+		and leaving them to be picked later lets the fair share decide who gets the bandwidth.
+		"""
+		piece_length = download.torrent.info.piece_length
+		rooms = []
+		if (backlog := self.rate_limits.backlog()) is not None:
+			requested = sum(other.requested_bytes for other in self.downloads.values())
+			rooms.append(max(int(backlog - requested) // piece_length, 0 if requested else 1))
+		if (backlog := self.rate_limits.backlog(download.torrent.uuid)) is not None:
+			rooms.append(max(int(backlog // piece_length), 1) - download.progress.requested)
+
+		return min(rooms) if rooms else None
+
+	def schedule(self) -> None:
+		"""
+		Fills the engine's free requests, always from the download that has the fewest in flight for its priority.
+		"""
+		free = self.engine.controller.limit - sum(download.in_flight for download in self.downloads.values())
+		if free < 1:
+			return None
+
+		waiting = [(download.share, download.added, position, download) for position, download in enumerate(self.downloads.values()) if download.wants_pieces]
+		heapq.heapify(waiting)
+
+		while free >= 1 and waiting:
+			share, added, position, download = heapq.heappop(waiting)
+			count = download.pieces_per_request
+			if (room := self._room(download)) is not None:
+				if room < 1:
+					continue
+				count = min(count, room)
+
+			if not (picked := download.pick(self.engine, count)):
+				continue
+
+			free -= len(picked) / download.pieces_per_request
+			if download.wants_pieces:
+				heapq.heappush(waiting, (download.share, added, position, download))
+
+	def handle_result(self, result) -> None:
+		self.engine.on_result(result)
+
+		if (download := self.downloads.get(result.torrent_uuid)) is None:
+			# The torrent was removed while this was on its way
+			return None
+
+		download.handle(self.engine, result)
+		if download.progress.finished and download.state != STATE_DONE:
+			self._finish(download)
+
+	def handle_command(self, request :typing.Dict[str, typing.Any]) -> typing.Any:
+		"""
+		Runs a command from the control socket, see control.COMMANDS, and returns its result.
+		"""
+		command = request.get('command')
+
+		if command == 'add':
+			return self.add(pathlib.Path(request['torrent']), priority=int(request.get('priority', 1)), paused=bool(request.get('paused', False)), location=request.get('location')).status()
+		elif command in ('pause', 'resume', 'priority', 'remove'):
+			download = self.find(str(request['id']))
+			if command == 'pause':
+				self.pause(download)
+			elif command == 'resume':
+				self.resume(download)
+			elif command == 'priority':
+				self.prioritise(download, int(request['priority']))
+			else:
+				self.remove(download)
+			return download.status()
+		elif command == 'status':
+			return self.status()
+		elif command == 'limit':
+			self.limit(int(request['connections']))
+			return self.status()['engine']
+		elif command == 'rate':
+			self.set_rate(str(request['scope']), float(request['rate']), request.get('target'))
+			return self.rate_limits.status()
+		elif command == 'shutdown':
+			self.running = False
+			return None
+
+		raise ValueError(f"Unknown command {command}")
+
+	def _run_commands(self) -> None:
+		while True:
+			try:
+				request, replies = self.commands.get_nowait()
+			except queue.Empty:
+				return None
+
+			try:
+				replies.put({'ok' : True, 'result' : self.handle_command(request)})
+			except (KeyError, ValueError, TypeError, OSError) as error:
+				message = f"{request.get('command')} is missing {error.args[0]}" if isinstance(error, KeyError) else str(error)
+				log(f"Control command {request} failed: {message}", level=logging.WARNING, fg="orange")
+				replies.put({'ok' : False, 'error' : message})
+
+	def serve(self, path :pathlib.Path) -> ControlServer:
+		self.control = ControlServer(path, self.commands)
+		threading.Thread(target=self.control.serve_forever, name='ptorrent-control', daemon=True).start()
+		return self.control
+
+	@property
+	def idle(self) -> bool:
+		return all(download.state == STATE_DONE for download in self.downloads.values())
+
+	def step(self) -> None:
+		"""
+		One round of the loop: commands, scheduling, at most one result and the endgame of every download.
+		"""
+		self._run_commands()
+		self.schedule()
+		self.engine.pump()
+
+		# Wake up now and then even if nothing arrives, the process
+		# engine needs pump() to start the next workers, and commands have to run.
+		endgame = any(download.endgame.active for download in self.downloads.values() if download.state == STATE_DOWNLOADING)
+		try:
+			result = self.results.get(timeout=0.1 if endgame else 0.5)
+		except queue.Empty:
+			result = None
+
+		if result is not None:
+			self.handle_result(result)
+
+		for download in self.downloads.values():
+			download.hedge(self.engine)
+
+	def run(self, exit_when_done :bool = False) -> None:
+		last_output = time.time()
+		while self.running and not (exit_when_done and self.idle):
+			self.step()
+
+			if time.time() - last_output > 1:
+				last_output = time.time()
+				states = {STATE_DOWNLOADING : 0, STATE_PAUSED : 0, STATE_DONE : 0}
+				rate = 0.0
+				for download in self.downloads.values():
+					states[download.state] += 1
+					if download.state != STATE_DONE:
+						rate += download.progress.sample(last_output)
+
+					if storage['arguments'].debug and download.state != STATE_DONE:
+						log(download.describe())
+
+				if states[STATE_DOWNLOADING]:
+					log(f"{states[STATE_DOWNLOADING]} downloading, {states[STATE_PAUSED]} paused, {states[STATE_DONE]} done, {rate / 1024 / 1024:.2f}MB/s ({self.engine.controller.describe()}).")
+
+	def close(self) -> None:
+		if self.control:
+			self.control.shutdown()
+			self.control.server_close()
+
+		self.engine.close()
+		for download in self.downloads.values():
+			if download.state != STATE_DONE:
+				download.torrent.close(queues=False)
+
+		if hasattr(self.results, 'close'):
+			self.results.close()
+		if self.seed_manager:
+			self.seed_manager.shutdown()
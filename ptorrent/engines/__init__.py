@@ -0,0 +1,24 @@
+from .process import ProcessEngine
+from .aio import AsyncEngine
+from .endgame import Endgame
+from .pickers import (
+	SequentialPicker,
+	PriorityPicker,
+	WindowPicker,
+	PICKERS,
+	create_picker
+)
+
+ENGINES = {
+	ProcessEngine.name : ProcessEngine,
+	AsyncEngine.name : AsyncEngine
+}
+
+def create_engine(name :str, **kwargs):
+	if name not in ENGINES:
+		raise ValueError(f"Unknown engine {name}, expected one of: {', '.join(ENGINES)}")
+
+	if name == ProcessEngine.name:
+		return ProcessEngine(max_connections=kwargs.get('max_connections', 64))
+
+	return ENGINES[name](**kwargs)
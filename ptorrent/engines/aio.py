@@ -0,0 +1,579 @@
+import ssl
+import time
+import typing
+import asyncio
+import hashlib
+import logging
+import threading
+import urllib.parse
+from ..models import BrokenChunk, PieceResult, Peer, Scoreboard, Timeouts
+from ..models.chunk import RESULT_OK, RESULT_CORRUPT, RESULT_FAILED, READ_BLOCK_SIZE
+from ..network import ConnectionPool, PoolExhausted, Shaper, rate_limits, seed_host
+from ..threading import AIMDController
+from .planner import RangeRequest, plan_requests
+from ..storage import storage
+from ..logger import log
+from .. import metrics
+from .. import tracing
+
+class HTTPError(Exception):
+	pass
+
+class StreamConnectionPool(ConnectionPool):
+	"""
+	A ConnectionPool of asyncio (reader, writer) pairs.
+	Only used from the engine's event loop, and the engine never lets more than
+	max_per_host requests run against one seed, so reserve() never has to wait.
+	"""
+	def _is_alive(self, connection :typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> bool:
+		reader, writer = connection
+		return not reader.at_eof() and not writer.is_closing()
+
+	def _close(self, connection :typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> None:
+		reader, writer = connection
+		writer.close()
+
+async def open_stream(url :urllib.parse.ParseResult, connect_timeout :float) -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+	if url.scheme == 'https':
+		port, ssl_context = url.port or 443, ssl.create_default_context()
+	elif url.scheme == 'http':
+		port, ssl_context = url.port or 80, None
+	else:
+		raise ValueError(f"Unknown schema: {url.scheme}")
+
+	return await asyncio.wait_for(asyncio.open_connection(url.hostname, port, ssl=ssl_context), connect_timeout)
+
+async def read_part(reader :asyncio.StreamReader, size :int, deadline :float, shaper :typing.Callable[[int], float]) -> typing.Tuple[bytes, float]:
+	"""
+	Reads size bytes in blocks of READ_BLOCK_SIZE, waiting as long as the shaper asks after each one.
+	Returns the data and the deadline, pushed back by however long was waited.
+	"""
+	blocks = []
+	received = 0
+	while received < size:
+		block = await asyncio.wait_for(reader.read(min(size - received, READ_BLOCK_SIZE)), max(deadline - time.time(), 0))
+		if not block:
+			raise asyncio.IncompleteReadError(b''.join(blocks), size)
+		blocks.append(block)
+		received += len(block)
+
+		if delay := shaper(len(block)):
+			await asyncio.sleep(delay)
+			# Waiting on our own rate limits isn't the seed being slow
+			deadline += delay
+
+	return b''.join(blocks), deadline
+
+async def fetch_range(pool :StreamConnectionPool, url :urllib.parse.ParseResult, start :int, sizes :typing.List[int], on_part :typing.Callable[[int, bytes], None], timeouts :Timeouts, shaper :typing.Optional[Shaper] = None) -> typing.Tuple[float, float, float]:
+	"""
+	Fetches sum(sizes) bytes from url starting at byte start, with a single keep-alive HTTP/1.1 GET.
+	The body is split into parts of the given sizes, and on_part(part_index, data) is called
+	for each one as soon as it has arrived. Connecting, waiting for the response and
+	transferring the whole body each have a deadline of their own. Parts are read at once,
+	unless the shaper (see RateLimits.shaper()) has limits to keep to, which is looked at for every part.
+	Returns the time it took to connect, until the response arrived and to transfer the body (including the wait for the response).
+	"""
+	key = pool.key_for(url)
+	end = start + sum(sizes) - 1
+
+	for attempt in range(2):
+		con_start = time.time()
+		if (connection := pool.checkout(key)) is None:
+			reused = False
+			pool.reserve(key, timeout=0)
+			try:
+				connection = await open_stream(url, timeouts.connect)
+			except BaseException:
+				pool.discard(key, None)
+				raise
+		else:
+			reused = True
+
+		reader, writer = connection
+		response_started = False
+		try:
+			writer.write((
+				f"GET {url.path or '/'} HTTP/1.1\r\n"
+				f"Host: {url.netloc}\r\n"
+				f"User-Agent: pTorrent\r\n"
+				f"Range: bytes={start}-{end}\r\n"
+				f"\r\n"
+			).encode('UTF-8'))
+			await writer.drain()
+			con_end = time.time()
+
+			async def read_headers() -> typing.Tuple[int, typing.Dict[str, str]]:
+				nonlocal response_started
+
+				status_line = await reader.readline()
+				if not status_line:
+					raise ConnectionResetError(f"Connection to {key} was closed before a response was received.")
+				response_started = True
+
+				try:
+					status = int(status_line.split(b' ', 2)[1])
+				except (IndexError, ValueError):
+					raise HTTPError(f"Malformed status line: {status_line!r}")
+
+				headers = {}
+				while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+					header, _, value = line.decode('latin-1').partition(':')
+					headers[header.strip().lower()] = value.strip()
+
+				return status, headers
+
+			status, headers = await asyncio.wait_for(read_headers(), timeouts.first_byte)
+			first_byte_time = time.time() - con_end
+			deadline = time.time() + timeouts.transfer
+
+			if status != 206:
+				raise HTTPError(f"Wrong HTTP status code: {status}.")
+
+			if 'content-length' not in headers:
+				raise HTTPError(f"Server did not send a Content-Length, chunked ranges are not supported.")
+
+			if int(headers['content-length']) != end - start + 1:
+				raise HTTPError(f"Asked for {end - start + 1} bytes but the server is sending {headers['content-length']}.")
+
+			for part_index, size in enumerate(sizes):
+				if shaper and shaper.limited:
+					data, deadline = await read_part(reader, size, deadline, shaper)
+					on_part(part_index, data)
+				else:
+					on_part(part_index, await asyncio.wait_for(reader.readexactly(size), max(deadline - time.time(), 0)))
+		except BaseException as error:
+			pool.discard(key, connection)
+
+			# A kept-alive connection the server closed after we checked it,
+			# nothing was received so the request can safely be retried on a new connection.
+			if reused and not attempt and not response_started and isinstance(error, (ConnectionError, asyncio.IncompleteReadError)):
+				continue
+			raise
+
+		if headers.get('connection', '').lower() != 'close':
+			pool.checkin(key, connection)
+		else:
+			pool.discard(key, connection)
+
+		ended = time.time()
+		if tracing.enabled():
+			# Requests overlap on the event loop's thread, so each one gets a track of its own
+			identifier = f"{url.netloc}{url.path} {start}-{end}"
+			for name, phase_started, phase_ended in (('connect', con_start, con_end), ('first byte', con_end, con_end + first_byte_time), ('transfer', con_end + first_byte_time, ended)):
+				tracing.begin(name, identifier, 'request', at=phase_started, reused=reused)
+				tracing.end(name, identifier, 'request', at=phase_ended)
+
+		return con_end - con_start, first_byte_time, ended - con_end
+
+class AsyncEngine:
+	"""
+	Downloads pieces as asyncio tasks on an event loop running in a background thread.
+	Any number of pieces can be submitted. How many requests run at the same time
+	is decided by an AIMDController() (at most max_connections), and the scoreboard
+	decides how many of them may run against the same seed.
+	Adjacent pieces submitted together are fetched with a single request
+	of at most max_request_bytes, see plan_requests(). With a block_size, pieces larger
+	than that are instead split into blocks fetched from different seeds at the same
+	time, and only the blocks that fail are fetched again. Hedged pieces (see Endgame())
+	always get a request of their own, preferably against a seed that isn't already
+	working on the piece, and requests whose pieces were all done elsewhere are cancelled.
+	Results are reported on the torrent's chunks queue as PieceResult()s, just like BrokenChunk.download() does.
+	"""
+	name = 'asyncio'
+
+	def __init__(self, max_connections :int = 64, max_per_seed :int = 8, max_request_bytes :int = 8 * 1024 * 1024, block_size :int = 0, block_attempts :int = 3, idle_timeout :float = 30):
+		self.max_connections = max_connections
+		self.max_request_bytes = max_request_bytes
+		self.block_size = block_size
+		self.block_attempts = block_attempts
+		self.max_per_seed = max_per_seed
+		self.pool = StreamConnectionPool(max_per_host=max_per_seed, idle_timeout=idle_timeout)
+
+		self._tasks = set()
+		# Which tasks are fetching a piece, which pieces a task still has to deliver,
+		# and which seeds are working on a piece. Keyed by (torrent uuid, piece index).
+		self._piece_tasks :typing.Dict[typing.Tuple[typing.Any, int], typing.Set[asyncio.Task]] = {}
+		self._task_pieces :typing.Dict[asyncio.Task, typing.Set[typing.Tuple[typing.Any, int]]] = {}
+		self._piece_seeds :typing.Dict[typing.Tuple[typing.Any, int], typing.List[str]] = {}
+
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._loop.run_forever, name='ptorrent-asyncio', daemon=True)
+		self._thread.start()
+
+		self.controller = AIMDController(maximum=max_connections)
+		self._running = 0
+		self._slot_released = asyncio.run_coroutine_threadsafe(self._create_condition(), self._loop).result()
+		self._seed_released = asyncio.run_coroutine_threadsafe(self._create_condition(), self._loop).result()
+		self._evictor = asyncio.run_coroutine_threadsafe(self._evict_idle_connections(), self._loop)
+
+	async def _create_condition(self) -> asyncio.Condition:
+		return asyncio.Condition()
+
+	async def _evict_idle_connections(self) -> None:
+		while True:
+			await asyncio.sleep(self.pool.idle_timeout / 2)
+			self.pool.evict_idle()
+
+	def submit(self, chunk :BrokenChunk) -> None:
+		self.submit_many([chunk])
+
+	def submit_many(self, chunks :typing.Iterable[BrokenChunk]) -> None:
+		self._loop.call_soon_threadsafe(self._schedule, list(chunks))
+
+	def hedge(self, chunk :BrokenChunk) -> None:
+		self._loop.call_soon_threadsafe(self._schedule, [chunk], True)
+
+	def cancel(self, torrent_uuid :typing.Any, index :int) -> None:
+		"""
+		The piece is done, any request still fetching it is cancelled unless it has other pieces to deliver.
+		"""
+		self._loop.call_soon_threadsafe(self._cancel, (torrent_uuid, index))
+
+	def _cancel(self, key :typing.Tuple[typing.Any, int]) -> None:
+		for task in self._piece_tasks.pop(key, ()):
+			if (pieces := self._task_pieces.get(task)) is None:
+				continue
+
+			pieces.discard(key)
+			if not pieces:
+				task.cancel()
+
+	def occupancy(self) -> typing.Dict[str, int]:
+		"""
+		Requests running, and those waiting for a connection slot (or for their turn against a seed).
+		"""
+		return {'running' : self._running, 'queued' : max(len(self._tasks) - self._running, 0), 'limit' : self.controller.limit}
+
+	def pieces_per_request(self, piece_length :int) -> int:
+		"""
+		How many adjacent pieces of piece_length bytes a single request can fetch.
+		"""
+		if self.block_size and piece_length > self.block_size:
+			return 1
+		return max(self.max_request_bytes // piece_length, 1)
+
+	def pump(self) -> None:
+		# Tasks are started as soon as they're submitted, nothing to do here.
+		pass
+
+	def on_result(self, result :PieceResult) -> None:
+		if result.ok:
+			grown = self.controller.completed(result.size)
+		else:
+			self.controller.failed()
+			grown = False
+
+		if grown:
+			self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self._wake_waiting()))
+
+	async def _wake_waiting(self) -> None:
+		async with self._slot_released:
+			self._slot_released.notify_all()
+
+	async def _acquire_slot(self) -> None:
+		async with self._slot_released:
+			while self._running >= self.controller.limit:
+				await self._slot_released.wait()
+			self._running += 1
+
+	async def _release_slot(self) -> None:
+		async with self._slot_released:
+			self._running -= 1
+			self._slot_released.notify_all()
+
+	def close(self, grace :float = 0.0) -> None:
+		# Requests live in this process, there's nothing that could finish by itself given grace seconds
+		if self._loop.is_closed():
+			return None
+
+		asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
+		self._loop.close()
+
+	async def _shutdown(self) -> None:
+		self._evictor.cancel()
+		for task in list(self._tasks):
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self.pool.close()
+
+	def _schedule(self, chunks :typing.List[BrokenChunk], hedge :bool = False) -> None:
+		if hedge:
+			requests = [RangeRequest(chunks=[chunk]) for chunk in chunks]
+		elif self.block_size:
+			# Pieces that are split into blocks are never merged with their neighbours.
+			requests = plan_requests([chunk for chunk in chunks if chunk.torrent.info.piece_size(chunk.index) <= self.block_size], self.max_request_bytes)
+			requests += [RangeRequest(chunks=[chunk]) for chunk in chunks if chunk.torrent.info.piece_size(chunk.index) > self.block_size]
+		else:
+			requests = plan_requests(chunks, self.max_request_bytes)
+
+		for request in requests:
+			keys = {(chunk.torrent.uuid, chunk.index) for chunk in request.chunks}
+			exclude = None
+			if hedge:
+				exclude = {target for key in keys for target in self._piece_seeds.get(key, ())}
+
+			if self.block_size and request.torrent.info.piece_size(request.chunks[0].index) > self.block_size:
+				task = self._loop.create_task(self._download_blocks(request.chunks[0], exclude))
+			else:
+				task = self._loop.create_task(self._download(request, exclude))
+			self._tasks.add(task)
+			self._task_pieces[task] = keys
+			for key in keys:
+				self._piece_tasks.setdefault(key, set()).add(task)
+			task.add_done_callback(self._forget_task)
+
+	def _forget_task(self, task :asyncio.Task) -> None:
+		self._tasks.discard(task)
+		for key in self._task_pieces.pop(task, ()):
+			if (tasks := self._piece_tasks.get(key)) is not None:
+				tasks.discard(task)
+				if not tasks:
+					del self._piece_tasks[key]
+
+	async def _acquire_peer(self, scoreboard :Scoreboard, exclude :typing.Optional[typing.Set[str]] = None, strict :bool = True) -> Peer:
+		# The scoreboard stops handing out a seed once it has max_per_seed requests running.
+		# There's no point in excluding the only seed there is. Without strict,
+		# excluded seeds are only avoided as long as there's another one available.
+		if exclude and len(exclude) >= len(scoreboard):
+			exclude = None
+
+		async with self._seed_released:
+			while (target := scoreboard.pick(exclude)) is None and (strict or not exclude or (target := scoreboard.pick()) is None):
+				await self._seed_released.wait()
+
+		return Peer(target=target)
+
+	async def _release_peer(self) -> None:
+		async with self._seed_released:
+			self._seed_released.notify_all()
+
+	def _report(self, chunk :BrokenChunk, data :typing.Optional[bytes], actual_hash :typing.Optional[bytes], transfer_time :float = 0.0) -> None:
+		# The coordinator lives in this process, so the data is handed over
+		# as is and written to the target by the coordinator.
+		if data is None:
+			status = RESULT_FAILED
+		elif actual_hash == chunk.expected_hash:
+			status = RESULT_OK
+		else:
+			status = RESULT_CORRUPT
+
+		if (entry := storage['torrents'].get(chunk.torrent.uuid)) is None:
+			# The torrent was removed (see ptorrent.daemon) while this was on its way
+			return None
+
+		entry['chunks'].put(
+			PieceResult(
+				torrent_uuid=chunk.torrent.uuid,
+				index=chunk.index,
+				status=status,
+				actual_hash=actual_hash,
+				size=len(data) if data is not None else 0,
+				transfer_time=transfer_time,
+				data=data if status == RESULT_OK else None
+			)
+		)
+
+	async def _download(self, request :RangeRequest, exclude :typing.Optional[typing.Set[str]] = None) -> None:
+		torrent = request.torrent
+		info = torrent.info
+		scoreboard = storage['torrents'][torrent.uuid]['peers']
+		reported = set()
+		corrupt = 0
+
+		# One GET per file the range touches (just the one for single-file torrents),
+		# each split into parts at the piece boundaries so a part never belongs to two pieces.
+		file_requests = []
+		for span in info.file_index.spans(request.start, request.end - request.start + 1):
+			position, end, sizes = request.start + span.range_offset, request.start + span.range_offset + span.length, []
+			while position < end:
+				sizes.append(min((position // info.piece_length + 1) * info.piece_length, end) - position)
+				position += sizes[-1]
+			file_requests.append((span, sizes))
+
+		pending = []
+		pending_size = 0
+		last_piece_at = 0.0
+
+		def on_part(part_index :int, data :bytes) -> None:
+			nonlocal corrupt, pending_size, last_piece_at
+
+			pending.append(data)
+			pending_size += len(data)
+
+			piece_position = len(reported)
+			if pending_size < request.sizes[piece_position]:
+				return None
+
+			# Every piece is verified and handed over as soon as its last byte arrived,
+			# without waiting for the rest of the range.
+			data = pending[0] if len(pending) == 1 else b''.join(pending)
+			pending.clear()
+			pending_size = 0
+
+			reported.add(piece_position)
+			with tracing.span('hash', piece=request.chunks[piece_position].index):
+				actual_hash = hashlib.sha1(data).digest()
+			if actual_hash != request.chunks[piece_position].expected_hash:
+				corrupt += 1
+
+			now = time.time()
+			self._report(request.chunks[piece_position], data, actual_hash, transfer_time=now - last_piece_at)
+			last_piece_at = now
+
+		waiting_since = time.time()
+		await self._acquire_slot()
+		try:
+			peer = await self._acquire_peer(scoreboard, exclude)
+			if tracing.enabled():
+				identifier = f"{request.chunks[0].index}-{request.chunks[-1].index}"
+				tracing.begin('wait for slot and seed', identifier, 'request', at=waiting_since, seed=peer.target)
+				tracing.end('wait for slot and seed', identifier, 'request')
+			peer_scored = False
+			cancelled = False
+
+			keys = [(chunk.torrent.uuid, chunk.index) for chunk in request.chunks]
+			for key in keys:
+				self._piece_seeds.setdefault(key, []).append(peer.target)
+
+			try:
+				last_piece_at = time.time()
+				connect_time, first_byte_time, transfer_time = 0.0, 0.0, 0.0
+				for span, sizes in file_requests:
+					span_connect_time, span_first_byte_time, span_transfer_time = await fetch_range(
+						self.pool,
+						peer.url_for(info.name, info.file_index[span.file_index].path),
+						span.offset,
+						sizes,
+						on_part,
+						scoreboard.timeouts(peer.target, span.length),
+						shaper=rate_limits().shaper(torrent.uuid, seed_host(peer.target))
+					)
+					connect_time += span_connect_time
+					first_byte_time = max(first_byte_time, span_first_byte_time)
+					transfer_time += span_transfer_time
+
+				# Corrupt data counts against the seed just like an error does.
+				if corrupt == 0:
+					scoreboard.report(peer.target, request.end - request.start + 1, connect_time, transfer_time, first_byte_time)
+					metrics.observe_request(peer.target, request.end - request.start + 1, connect_time, first_byte_time, max(transfer_time - first_byte_time, 0.0))
+					peer_scored = True
+
+				if storage['arguments'].debug:
+					log(f"{request.chunks[0].index}-{request.chunks[-1].index}: Connecting took {connect_time}, the response took {first_byte_time}, download took {transfer_time} ({self.pool.stats()})", level=logging.INFO, fg="teal")
+			except asyncio.CancelledError:
+				# Another copy of the pieces won (or we're shutting down), that's not the seed's fault.
+				cancelled = True
+				raise
+			except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, PoolExhausted, ValueError) as error:
+				if storage['arguments'].debug:
+					log(f"{request.chunks[0].index}-{request.chunks[-1].index} ******> {error}", level=logging.ERROR, fg="red")
+			finally:
+				for key in keys:
+					self._piece_seeds[key].remove(peer.target)
+					if not self._piece_seeds[key]:
+						del self._piece_seeds[key]
+
+				if cancelled:
+					scoreboard.release(peer.target)
+				elif not peer_scored:
+					scoreboard.report_error(peer.target)
+					metrics.observe_request(peer.target, 0, 0.0, 0.0, 0.0, ok=False)
+				await self._release_peer()
+		finally:
+			await self._release_slot()
+
+		for part_index, chunk in enumerate(request.chunks):
+			if part_index not in reported:
+				self._report(chunk, None, None)
+
+	async def _download_blocks(self, chunk :BrokenChunk, exclude :typing.Optional[typing.Set[str]] = None) -> None:
+		info = chunk.torrent.info
+		size = info.piece_size(chunk.index)
+		buffer = bytearray(size)
+
+		started = time.time()
+		fetched = await asyncio.gather(*(
+			self._fetch_block(chunk, buffer, start, min(self.block_size, size - start), exclude)
+			for start in range(0, size, self.block_size)
+		))
+
+		if all(fetched):
+			with tracing.span('hash', piece=chunk.index):
+				actual_hash = hashlib.sha1(buffer).digest()
+			self._report(chunk, buffer, actual_hash, transfer_time=time.time() - started)
+		else:
+			self._report(chunk, None, None)
+
+	async def _fetch_block(self, chunk :BrokenChunk, buffer :bytearray, start :int, length :int, exclude :typing.Optional[typing.Set[str]] = None) -> bool:
+		"""
+		Fetches length bytes at start of the piece into buffer from whichever seed is best.
+		The scoreboard counts the requests running against each seed, so the blocks of a piece
+		spread out over the seeds by themselves. Only this block is retried if its seed fails,
+		preferably from another seed, up to block_attempts times.
+		"""
+		info = chunk.torrent.info
+		key = (chunk.torrent.uuid, chunk.index)
+		scoreboard = storage['torrents'][chunk.torrent.uuid]['peers']
+		exclude = set(exclude or ())
+
+		for attempt in range(self.block_attempts):
+			waiting_since = time.time()
+			await self._acquire_slot()
+			try:
+				peer = await self._acquire_peer(scoreboard, exclude, strict=False)
+				if tracing.enabled():
+					identifier = f"{chunk.index}+{start}"
+					tracing.begin('wait for slot and seed', identifier, 'request', at=waiting_since, seed=peer.target, attempt=attempt)
+					tracing.end('wait for slot and seed', identifier, 'request')
+				peer_scored = False
+				cancelled = False
+
+				self._piece_seeds.setdefault(key, []).append(peer.target)
+				try:
+					connect_time, first_byte_time, transfer_time = 0.0, 0.0, 0.0
+					for span in info.file_index.spans(chunk.index * info.piece_length + start, length):
+						def on_part(part_index :int, data :bytes, offset :int = start + span.range_offset) -> None:
+							buffer[offset:offset + len(data)] = data
+
+						span_connect_time, span_first_byte_time, span_transfer_time = await fetch_range(
+							self.pool,
+							peer.url_for(info.name, info.file_index[span.file_index].path),
+							span.offset,
+							[span.length],
+							on_part,
+							scoreboard.timeouts(peer.target, span.length),
+							shaper=rate_limits().shaper(chunk.torrent.uuid, seed_host(peer.target))
+						)
+						connect_time += span_connect_time
+						first_byte_time = max(first_byte_time, span_first_byte_time)
+						transfer_time += span_transfer_time
+
+					# Every block is a measurement of its own, the piece hash is checked once all of them are in.
+					scoreboard.report(peer.target, length, connect_time, transfer_time, first_byte_time)
+					metrics.observe_request(peer.target, length, connect_time, first_byte_time, max(transfer_time - first_byte_time, 0.0))
+					peer_scored = True
+					return True
+				except asyncio.CancelledError:
+					cancelled = True
+					raise
+				except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, PoolExhausted, ValueError) as error:
+					if storage['arguments'].debug:
+						log(f"{chunk.index}+{start}: block attempt {attempt + 1}/{self.block_attempts} ******> {error}", level=logging.ERROR, fg="red")
+				finally:
+					self._piece_seeds[key].remove(peer.target)
+					if not self._piece_seeds[key]:
+						del self._piece_seeds[key]
+
+					if cancelled:
+						scoreboard.release(peer.target)
+					elif not peer_scored:
+						scoreboard.report_error(peer.target)
+						metrics.observe_request(peer.target, 0, 0.0, 0.0, 0.0, ok=False)
+						exclude.add(peer.target)
+					await self._release_peer()
+			finally:
+				await self._release_slot()
+
+		return False
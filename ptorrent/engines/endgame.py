@@ -0,0 +1,73 @@
+import time
+import typing
+from dataclasses import dataclass, field
+
+if typing.TYPE_CHECKING:
+	from ..models import Progress
+
+@dataclass
+class Endgame:
+	"""
+	Decides which outstanding pieces are requested a second time at the end of a download.
+
+	It kicks in once at most threshold pieces are outstanding. From then on, a piece that
+	has been out for longer than hedge_factor times what a piece usually takes (at least min_wait)
+	gets another copy requested, up to max_copies at the same time. The first verified copy wins,
+	the others are cancelled by the engine and whatever they still deliver is counted as wasted.
+	"""
+	threshold :int = 16
+	hedge_factor :float = 2.0
+	min_wait :float = 0.5
+	max_copies :int = 2
+	active :bool = False
+	hedged :int = 0 # Duplicate requests issued in total
+	_copies :typing.Dict[int, int] = field(default_factory=dict)
+
+	def candidates(self, progress :'Progress', now :typing.Optional[float] = None) -> typing.List[int]:
+		"""
+		The outstanding pieces that should be requested once more right now, slowest first.
+		"""
+		if self.threshold <= 0 or progress.requested == 0:
+			return []
+
+		if not self.active:
+			if progress.requested > self.threshold:
+				return []
+			self.active = True
+
+		now = now or time.time()
+		wait = max(self.min_wait, progress.piece_latency * self.hedge_factor)
+
+		# Only at most threshold pieces are outstanding here, so this never walks the whole torrent.
+		overdue = [
+			(requested_at, index) for index, requested_at in progress.requested_at.items()
+			if now - requested_at >= wait * self._copies.get(index, 1) and self._copies.get(index, 1) < self.max_copies
+		]
+
+		return [index for requested_at, index in sorted(overdue)]
+
+	def may_hedge(self, index :int) -> bool:
+		return self._copies.get(index, 1) < self.max_copies
+
+	def hedging(self, index :int) -> None:
+		self._copies[index] = self._copies.get(index, 1) + 1
+		self.hedged += 1
+
+	def copy_failed(self, index :int) -> bool:
+		"""
+		Returns True if another copy of the piece is still running,
+		in which case there's no need to retry it just yet.
+		"""
+		if (copies := self._copies.get(index, 1)) > 1:
+			self._copies[index] = copies - 1
+			return True
+		return False
+
+	def completed(self, index :int) -> bool:
+		"""
+		Returns True if there were other copies of the piece that should now be cancelled.
+		"""
+		return self._copies.pop(index, 1) > 1
+
+	def describe(self) -> str:
+		return f"endgame, {self.hedged} duplicate request(s)" if self.active else "not in endgame"
@@ -0,0 +1,223 @@
+import time
+import typing
+from dataclasses import dataclass, field
+from ..models.progress import PIECE_MISSING, PIECE_REQUESTED, PIECE_DONE
+
+if typing.TYPE_CHECKING:
+	from ..models import Progress
+
+# Pieces never go from requested or done back to missing (failed pieces stay requested
+# and are retried), so the pickers can keep cursors that only ever move forward.
+# Walking the torrent's pieces therefore costs O(n) in total over the whole download.
+
+@dataclass
+class SequentialPicker:
+	"""
+	Picks the missing pieces in index order, only those in [start, end) if given.
+	"""
+	start :int = 0
+	end :typing.Optional[int] = None
+	_cursor :int = 0
+
+	def __post_init__(self):
+		self._cursor = self.start
+
+	def exhausted(self, progress :'Progress') -> bool:
+		return self._cursor >= (progress.piece_count if self.end is None else min(self.end, progress.piece_count))
+
+	def wanted(self, index :int) -> bool:
+		return self.start <= index and (self.end is None or index < self.end)
+
+	def pick(self, progress :'Progress', count :int, now :typing.Optional[float] = None) -> typing.List[int]:
+		"""
+		Marks up to count of the highest priority missing pieces as requested, and returns them.
+		"""
+		now = now or time.time()
+		end = progress.piece_count if self.end is None else min(self.end, progress.piece_count)
+
+		picked = []
+		index = self._cursor
+		while index < end and len(picked) < count:
+			if progress.states[index] == PIECE_MISSING:
+				progress.mark_requested(index, now)
+				picked.append(index)
+			index += 1
+
+		self._cursor = index
+		return picked
+
+	def overdue(self, progress :'Progress', now :typing.Optional[float] = None) -> typing.List[int]:
+		"""
+		Outstanding pieces that are needed sooner than they arrive, and should be requested once more.
+		"""
+		return []
+
+	def describe(self) -> str:
+		return "sequential"
+
+@dataclass
+class PriorityPicker:
+	"""
+	Picks the pieces of byte ranges with a higher level first, and in index order within a level.
+	ranges are (start, end, level) with end exclusive, later ranges take precedence over earlier ones
+	where they overlap, and bytes not in any range get default. Level 0 means the range isn't downloaded at all,
+	but only pieces entirely within it are left out so the bytes around it stay complete.
+	"""
+	piece_length :int
+	length :int
+	ranges :typing.List[typing.Tuple[int, int, int]] = field(default_factory=list)
+	default :int = 1
+	_levels :bytearray = field(default_factory=bytearray)
+	_segments :typing.List[typing.Tuple[int, SequentialPicker]] = field(default_factory=list)
+
+	def __post_init__(self):
+		piece_count = -(-self.length // self.piece_length)
+		levels = bytearray([self.default]) * piece_count
+
+		for start, end, level in self.ranges:
+			if not 0 <= level <= 255:
+				raise ValueError(f"Priority levels go from 0 to 255, got {level}")
+
+			end = min(end, self.length)
+			if start >= end:
+				continue
+
+			if level == 0:
+				first, last = -(-start // self.piece_length), piece_count if end == self.length else end // self.piece_length
+			else:
+				first, last = start // self.piece_length, -(-end // self.piece_length)
+
+			if first < last:
+				levels[first:last] = bytes([level]) * (last - first)
+
+		# Runs of pieces with the same level, the highest levels first
+		segments = []
+		index = 0
+		while index < piece_count:
+			level = levels[index]
+			run_end = index + 1
+			while run_end < piece_count and levels[run_end] == level:
+				run_end += 1
+
+			if level:
+				segments.append((level, SequentialPicker(start=index, end=run_end)))
+			index = run_end
+
+		self._levels = levels
+		self._segments = sorted(segments, key=lambda segment: (-segment[0], segment[1].start))
+
+	def exhausted(self, progress :'Progress') -> bool:
+		return all(segment.exhausted(progress) for level, segment in self._segments)
+
+	def wanted(self, index :int) -> bool:
+		return self._levels[index] != 0
+
+	def pick(self, progress :'Progress', count :int, now :typing.Optional[float] = None) -> typing.List[int]:
+		now = now or time.time()
+		picked = []
+		for level, segment in self._segments:
+			if len(picked) >= count:
+				break
+			if not segment.exhausted(progress):
+				picked += segment.pick(progress, count - len(picked), now)
+
+		return picked
+
+	def overdue(self, progress :'Progress', now :typing.Optional[float] = None) -> typing.List[int]:
+		return []
+
+	def describe(self) -> str:
+		return f"priorities ({len(self._segments)} range(s) to download)"
+
+@dataclass
+class WindowPicker:
+	"""
+	For consuming the torrent while it downloads: the window of size pieces from the first piece
+	that isn't done yet (where a sequential reader is waiting) is always picked first, and the
+	remaining slots are filled by the fallback picker.
+	Pieces the fallback doesn't want (see PriorityPicker, level 0) are skipped, also by the window.
+	With a rate (bytes/s the reader consumes), every piece in the window gets a deadline: the reader
+	reaches it (index - head + 1) pieces' worth of time after it got to the head. Outstanding pieces
+	past their deadline that have taken longer than a piece usually does are overdue, and get hedged.
+	"""
+	piece_length :int
+	size :int = 16
+	rate :float = 0.0
+	fallback :typing.Any = field(default_factory=SequentialPicker)
+	_head :int = 0
+	_head_since :float = field(default_factory=time.time)
+	_cursor :int = 0
+
+	def _advance(self, progress :'Progress', now :float) -> None:
+		head = self._head
+		# A reader that skips pieces nobody wants doesn't wait for them either
+		while head < progress.piece_count and (progress.states[head] == PIECE_DONE or not self.fallback.wanted(head)):
+			head += 1
+
+		if head != self._head:
+			self._head, self._head_since = head, now
+			self._cursor = max(self._cursor, head)
+
+	@property
+	def window(self) -> typing.Tuple[int, int]:
+		return self._head, self._head + self.size
+
+	def exhausted(self, progress :'Progress') -> bool:
+		return self._cursor >= min(self._head + self.size, progress.piece_count) and self.fallback.exhausted(progress)
+
+	def wanted(self, index :int) -> bool:
+		return self.fallback.wanted(index)
+
+	def deadline(self, index :int) -> typing.Optional[float]:
+		if self.rate <= 0 or not self._head <= index < self._head + self.size:
+			return None
+		return self._head_since + (index - self._head + 1) * self.piece_length / self.rate
+
+	def pick(self, progress :'Progress', count :int, now :typing.Optional[float] = None) -> typing.List[int]:
+		now = now or time.time()
+		self._advance(progress, now)
+
+		picked = []
+		end = min(self._head + self.size, progress.piece_count)
+		while self._cursor < end and len(picked) < count:
+			if progress.states[self._cursor] == PIECE_MISSING and self.fallback.wanted(self._cursor):
+				progress.mark_requested(self._cursor, now)
+				picked.append(self._cursor)
+			self._cursor += 1
+
+		if len(picked) < count:
+			picked += self.fallback.pick(progress, count - len(picked), now)
+
+		return picked
+
+	def overdue(self, progress :'Progress', now :typing.Optional[float] = None) -> typing.List[int]:
+		now = now or time.time()
+		self._advance(progress, now)
+		if self.rate <= 0:
+			return []
+
+		return [
+			index for index in range(self._head, min(self._head + self.size, progress.piece_count))
+			if progress.states[index] == PIECE_REQUESTED
+				and now > self.deadline(index)
+				and now - progress.requested_at.get(index, now) >= progress.piece_latency
+		]
+
+	def describe(self) -> str:
+		return f"streaming window {self._head}-{self._head + self.size}, then {self.fallback.describe()}"
+
+PICKERS = ('sequential', 'window')
+
+def create_picker(name :str, piece_length :int, length :int, priorities :typing.Optional[typing.List[typing.Tuple[int, int, int]]] = None, window :int = 16, rate :float = 0.0):
+	"""
+	Pieces outside the streaming window (or all of them with the sequential picker)
+	are picked by priority if any priorities are given, in index order otherwise.
+	"""
+	if name not in PICKERS:
+		raise ValueError(f"Unknown piece picker {name}, expected one of: {', '.join(PICKERS)}")
+
+	picker = PriorityPicker(piece_length=piece_length, length=length, ranges=priorities) if priorities else SequentialPicker()
+	if name == 'window':
+		picker = WindowPicker(piece_length=piece_length, size=window, rate=rate, fallback=picker)
+
+	return picker
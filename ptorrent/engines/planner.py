@@ -0,0 +1,56 @@
+import typing
+from dataclasses import dataclass
+
+if typing.TYPE_CHECKING:
+	from ..models import BrokenChunk
+
+@dataclass
+class RangeRequest:
+	"""
+	One ranged GET covering a run of adjacent pieces of the same torrent.
+	"""
+	chunks :typing.List['BrokenChunk']
+
+	@property
+	def torrent(self):
+		return self.chunks[0].torrent
+
+	@property
+	def start(self) -> int:
+		return self.chunks[0].index * self.torrent.info.piece_length
+
+	@property
+	def end(self) -> int:
+		# Inclusive, as used in the Range header
+		return self.start + sum(self.sizes) - 1
+
+	@property
+	def sizes(self) -> typing.List[int]:
+		return [self.torrent.info.piece_size(chunk.index) for chunk in self.chunks]
+
+def plan_requests(chunks :typing.Iterable['BrokenChunk'], max_bytes :int) -> typing.List[RangeRequest]:
+	"""
+	Merges runs of adjacent pieces into RangeRequest()'s of at most max_bytes each.
+	A piece larger than max_bytes still gets a request of its own.
+	"""
+	requests = []
+	current = None
+	current_bytes = 0
+
+	for chunk in sorted(chunks, key=lambda chunk_obj: (str(chunk_obj.torrent.uuid), chunk_obj.index)):
+		size = chunk.torrent.info.piece_size(chunk.index)
+
+		if current is not None \
+			and current.torrent.uuid == chunk.torrent.uuid \
+			and current.chunks[-1].index + 1 == chunk.index \
+			and current_bytes + size <= max_bytes:
+
+			current.chunks.append(chunk)
+			current_bytes += size
+			continue
+
+		current = RangeRequest(chunks=[chunk])
+		current_bytes = size
+		requests.append(current)
+
+	return requests
@@ -0,0 +1,122 @@
+import time
+import typing
+import collections
+import multiprocessing
+from ..threading import (
+	AIMDController,
+	max_threads
+)
+from ..storage import storage
+from .. import metrics
+from .. import tracing
+
+if typing.TYPE_CHECKING:
+	from ..models import PieceResult
+
+class ProcessEngine:
+	"""
+	Downloads every piece in a multiprocessing.Process of its own.
+	How many of them run at the same time is decided by an AIMDController(),
+	never more than max_connections (or max_threads(), if that's lower).
+	The engine holds on to its workers only until they have exited, nothing else keeps
+	them around, so a long download doesn't pile up a handle for every piece it ever fetched.
+	A worker's slot is free as soon as its result arrives, it doesn't have to have exited yet.
+	Hedged pieces (see Endgame()) jump the queue, and avoid the seeds already busy with them. Workers can't be cancelled once running,
+	killing one could leave a half written message in the results queue, so only
+	copies that haven't started yet are dropped when a piece is done elsewhere.
+	"""
+	name = 'process'
+
+	def __init__(self, max_connections :int = 64):
+		self.controller = AIMDController(maximum=min(max_threads(), max_connections))
+		self._waiting :typing.Deque[typing.Tuple[typing.Tuple[typing.Any, int], multiprocessing.Process]] = collections.deque()
+		self._running :typing.List[typing.Tuple[typing.Tuple[typing.Any, int], multiprocessing.Process]] = []
+		# Workers that reported their result and are on their way out
+		self._exiting :typing.List[multiprocessing.Process] = []
+
+	def submit(self, chunk :'BrokenChunk') -> None:
+		self._waiting.append(((chunk.torrent.uuid, chunk.index), multiprocessing.Process(target=chunk.download)))
+
+	def hedge(self, chunk :'BrokenChunk') -> None:
+		# Send the copy to another seed than the one(s) already busy with the piece
+		chunk.exclude = set(storage['torrents'][chunk.torrent.uuid]['peers'].seeds_of(chunk.index))
+		self._waiting.appendleft(((chunk.torrent.uuid, chunk.index), multiprocessing.Process(target=chunk.download)))
+
+	def cancel(self, torrent_uuid :typing.Any, index :int) -> None:
+		self._waiting = collections.deque(
+			(key, process) for key, process in self._waiting if key != (torrent_uuid, index)
+		)
+
+	def submit_many(self, chunks :typing.Iterable['BrokenChunk']) -> None:
+		for chunk in chunks:
+			self.submit(chunk)
+
+	def pieces_per_request(self, piece_length :int) -> int:
+		return 1
+
+	def pump(self) -> None:
+		running = []
+		for key, process in self._running:
+			if process.is_alive():
+				running.append((key, process))
+			else:
+				process.join()
+				process.close()
+		self._running = running
+
+		exiting = []
+		for process in self._exiting:
+			if process.is_alive():
+				exiting.append(process)
+			else:
+				process.join()
+				process.close()
+		self._exiting = exiting
+
+		while self._waiting and len(self._running) < self.controller.limit:
+			key, process = self._waiting.popleft()
+			with tracing.span('spawn', piece=key[1]):
+				process.start()
+			self._running.append((key, process))
+
+	def occupancy(self) -> typing.Dict[str, int]:
+		return {'running' : len(self._running), 'queued' : len(self._waiting), 'limit' : self.controller.limit}
+
+	def on_result(self, result :'PieceResult') -> None:
+		# The worker is done once it has reported, so the next one can start
+		# right away instead of once this one is found to have exited.
+		for position, (key, process) in enumerate(self._running):
+			if key == (result.torrent_uuid, result.index):
+				self._exiting.append(process)
+				del self._running[position]
+				break
+
+		# Every worker fetched its piece with requests of its own
+		metrics.observe_request(result.seed, result.size, result.connect_time, result.first_byte_time, max(result.transfer_time - result.first_byte_time, 0.0), ok=result.ok)
+
+		if result.ok:
+			self.controller.completed(result.size)
+		else:
+			self.controller.failed()
+
+	def close(self, grace :float = 0.0) -> None:
+		"""
+		Kills the workers, giving those still running up to grace seconds to finish by themselves first.
+		"""
+		deadline = time.time() + grace
+		processes = [process for key, process in self._running] + self._exiting
+		for process in processes:
+			process.join(max(deadline - time.time(), 0))
+
+		for process in processes:
+			try:
+				process.kill()
+				process.join()
+				process.close()
+			except ValueError:
+				# Already closed
+				pass
+
+		self._waiting.clear()
+		self._running = []
+		self._exiting = []
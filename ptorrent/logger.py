@@ -1,31 +1,176 @@
 import logging
 import os
 import sys
+import queue
+import atexit
 import pathlib
-from typing import Dict, Union, List, Any
+import threading
+import functools
+import multiprocessing.util
+from typing import Dict, Union, List, Any, Optional, TextIO
 
 from .storage import storage
 
 class Journald:
-	@staticmethod
-	def log(message :str, level :int = logging.DEBUG) -> None:
-		try:
-			import systemd.journal  # type: ignore
-		except ModuleNotFoundError:
+	"""
+	Sends messages to the systemd journal through a single JournalHandler,
+	set up the first time it's needed (if systemd's python bindings are installed at all).
+	"""
+	_logger :Optional[logging.Logger] = None
+	_available :Optional[bool] = None
+
+	@classmethod
+	def logger(cls) -> Optional[logging.Logger]:
+		if cls._available is None:
+			try:
+				import systemd.journal  # type: ignore
+			except ModuleNotFoundError:
+				cls._available = False
+				return None
+
+			log_adapter = logging.getLogger('ptorrent')
+			log_ch = systemd.journal.JournalHandler()
+			log_ch.setFormatter(logging.Formatter("[%(levelname)s]: %(message)s"))
+			log_adapter.addHandler(log_ch)
+			log_adapter.setLevel(logging.DEBUG)
+			log_adapter.propagate = False
+
+			cls._logger, cls._available = log_adapter, True
+
+		return cls._logger
+
+	@classmethod
+	def log(cls, message :str, level :int = logging.DEBUG) -> None:
+		if (log_adapter := cls.logger()) is not None:
+			log_adapter.log(level, message)
+
+class LogWriter:
+	"""
+	Writes log lines from a background thread, so log() only has to put them on a queue.
+	Whatever is queued by the time the thread gets to it is written as one batch,
+	with a single write and flush to stdout and to the (persistently open) log file.
+	Every process gets a writer of its own, see writer().
+	"""
+	batch_size = 512
+
+	def __init__(self):
+		self.queue :queue.SimpleQueue = queue.SimpleQueue()
+		self._file :Optional[TextIO] = None
+		self._file_path :Optional[pathlib.Path] = None
+		self._thread = threading.Thread(target=self._run, name='ptorrent-log', daemon=True)
+		self._thread.start()
+
+	def write(self, line :str, plain :str, level :int, show :bool) -> None:
+		self.queue.put((line, plain, level, show))
+
+	def flush(self, timeout :float = 5) -> None:
+		"""
+		Blocks until everything logged so far has been written.
+		"""
+		if not self._thread.is_alive():
+			return None
+
+		written = threading.Event()
+		self.queue.put(written)
+		written.wait(timeout)
+
+	def _run(self) -> None:
+		while True:
+			batch = [self.queue.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+
+			try:
+				self._write_batch([item for item in batch if type(item) == tuple])
+			except Exception:
+				# Logging must never take the download down with it
+				pass
+
+			for item in batch:
+				if type(item) == threading.Event:
+					item.set()
+
+	def _write_batch(self, batch :List[tuple]) -> None:
+		if not batch:
+			return None
+
+		if log_file := self._log_file():
+			log_file.write(''.join(f"{plain}\n" for line, plain, level, show in batch))
+			log_file.flush()
+
+		for line, plain, level, show in batch:
+			Journald.log(plain, level=level)
+
+		if shown := ''.join(f"{line}\n" for line, plain, level, show in batch if show):
+			# sys.stdout.write()+flush() instead of print() to try and fix issue #94
+			sys.stdout.write(shown)
+			sys.stdout.flush()
+
+	def _log_file(self) -> Optional[TextIO]:
+		"""
+		The log file defined in storage, opened once and kept open (re-opened if it's changed).
+		"""
+		if not (filename := storage.get('LOG_FILE', None)):
 			return None
 
-		log_adapter = logging.getLogger('slimHTTP3')
-		log_fmt = logging.Formatter("[%(levelname)s]: %(message)s")
-		log_ch = systemd.journal.JournalHandler()
-		log_ch.setFormatter(log_fmt)
-		log_adapter.addHandler(log_ch)
-		log_adapter.setLevel(logging.DEBUG)
+		absolute_logfile = pathlib.Path(storage.get('LOG_PATH', './')) / filename
+		if self._file is not None and self._file_path == absolute_logfile:
+			return self._file
+
+		if self._file is not None:
+			self._file.close()
+
+		try:
+			absolute_logfile.parents[0].mkdir(exist_ok=True, parents=True)
+			self._file = absolute_logfile.open('a')
+		except PermissionError:
+			# Fallback to creating the log file in the current folder
+			fallback = pathlib.Path('./').resolve() / filename
+			sys.stdout.write(f"Not enough permission to place log file at {absolute_logfile}, creating it in {fallback} instead.\n")
+			storage['LOG_PATH'] = './'
+			absolute_logfile = pathlib.Path('./') / filename
+			self._file = fallback.open('a')
+
+		self._file_path = absolute_logfile
+		return self._file
+
+_writer :Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+def _forget_writer() -> None:
+	# Forked worker processes inherit the parent's writer but not its thread.
+	global _writer, _writer_lock
+	_writer, _writer_lock = None, threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_writer)
+
+def writer() -> LogWriter:
+	"""
+	The LogWriter of this process, started the first time something is logged.
+	It's flushed before the process exits.
+	"""
+	global _writer
+	if _writer is not None:
+		return _writer
+
+	with _writer_lock:
+		if _writer is None:
+			_writer = LogWriter()
+			# multiprocessing children skip atexit, but run their finalizers
+			multiprocessing.util.Finalize(None, _writer.flush, exitpriority=0)
+			atexit.register(_writer.flush)
 
-		log_adapter.log(level, message)
+	return _writer
 
+def flush() -> None:
+	writer().flush()
 
 # Found first reference here: https://stackoverflow.com/questions/7445658/how-to-detect-if-the-console-does-support-ansi-escape-codes-in-python
 # And re-used this: https://github.com/django/django/blob/master/django/core/management/color.py#L12
+@functools.lru_cache(maxsize=None)
 def supports_color() -> bool:
 	"""
 	Return True if the running system's terminal supports color,
@@ -87,39 +232,20 @@ def stylize_output(text: str, *opts :str, **kwargs) -> str:
 
 
 def log(*args :str, **kwargs :Union[str, int, Dict[str, Union[str, int]]]) -> None:
+	level = int(str(kwargs.get('level', logging.INFO)))
+
+	# Debug messages are only shown with --debug (or verbose), and nothing is formatted if they're not.
+	# They still go to the log file and journald if those are set up.
+	show = level != logging.DEBUG or bool(getattr(storage.get('arguments'), 'debug', False) or getattr(storage.get('arguments'), 'verbose', False))
+	if not show and not storage.get('LOG_FILE', None) and Journald._available is False:
+		return None
+
 	string = orig_string = ' '.join([str(x) for x in args])
 
 	# Attempt to colorize the output if supported
 	# Insert default colors and override with **kwargs
 	if supports_color():
 		kwargs = {'fg': 'white', **kwargs}
-		string = stylize_output(string, **kwargs)
-
-	# If a logfile is defined in storage,
-	# we use that one to output everything
-	if filename := storage.get('LOG_FILE', None):
-		absolute_logfile = pathlib.Path(storage.get('LOG_PATH', './')) / filename
-
-		try:
-			absolute_logfile.parents[0].mkdir(exist_ok=True, parents=True)
-			with absolute_logfile.open('a') as log_file:
-				log_file.write("")
-		except PermissionError:
-			# Fallback to creating the log file in the current folder
-			err_string = f"Not enough permission to place log file at {absolute_logfile}, creating it in {pathlib.Path('./').resolve() / filename} instead."
-			absolute_logfile = pathlib.Path('./').resolve() / filename
-			absolute_logfile.parents[0].mkdir(exist_ok=True)
-			storage['LOG_PATH'] = './'
-			log(err_string, fg="red")
-
-		with absolute_logfile.open('a') as log_file:
-			log_file.write(f"{orig_string}\n")
-
-	Journald.log(string, level=int(str(kwargs.get('level', logging.INFO))))
+		string = stylize_output(string, **{key: value for key, value in kwargs.items() if key in ('fg', 'bg')})
 
-	# Finally, print the log unless we skipped it based on level.
-	# We use sys.stdout.write()+flush() instead of print() to try and
-	# fix issue #94
-	if kwargs.get('level', logging.INFO) != logging.DEBUG or storage['arguments'].get('verbose', False):
-		sys.stdout.write(f"{string}\n")
-		sys.stdout.flush()
\ No newline at end of file
+	writer().write(string, orig_string, level, show)
@@ -0,0 +1,291 @@
+import os
+import math
+import typing
+import pathlib
+import threading
+import http.server
+
+# Bucket bounds in seconds, for everything from a pooled connection to a stalled transfer
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metric:
+	"""
+	A family of values that share a name, one per combination of label values.
+	"""
+	kind = 'untyped'
+
+	def __init__(self, registry :'Registry', name :str, description :str, labels :typing.Tuple[str, ...] = ()):
+		self.registry = registry
+		self.name = name
+		self.description = description
+		self.labels = tuple(labels)
+		self.values :typing.Dict[typing.Tuple[str, ...], typing.Any] = {}
+
+	def _key(self, labels :typing.Dict[str, typing.Any]) -> typing.Tuple[str, ...]:
+		if len(labels) != len(self.labels):
+			raise ValueError(f"{self.name} takes the labels {', '.join(self.labels) or 'none'}, got {', '.join(labels) or 'none'}")
+		return tuple(str(labels[label]) for label in self.labels)
+
+	def _label_text(self, key :typing.Tuple[str, ...], extra :str = '') -> str:
+		pairs = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, key)]
+		if extra:
+			pairs.append(extra)
+		return '{' + ','.join(pairs) + '}' if pairs else ''
+
+	def prometheus(self) -> typing.List[str]:
+		return [f"{self.name}{self._label_text(key)} {format_value(value)}" for key, value in self.values.items()]
+
+	def snapshot(self) -> typing.Any:
+		if not self.labels:
+			return self.values.get((), 0)
+		return [{**dict(zip(self.labels, key)), 'value' : value} for key, value in self.values.items()]
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def inc(self, amount :float = 1, **labels) -> None:
+		key = self._key(labels)
+		with self.registry.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+	kind = 'gauge'
+
+	def set(self, value :float, **labels) -> None:
+		key = self._key(labels)
+		with self.registry.lock:
+			self.values[key] = value
+
+class Histogram(Metric):
+	"""
+	Counts observations per bucket (cumulative, like Prometheus expects them) together with their sum.
+	"""
+	kind = 'histogram'
+
+	def __init__(self, registry :'Registry', name :str, description :str, labels :typing.Tuple[str, ...] = (), buckets :typing.Tuple[float, ...] = LATENCY_BUCKETS):
+		super().__init__(registry, name, description, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value :float, **labels) -> None:
+		key = self._key(labels)
+		with self.registry.lock:
+			if (counts := self.values.get(key)) is None:
+				counts = self.values[key] = {'buckets' : [0] * len(self.buckets), 'count' : 0, 'sum' : 0.0}
+
+			for position, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts['buckets'][position] += 1
+			counts['count'] += 1
+			counts['sum'] += value
+
+	def prometheus(self) -> typing.List[str]:
+		lines = []
+		for key, counts in self.values.items():
+			for bound, count in zip(self.buckets, counts['buckets']):
+				le = f'le="{format_value(bound)}"'
+				lines.append(f"{self.name}_bucket{self._label_text(key, le)} {count}")
+			le = 'le="+Inf"'
+			lines.append(f"{self.name}_bucket{self._label_text(key, le)} {counts['count']}")
+			lines.append(f"{self.name}_sum{self._label_text(key)} {format_value(counts['sum'])}")
+			lines.append(f"{self.name}_count{self._label_text(key)} {counts['count']}")
+		return lines
+
+	def snapshot(self) -> typing.Any:
+		return [
+			{
+				**dict(zip(self.labels, key)),
+				'buckets' : {format_value(bound) : count for bound, count in zip(self.buckets, counts['buckets'])},
+				'count' : counts['count'],
+				'sum' : counts['sum']
+			}
+			for key, counts in self.values.items()
+		]
+
+def escape(value :str) -> str:
+	return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value :float) -> str:
+	if isinstance(value, float) and math.isinf(value):
+		return '+Inf' if value > 0 else '-Inf'
+	if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+		return str(int(value))
+	return str(value)
+
+class Registry:
+	"""
+	Every metric of the running process by name. Values that are cheaper to look up than
+	to keep updated (queue depths, the scoreboard's rolling throughput) are filled in by
+	collectors right before the metrics are exported.
+	"""
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.metrics :typing.Dict[str, Metric] = {}
+		self.collectors :typing.List[typing.Callable[[], None]] = []
+
+	def _get(self, kind :typing.Type[Metric], name :str, description :str, labels :typing.Tuple[str, ...] = (), **options) -> Metric:
+		with self.lock:
+			if (metric := self.metrics.get(name)) is None:
+				metric = self.metrics[name] = kind(self, name, description, labels, **options)
+			elif type(metric) != kind:
+				raise ValueError(f"{name} is already registered as a {metric.kind}")
+			return metric
+
+	def counter(self, name :str, description :str, labels :typing.Tuple[str, ...] = ()) -> Counter:
+		return self._get(Counter, name, description, labels)
+
+	def gauge(self, name :str, description :str, labels :typing.Tuple[str, ...] = ()) -> Gauge:
+		return self._get(Gauge, name, description, labels)
+
+	def histogram(self, name :str, description :str, labels :typing.Tuple[str, ...] = (), buckets :typing.Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+		return self._get(Histogram, name, description, labels, buckets=buckets)
+
+	def add_collector(self, collector :typing.Callable[[], None]) -> None:
+		with self.lock:
+			self.collectors.append(collector)
+
+	def collect(self) -> None:
+		for collector in list(self.collectors):
+			collector()
+
+	def prometheus(self) -> str:
+		"""
+		The text exposition format, https://prometheus.io/docs/instrumenting/exposition_formats/
+		"""
+		self.collect()
+		lines = []
+		with self.lock:
+			for metric in self.metrics.values():
+				lines.append(f"# HELP {metric.name} {metric.description}")
+				lines.append(f"# TYPE {metric.name} {metric.kind}")
+				lines += metric.prometheus()
+		return '\n'.join(lines) + '\n'
+
+	def snapshot(self) -> typing.Dict[str, typing.Any]:
+		self.collect()
+		with self.lock:
+			return {name : metric.snapshot() for name, metric in self.metrics.items()}
+
+	def write_prometheus(self, path :pathlib.Path) -> None:
+		"""
+		Replaces path atomically, so whoever scrapes it (node_exporter's textfile collector) never sees half a file.
+		"""
+		temporary = path.with_name(f".{path.name}.{os.getpid()}")
+		temporary.write_text(self.prometheus())
+		os.replace(temporary, path)
+
+	def serve(self, port :int, host :str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+		"""
+		Serves the metrics at http://host:port/metrics from a background thread.
+		"""
+		registry = self
+
+		class MetricsHandler(http.server.BaseHTTPRequestHandler):
+			def log_message(self, *args) -> None:
+				pass
+
+			def do_GET(self) -> None:
+				if self.path.split('?')[0] not in ('/', '/metrics'):
+					self.send_response(404)
+					self.send_header('Content-Length', '0')
+					self.end_headers()
+					return None
+
+				body = registry.prometheus().encode('UTF-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+		server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+		server.daemon_threads = True
+		threading.Thread(target=server.serve_forever, name='ptorrent-metrics', daemon=True).start()
+		return server
+
+registry = Registry()
+
+# What the engines measure for every request against a seed
+SEED_BYTES = registry.counter('ptorrent_seed_bytes_total', 'Bytes of the successful requests to each web seed.', ('seed',))
+SEED_REQUESTS = registry.counter('ptorrent_seed_requests_total', 'Requests made to each web seed.', ('seed',))
+SEED_ERRORS = registry.counter('ptorrent_seed_errors_total', 'Requests to each web seed that failed or delivered corrupt data.', ('seed',))
+REQUEST_SECONDS = registry.histogram('ptorrent_request_seconds', 'Seconds a request spent connecting, waiting for the response and transferring the body.', ('phase',))
+
+def observe_request(seed :typing.Optional[str], size :int, connect_time :float, first_byte_time :float, transfer_time :float, ok :bool = True) -> None:
+	"""
+	transfer_time is the time it took to receive the body after the response arrived.
+	"""
+	if seed is None:
+		return None
+
+	SEED_REQUESTS.inc(seed=seed)
+	if not ok:
+		SEED_ERRORS.inc(seed=seed)
+		return None
+
+	SEED_BYTES.inc(size, seed=seed)
+	REQUEST_SECONDS.observe(connect_time, phase='connect')
+	REQUEST_SECONDS.observe(first_byte_time, phase='first_byte')
+	REQUEST_SECONDS.observe(transfer_time, phase='transfer')
+
+# What the coordinator measures
+PIECE_SECONDS = registry.histogram('ptorrent_piece_seconds', 'Seconds from requesting a piece until it was verified and stored.')
+VERIFY_BYTES = registry.counter('ptorrent_verify_bytes_total', 'Bytes of local data hashed on startup.')
+VERIFY_SECONDS = registry.counter('ptorrent_verify_seconds_total', 'Seconds spent hashing local data on startup.')
+
+def track_progress(progress) -> None:
+	"""
+	Exports a Progress() (or anything like it) as gauges whenever the metrics are collected.
+	"""
+	pieces = registry.gauge('ptorrent_pieces', 'Pieces of the torrent by state.', ('state',))
+	downloaded = registry.gauge('ptorrent_downloaded_bytes', 'Bytes downloaded since the start, without what was already on disk.')
+	wasted = registry.gauge('ptorrent_wasted_bytes', 'Bytes of duplicate pieces that were thrown away.')
+	failures = registry.gauge('ptorrent_piece_failures', 'Piece downloads that failed or were corrupt.')
+	rate = registry.gauge('ptorrent_download_rate_bytes', 'Download rate in bytes/s, exponentially weighted.')
+
+	def collect() -> None:
+		pieces.set(progress.done, state='done')
+		pieces.set(progress.requested, state='requested')
+		pieces.set(progress.piece_count - progress.done - progress.requested, state='missing')
+		downloaded.set(progress.downloaded_bytes)
+		wasted.set(progress.wasted_bytes)
+		failures.set(progress.failures)
+		rate.set(progress.rate)
+
+	registry.add_collector(collect)
+
+def track_engine(engine, results) -> None:
+	"""
+	Exports how busy the engine is, and how many results wait for the coordinator.
+	"""
+	requests = registry.gauge('ptorrent_engine_requests', 'Requests (or worker processes) of the engine by state, limit being what the AIMD controller allows.', ('state',))
+	results_queued = registry.gauge('ptorrent_results_queued', 'Results waiting for the coordinator.')
+
+	def collect() -> None:
+		for state, value in engine.occupancy().items():
+			requests.set(value, state=state)
+
+		try:
+			results_queued.set(results.qsize())
+		except NotImplementedError:
+			# multiprocessing.Queue().qsize() isn't available on macOS
+			pass
+
+	registry.add_collector(collect)
+
+def track_scoreboard(scoreboard) -> None:
+	"""
+	Exports the scoreboard's view of every seed, its rolling throughput in particular.
+	"""
+	throughput = registry.gauge('ptorrent_seed_throughput_bytes', 'Rolling throughput of all requests against each web seed in bytes/s.', ('seed',))
+	active = registry.gauge('ptorrent_seed_active_requests', 'Requests running against each web seed.', ('seed',))
+	window = registry.gauge('ptorrent_seed_window', 'How many requests may run against each web seed at the same time.', ('seed',))
+	srtt = registry.gauge('ptorrent_seed_srtt_seconds', 'Smoothed time until each web seed responds.', ('seed',))
+
+	def collect() -> None:
+		for score in scoreboard.scores():
+			throughput.set(score.aggregate, seed=score.target)
+			active.set(score.active, seed=score.target)
+			window.set(score.window, seed=score.target)
+			srtt.set(score.srtt, seed=score.target)
+
+	registry.add_collector(collect)
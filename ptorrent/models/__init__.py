@@ -1,7 +1,13 @@
 from .torrent import Torrent, TorrentInfo
-from .chunk import Chunk, BrokenChunk
+from .chunk import Chunk, BrokenChunk, PieceResult
+from .resume import ResumeState
+from .progress import Progress
+from .files import FileEntry, FileSpan, FileIndex
+from .target import TargetFile, TargetFiles
 from .seeders import (
 	Peer as Peer,
-	Peers as Peers,
-	Priority as Priority
+	SeedScore as SeedScore,
+	Timeouts as Timeouts,
+	Scoreboard as Scoreboard,
+	SeedManager as SeedManager
 )
\ No newline at end of file
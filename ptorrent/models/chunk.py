@@ -2,50 +2,182 @@ import typing
 import hashlib
 import urllib.request
 import urllib.error
+import urllib.parse
 import multiprocessing
 import traceback
 import sys
 import http.client
-import threading
 import time
 import socket
 import ssl
 import logging
 from dataclasses import dataclass
 from .torrent import Torrent
-from .seeders import Priority, Peer
+from .seeders import Peer, Timeouts
+from ..network import http_pool, rate_limits, seed_host
 from ..storage import storage
 from ..logger import log
+from .. import tracing
 
-class Reader(threading.Thread):
-	def __init__(self, func, chunksize):
-		self.func = func
-		self.chunksize = chunksize
-		self.data = None
-		threading.Thread.__init__(self)
-		self._stop_event = threading.Event()
-		self.start()
+# How much is read from the socket at a time, the digest is updated in between.
+READ_BLOCK_SIZE = 64 * 1024
 
-	def kill(self):
-		self._stop_event.set()
+def read_buffer(size :int) -> memoryview:
+	"""
+	Returns a writable buffer of size bytes that is re-used between downloads in this process.
+	"""
+	if len(storage.get('read_buffer', b'')) < size:
+		storage['read_buffer'] = bytearray(size)
 
-	def stopped(self):
-		return self._stop_event.is_set()
+	return memoryview(storage['read_buffer'])[:size]
 
-	def run(self):
-		try:
-			self.data = self.func(self.chunksize)
-		except Exception as error:
-			if storage['arguments'].debug:
-				log(f'Could not read data: {error}', level=logging.ERROR, fg="red")
-			pass
+class IncompleteBody(http.client.IncompleteRead):
+	"""
+	An IncompleteRead that only carries how many bytes arrived, not the bytes themselves,
+	which would be a copy of the partial piece that's thrown away right after.
+	"""
+	def __init__(self, received :int, expected :int):
+		super().__init__(b'', expected)
+		self.received = received
+
+	def __repr__(self) -> str:
+		return f"IncompleteBody({self.received} bytes read, {self.expected} more expected)"
+
+	__str__ = __repr__
+
+def read_into(response :http.client.HTTPResponse, sock :socket.socket, buffer :memoryview, deadline :float, digest :'hashlib._Hash', shaper :typing.Optional[typing.Callable[[int], float]] = None) -> int:
+	"""
+	Reads the response body into buffer until it's full, updating digest as the bytes arrive.
+	The socket timeout is lowered as the deadline approaches, so a stalled read can never outlive it.
+	With a shaper (see RateLimits.shaper()), every block is followed by the wait it asks for.
+	Returns the number of bytes read.
+	"""
+	received = 0
+
+	while received < len(buffer):
+		if (time_left := deadline - time.time()) <= 0:
+			raise TimeoutError(f"Could not read data in timely fashion, got {received} of {len(buffer)} bytes.")
+		sock.settimeout(time_left)
+
+		if (read := response.readinto(buffer[received:received + READ_BLOCK_SIZE])) == 0:
+			raise IncompleteBody(received, len(buffer) - received)
+
+		digest.update(buffer[received:received + read])
+		received += read
+
+		if shaper and (delay := shaper(read)):
+			time.sleep(delay)
+			# Waiting on our own rate limits isn't the seed being slow
+			deadline += delay
+
+	return received
+
+def fetch_into(url :urllib.parse.ParseResult, start :int, buffer :memoryview, digest :'hashlib._Hash', timeouts :Timeouts, shaper :typing.Optional[typing.Callable[[int], float]] = None) -> typing.Tuple[float, float, float]:
+	"""
+	Fetches len(buffer) bytes of url, starting at byte start, into buffer
+	over a pooled keep-alive connection and updates digest with them.
+	Connecting, waiting for the response and transferring the body each have a deadline of their own.
+	Returns the time it took to connect, until the response arrived and to transfer the body (including the wait for the response).
+	"""
+	pool = http_pool()
+	pool_key = pool.key_for(url)
+	handle = None
+	try:
+		con_start = time.time()
+
+		for attempt in range(2):
+			handle, reused = pool.connect(url, timeout=timeouts.connect)
+
+			try:
+				handle.putrequest('GET', url.path)
+				handle.putheader('User-Agent', f"pTorrent")
+				handle.putheader('Range', f"bytes={start}-{start + len(buffer) - 1}")
+				handle.endheaders()
+				handle.send(b'')
+				# http.client hands the socket over to the response (and forgets it)
+				# if the server closes after this response, so hold on to it here.
+				sock = handle.sock
+
+				con_end = time.time()
+				dl_started = time.time()
+
+				sock.settimeout(timeouts.first_byte)
+				response = handle.getresponse()
+				first_byte_time = time.time() - dl_started
+				break
+			except (http.client.HTTPException, ConnectionError):
+				# The server closed the kept-alive connection between our liveness check
+				# and the request. A range GET is idempotent, so retry once on a fresh connection.
+				pool.discard(pool_key, handle)
+				handle = None
+				if not reused or attempt:
+					raise
+
+		if response.status != 206:
+			raise TimeoutError(f"Wrong HTTP status code: {response.status}.")
+
+		if response.length is not None and response.length != len(buffer):
+			raise TimeoutError(f"Asked for {len(buffer)} bytes but the server is sending {response.length}.")
+
+		read_into(response, sock, buffer, deadline=time.time() + timeouts.transfer, digest=digest, shaper=shaper)
+
+		# Only put the connection back if the whole response was consumed,
+		# otherwise the next request would read the leftovers.
+		if response.isclosed() and not response.will_close:
+			pool.checkin(pool_key, handle)
+		else:
+			pool.discard(pool_key, handle)
+		handle = None
+
+		ended = time.time()
+		if tracing.enabled():
+			# The body is hashed while it's read, so that's part of the transfer
+			tracing.complete('connect', con_start, con_end, 'request', url=url.geturl(), reused=reused)
+			tracing.complete('first byte', dl_started, dl_started + first_byte_time, 'request')
+			tracing.complete('transfer', dl_started + first_byte_time, ended, 'request', bytes=len(buffer))
+
+		return con_end - con_start, first_byte_time, ended - dl_started
+	finally:
+		if handle is not None:
+			pool.discard(pool_key, handle)
+
+RESULT_OK = 'ok'
+RESULT_CORRUPT = 'corrupt'
+RESULT_FAILED = 'failed'
+
+@dataclass
+class PieceResult:
+	"""
+	What a download reports back to the coordinator, small enough to be pickled for next to nothing.
+	Worker processes write good pieces straight into the target (written=True),
+	in-process engines may hand the data over instead since nothing has to be pickled then.
+	The torrent is referred to by its uuid, never by the Torrent() itself.
+	"""
+	torrent_uuid :str
+	index :int
+	status :str
+	actual_hash :typing.Optional[bytes] = None
+	size :int = 0
+	connect_time :float = 0.0
+	first_byte_time :float = 0.0
+	transfer_time :float = 0.0 # Including the wait for the response
+	seed :typing.Optional[str] = None # Who it was downloaded from, if a request was made at all
+	written :bool = False
+	data :typing.Optional[bytes] = None
+
+	def __repr__(self) -> str:
+		return f"PieceResult(torrent_uuid={self.torrent_uuid}, index={self.index}, status={self.status}, size={self.size}, written={self.written})"
+
+	@property
+	def ok(self) -> bool:
+		return self.status == RESULT_OK
 
 @dataclass
 class Chunk:
 	torrent: Torrent
 	index: int
 	expected_hash :bytes
-	data :bytes
+	data :typing.Optional[bytes]
 	actual_hash :typing.Optional[bytes] = None
 
 	def __repr__(self) -> str:
@@ -66,6 +198,7 @@ class BrokenChunk:
 	expected_hash :bytes
 	data :typing.Optional[bytes] = None
 	actual_hash :typing.Optional[bytes] = None
+	exclude :typing.Optional[typing.Set[str]] = None # Seeds to leave alone, those already busy with a copy of it
 	_broken_download = False
 
 	def __repr__(self) -> str:
@@ -97,75 +230,82 @@ class BrokenChunk:
 		if storage['arguments'].debug:
 			log(f"{self.index}: Initating download", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
 
+		# Whatever happens, the coordinator has to hear back, or the piece stays requested for good.
+		result = PieceResult(torrent_uuid=self.torrent.uuid, index=self.index, status=RESULT_FAILED)
+		try:
+			with tracing.span('download', piece=self.index):
+				return self._download(colors, result)
+		finally:
+			storage['torrents'][self.torrent.uuid]['chunks'].put(result)
+
+	def _download(self, colors :typing.Dict[int, str], result :PieceResult):
 		last_output = time.time()
-		prio = None
-		while prio is None:
-			prio, peer = self.torrent.get_fastest_peer()
-			time.sleep(0.0001)
+		with tracing.span('wait for seed', piece=self.index):
+			while (peer := self.torrent.get_fastest_peer(self.exclude, self.index)) is None:
+				time.sleep(0.01)
 
-			if storage['arguments'].debug and time.time() - last_output > 5:
-				log(f"{self.index} still waiting for fastest available peer...", level=logging.WARNING, fg="orange")
-				last_output = time.time()
+				if storage['arguments'].debug and time.time() - last_output > 5:
+					log(f"{self.index} still waiting for fastest available peer...", level=logging.WARNING, fg="orange")
+					last_output = time.time()
 
-		chunk_start_byte = int(self.index * self.torrent.info.piece_length)
-		chunk_end_byte = int(chunk_start_byte + self.torrent.info.piece_length)-1
+		result.seed = peer.target
+		chunk_size = self.torrent.info.piece_size(self.index)
+		# Pieces of multi-file torrents can span several files, which are fetched one request each.
+		urls = [
+			(peer.url_for(self.torrent.info.name, self.torrent.info.file_index[span.file_index].path), span)
+			for span in self.torrent.info.piece_spans(self.index)
+		]
 
-		if (http_schema := urllib.parse.urlparse(peer.target)).scheme:
-			if http_schema.path.endswith('/') is True:
-				http_schema = urllib.parse.urlparse(peer.target + self.torrent.info.name.decode('UTF-8', errors='replace'))
+		if all(url.scheme for url, span in urls):
 
 			if storage['arguments'].debug:
-				log(f"{self.index}: Starting download of index via {http_schema}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
+				log(f"{self.index}: Starting download of index via {urls[0][0]}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
 
-			# request = urllib.request.Request(peer.target)
-			# request.headers['Range'] = f"bytes={start}-{end}"
-			
+			peer_scored = False
 			try:
-				con_start = time.time()
-				
-				if http_schema.scheme == 'https':
-					handle = http.client.HTTPSConnection(*http_schema.netloc.split(':', 1), timeout=1)
-				elif http_schema.scheme == 'http':
-					handle = http.client.HTTPConnection(*http_schema.netloc.split(':', 1), timeout=1)
-				else:
-					raise ValueError(f"Unknown schema: {http_schema.scheme}")
+				buffer = read_buffer(chunk_size)
+				digest = hashlib.sha1()
+				connect_time, first_byte_time, transfer_time = 0.0, 0.0, 0.0
+				shaper = rate_limits().shaper(self.torrent.uuid, seed_host(peer.target))
 
-				handle.putrequest('GET', http_schema.path)
-				handle.putheader('User-Agent', f"pTorrent")
-				handle.putheader('Range', f"bytes={chunk_start_byte}-{chunk_end_byte}")
-				handle.endheaders()
-				handle.send(b'')
-				
-				con_end = time.time()
+				for url, span in urls:
+					timeouts = self.torrent.seed_timeouts(peer, span.length)
+					if storage['arguments'].debug:
+						log(f"{self.index}: Timeouts for {peer.target}: {timeouts}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
+
+					span_connect_time, span_first_byte_time, span_transfer_time = fetch_into(url, span.offset, buffer[span.range_offset:span.range_offset + span.length], digest, timeouts, shaper=shaper)
+					connect_time += span_connect_time
+					first_byte_time = max(first_byte_time, span_first_byte_time)
+					transfer_time += span_transfer_time
 
-				dl_started = time.time()
 				if storage['arguments'].debug:
-					log(f"{self.index}: Connecting took {con_end - con_start}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
+					log(f"{self.index}: Connecting took {connect_time}, the response took {first_byte_time}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
+					log(f"{self.index}: {http_pool().stats()}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
+					log(f"{self.index}: Download took {transfer_time}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
 
-				response = handle.getresponse()
-				if response.status != 206:
-					raise TimeoutError(f"Wrong HTTP status code: {response.status}.")
+				received = chunk_size
+				actual_hash = digest.digest()
 
-				reader = Reader(response.read, self.torrent.info.piece_length)
-				while reader.is_alive():
-					if time.time() - dl_started > 1:
-						reader.kill()
-						break
-					time.sleep(0.0001)
+				# The hash is already known the moment the last byte landed, so a good
+				# piece goes from the read buffer straight into the target. Only the
+				# small PieceResult() has to travel back to the coordinator.
+				self.actual_hash = actual_hash
+				result.actual_hash = actual_hash
+				result.size = received
+				result.connect_time = connect_time
+				result.first_byte_time = first_byte_time
+				result.transfer_time = transfer_time
 
-				if reader.data is None:
-					raise TimeoutError(f"Could not read data in timely fashion.")
+				if self.is_complete:
+					with tracing.span('write', piece=self.index):
+						self.torrent.open_target().write_piece(self.index, buffer[:received])
+					result.status = RESULT_OK
+					result.written = True
 
-				dl_ended = time.time()
-				if storage['arguments'].debug:
-					log(f"{self.index}: Download took {dl_ended - dl_started}", level=logging.INFO, fg=colors[self.index % (len(colors)-1)])
-				self.torrent.update_priority(
-					priority=Priority(connectivity=con_end - con_start, chunk_speed=dl_ended - dl_started),
-					peer=peer
-				)
-
-				self.data = reader.data
-				self.actual_hash = hashlib.sha1(self.data).digest()
+					self.torrent.update_score(peer, size=received, connect_time=result.connect_time, transfer_time=result.transfer_time, first_byte_time=first_byte_time)
+					peer_scored = True
+				else:
+					result.status = RESULT_CORRUPT
 			except ssl.SSLCertVerificationError as error:
 				if storage['arguments'].debug:
 					log(f"{self.index} ******> {error}", level=logging.ERROR, fg="red")
@@ -194,18 +334,16 @@ class BrokenChunk:
 				if storage['arguments'].debug:
 					log(f"{self.index} ******> {error}", level=logging.ERROR, fg="red")
 				self._broken_download = True
-
-		if self.is_complete:
-			storage['torrents'][self.torrent.uuid]['chunks'].put(
-				Chunk(
-					torrent=self.torrent,
-					index=self.index,
-					expected_hash=self.expected_hash,
-					data=self.data,
-					actual_hash=self.actual_hash
-				)
-			)
+			except (http.client.HTTPException, ValueError) as error:
+				# A malformed response, e.g. a bad status line, an over-long header or a Content-Length that isn't a number
+				if storage['arguments'].debug:
+					log(f"{self.index} ******> {error}", level=logging.ERROR, fg="red")
+				self._broken_download = True
+			finally:
+				# Errors and corrupt data both count against the seed.
+				if not peer_scored:
+					self.torrent.peer_failed(peer)
 		else:
-			storage['torrents'][self.torrent.uuid]['chunks'].put(self)
+			self.torrent.peer_failed(peer)
 
-		return self
\ No newline at end of file
+		return self
@@ -0,0 +1,109 @@
+import bisect
+import typing
+import pathlib
+from dataclasses import dataclass, field
+
+@dataclass
+class FileEntry:
+	"""
+	One file of a torrent, offset is where it starts in the torrent's
+	byte stream (all files laid out end to end in the order they're listed).
+	Single-file torrents have a single entry with an empty path, the file is then named after the torrent.
+	"""
+	length :int
+	path :typing.List[bytes] = field(default_factory=list)
+	offset :int = 0
+
+	def __post_init__(self):
+		for part in self.path:
+			if part in (b'', b'.', b'..') or b'/' in part or b'\\' in part:
+				raise ValueError(f"Unsafe path in torrent: {self.path}")
+
+	def __bencode__(self):
+		return {
+			'length' : self.length,
+			'path' : self.path
+		}
+
+	def __json__(self):
+		return {
+			'length' : self.length,
+			'path' : [part.decode('UTF-8', errors='replace') for part in self.path]
+		}
+
+	@property
+	def parts(self) -> typing.List[str]:
+		return [part.decode('UTF-8', errors='replace') for part in self.path]
+
+	@property
+	def end(self) -> int:
+		return self.offset + self.length
+
+@dataclass
+class FileSpan:
+	"""
+	A part of a byte range that lives in a single file.
+	offset is where it starts in that file, range_offset where it starts in the range it's a part of.
+	"""
+	file_index :int
+	offset :int
+	length :int
+	range_offset :int
+
+class FileIndex:
+	"""
+	The start offset of every file in a sorted list, so the files any byte range
+	(like a piece) touches are found with a bisect instead of by walking the file list.
+	"""
+	def __init__(self, files :typing.List[FileEntry]):
+		self.files = files
+		self._offsets = [entry.offset for entry in files]
+		self.length = files[-1].end if files else 0
+
+	def __len__(self) -> int:
+		return len(self.files)
+
+	def __iter__(self) -> typing.Iterator[FileEntry]:
+		return iter(self.files)
+
+	def __getitem__(self, file_index :int) -> FileEntry:
+		return self.files[file_index]
+
+	@classmethod
+	def from_lengths(cls, lengths_and_paths :typing.Iterable[typing.Tuple[int, typing.List[bytes]]]) -> 'FileIndex':
+		files = []
+		offset = 0
+		for length, path in lengths_and_paths:
+			files.append(FileEntry(length=length, path=path, offset=offset))
+			offset += length
+
+		return cls(files)
+
+	def spans(self, start :int, length :int) -> typing.List[FileSpan]:
+		"""
+		Splits length bytes starting at start into one FileSpan per file they touch.
+		"""
+		if start < 0 or start + length > self.length:
+			raise ValueError(f"Range {start}+{length} is outside of the torrent's {self.length} bytes.")
+
+		spans = []
+		file_index = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+		position = start
+		end = start + length
+
+		while position < end:
+			entry = self.files[file_index]
+			if entry.length and position < entry.end:
+				span_length = min(entry.end, end) - position
+				spans.append(FileSpan(file_index=file_index, offset=position - entry.offset, length=span_length, range_offset=position - start))
+				position += span_length
+			file_index += 1
+
+		return spans
+
+	def paths(self, root :pathlib.Path) -> typing.List[pathlib.Path]:
+		"""
+		Where every file goes when the torrent is downloaded to root
+		(root being the file itself for single-file torrents).
+		"""
+		return [root.joinpath(*entry.parts) for entry in self.files]
@@ -0,0 +1,189 @@
+import time
+import random
+import typing
+from dataclasses import dataclass, field
+from .. import metrics
+
+PIECE_MISSING = 0
+PIECE_REQUESTED = 1
+PIECE_DONE = 2
+
+# How many piece latencies are kept for the percentiles, a uniform sample of them once there are more
+LATENCY_SAMPLES = 1024
+
+def format_duration(seconds :float) -> str:
+	seconds = int(seconds)
+	if seconds >= 3600:
+		return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+	if seconds >= 60:
+		return f"{seconds // 60}m{seconds % 60:02d}s"
+	return f"{seconds}s"
+
+@dataclass
+class Progress:
+	"""
+	The state of every piece of a torrent (one byte each), together with counters
+	that are updated as the states change. Nothing here ever looks at more than one
+	piece, so keeping track of the download costs the same regardless of the piece count.
+	"""
+	piece_count :int
+	length :int
+	states :bytearray = field(default_factory=bytearray)
+	done :int = 0
+	requested :int = 0
+	done_bytes :int = 0
+	downloaded_bytes :int = 0 # Only what was downloaded since the start, not what was on disk
+	wasted_bytes :int = 0 # Duplicates of pieces that were already done
+	failures :int = 0
+	# When each outstanding piece was (last) requested, and how long a download of one usually takes
+	requested_at :typing.Dict[int, float] = field(default_factory=dict)
+	piece_latency :float = 0.0
+	rate :float = 0.0 # bytes/s, exponentially weighted
+	alpha :float = 0.3
+	started :float = field(default_factory=time.time)
+	first_piece_at :typing.Optional[float] = None # When the first downloaded piece was done
+	latencies :typing.List[float] = field(default_factory=list) # Seconds from (last) request until done, a sample of the downloaded pieces
+	latency_count :int = 0 # Every downloaded piece, not just those in the sample
+	latency_max :float = 0.0
+	_sampled_at :float = 0.0
+	_sampled_bytes :int = 0
+
+	def __post_init__(self):
+		if len(self.states) != self.piece_count:
+			self.states = bytearray(self.piece_count)
+		self._sampled_at = self.started
+
+	@property
+	def finished(self) -> bool:
+		return self.done == self.piece_count
+
+	@property
+	def remaining_bytes(self) -> int:
+		return self.length - self.done_bytes
+
+	def state(self, index :int) -> int:
+		return self.states[index]
+
+	def is_done(self, index :int) -> bool:
+		return self.states[index] == PIECE_DONE
+
+	def mark_requested(self, index :int, now :typing.Optional[float] = None) -> None:
+		if self.states[index] == PIECE_MISSING:
+			self.states[index] = PIECE_REQUESTED
+			self.requested += 1
+			self.requested_at[index] = now or time.time()
+
+	def mark_failed(self, index :int, retried :bool = True, now :typing.Optional[float] = None) -> None:
+		"""
+		The piece stays requested, whoever reported the failure is expected to retry it.
+		"""
+		self.failures += 1
+		if retried and index in self.requested_at:
+			self.requested_at[index] = now or time.time()
+
+	def mark_wasted(self, size :int) -> None:
+		self.wasted_bytes += size
+
+	def mark_done(self, index :int, size :int, downloaded :bool = True, duration :typing.Optional[float] = None, now :typing.Optional[float] = None) -> bool:
+		"""
+		duration is how long the actual download took, as measured by whoever downloaded it.
+		Returns False if the piece was already done.
+		"""
+		if (previous := self.states[index]) == PIECE_DONE:
+			return False
+
+		if previous == PIECE_REQUESTED:
+			self.requested -= 1
+			requested_at = self.requested_at.pop(index, None)
+
+			if downloaded and requested_at is not None:
+				now = now or time.time()
+				self.add_latency(now - requested_at)
+				metrics.PIECE_SECONDS.observe(now - requested_at)
+				if self.first_piece_at is None:
+					self.first_piece_at = now
+
+		if duration:
+			self.piece_latency = duration if self.piece_latency == 0 else self.piece_latency + self.alpha * (duration - self.piece_latency)
+
+		self.states[index] = PIECE_DONE
+		self.done += 1
+		self.done_bytes += size
+		if downloaded:
+			self.downloaded_bytes += size
+
+		return True
+
+	def sample(self, now :typing.Optional[float] = None) -> float:
+		"""
+		Updates the download rate with what arrived since the last sample.
+		"""
+		now = now or time.time()
+		if (elapsed := now - self._sampled_at) <= 0:
+			return self.rate
+
+		rate = (self.downloaded_bytes - self._sampled_bytes) / elapsed
+		self.rate = rate if self._sampled_bytes == 0 and self.rate == 0 else self.rate + self.alpha * (rate - self.rate)
+
+		self._sampled_at = now
+		self._sampled_bytes = self.downloaded_bytes
+		return self.rate
+
+	@property
+	def average_rate(self) -> float:
+		return self.downloaded_bytes / max(time.time() - self.started, 0.000001)
+
+	def add_latency(self, seconds :float) -> None:
+		"""
+		Keeps at most LATENCY_SAMPLES latencies (reservoir sampling), every one
+		downloaded so far being equally likely to be among them.
+		"""
+		self.latency_count += 1
+		self.latency_max = max(self.latency_max, seconds)
+
+		if len(self.latencies) < LATENCY_SAMPLES:
+			self.latencies.append(seconds)
+		elif (position := random.randrange(self.latency_count)) < LATENCY_SAMPLES:
+			self.latencies[position] = seconds
+
+	def latency_percentile(self, percentile :float) -> typing.Optional[float]:
+		if not self.latencies:
+			return None
+		if percentile >= 100:
+			return self.latency_max
+		ordered = sorted(self.latencies)
+		return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+	def summary(self) -> typing.Dict[str, typing.Any]:
+		"""
+		The numbers a download is judged by, see --stats.
+		"""
+		elapsed = time.time() - self.started
+		return {
+			'pieces' : self.piece_count,
+			'done' : self.done,
+			'downloaded_bytes' : self.downloaded_bytes,
+			'wasted_bytes' : self.wasted_bytes,
+			'failures' : self.failures,
+			'seconds' : elapsed,
+			'throughput' : self.downloaded_bytes / max(elapsed, 0.000001),
+			'time_to_first_piece' : self.first_piece_at - self.started if self.first_piece_at else None,
+			'piece_latency' : {
+				f'p{percentile}' : self.latency_percentile(percentile) for percentile in (50, 90, 99, 100)
+			}
+		}
+
+	def eta(self) -> typing.Optional[float]:
+		if self.finished:
+			return 0.0
+		if self.rate <= 0:
+			return None
+		return self.remaining_bytes / self.rate
+
+	def describe(self) -> str:
+		eta = self.eta()
+		return (
+			f"{self.done}/{self.piece_count} has finished downloading"
+			f" ({self.done_bytes / max(self.length, 1) * 100:.1f}%, {self.rate / 1024 / 1024:.2f}MB/s,"
+			f" ETA {format_duration(eta) if eta is not None else 'unknown'})"
+		)
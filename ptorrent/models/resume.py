@@ -0,0 +1,158 @@
+import os
+import time
+import typing
+import pathlib
+import logging
+from dataclasses import dataclass, field
+from ..storage import storage
+from ..logger import log
+
+RESUME_VERSION = 1
+
+def fingerprint(paths :typing.List[pathlib.Path]) -> typing.Tuple[int, int]:
+	"""
+	The combined size and the newest mtime of paths, (-1, -1) if any of them is missing.
+	"""
+	size, mtime_ns = 0, 0
+	for path in paths:
+		try:
+			path_stat = path.stat()
+		except OSError:
+			return -1, -1
+
+		size += path_stat.st_size
+		mtime_ns = max(mtime_ns, path_stat.st_mtime_ns)
+
+	return size, mtime_ns
+
+@dataclass
+class ResumeState:
+	"""
+	Keeps track of which pieces are known to be on disk, together with
+	the size and mtime the target files had when that was last true.
+	If the targets still have the same fingerprint on the next start,
+	the bitfield can be trusted instead of re-hashing the file. If only the mtime
+	changed, pieces were written after the last save (a crash between flushes),
+	and only the pieces the bitfield doesn't have need to be re-hashed.
+	"""
+	location :pathlib.Path
+	info_hash :bytes
+	piece_count :int
+	size :int = -1
+	mtime_ns :int = -1
+	bitfield :bytearray = field(default_factory=bytearray)
+	flush_every_pieces :int = 16
+	flush_every_seconds :float = 5.0
+	_dirty = 0
+	_last_flush = 0.0
+
+	def __post_init__(self):
+		if len(self.bitfield) != (self.piece_count + 7) // 8:
+			self.bitfield = bytearray((self.piece_count + 7) // 8)
+
+	@staticmethod
+	def location_for(target :pathlib.Path) -> pathlib.Path:
+		return target.with_name(f"{target.name}.resume")
+
+	@classmethod
+	def load(cls, target :pathlib.Path, info_hash :bytes, piece_count :int) -> 'ResumeState':
+		"""
+		Loads the resume state stored next to target.
+		A fresh (empty) state is returned if there is none, or if it belongs to another torrent.
+		"""
+		from ..parsers.torrent import parse_torrent
+
+		location = cls.location_for(target)
+		try:
+			with location.open('rb') as fh:
+				stored = parse_torrent(fh.read())
+		except (OSError, ValueError):
+			return cls(location=location, info_hash=info_hash, piece_count=piece_count)
+
+		if type(stored) != dict \
+			or stored.get('version') != RESUME_VERSION \
+			or stored.get('info_hash') != info_hash \
+			or stored.get('piece_count') != piece_count:
+			return cls(location=location, info_hash=info_hash, piece_count=piece_count)
+
+		return cls(
+			location=location,
+			info_hash=info_hash,
+			piece_count=piece_count,
+			size=stored.get('size', -1),
+			mtime_ns=stored.get('mtime_ns', -1),
+			bitfield=bytearray(stored.get('bitfield', b''))
+		)
+
+	def matches(self, paths :typing.List[pathlib.Path]) -> bool:
+		if self.size == -1:
+			return False
+
+		return fingerprint(paths) == (self.size, self.mtime_ns)
+
+	def size_matches(self, paths :typing.List[pathlib.Path]) -> bool:
+		if self.size == -1:
+			return False
+
+		return fingerprint(paths)[0] == self.size
+
+	def missing(self) -> typing.List[int]:
+		return [index for index in range(self.piece_count) if not self.has_piece(index)]
+
+	def has_piece(self, index :int) -> bool:
+		return bool(self.bitfield[index >> 3] & (0x80 >> (index & 7)))
+
+	def set_piece(self, index :int) -> None:
+		self.bitfield[index >> 3] |= 0x80 >> (index & 7)
+		self._dirty += 1
+
+	def clear_piece(self, index :int) -> None:
+		self.bitfield[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+		self._dirty += 1
+
+	def reset(self) -> None:
+		self.bitfield = bytearray(len(self.bitfield))
+		self._dirty += 1
+
+	@property
+	def completed(self) -> int:
+		return sum(bin(byte).count('1') for byte in self.bitfield)
+
+	def flush(self, paths :typing.List[pathlib.Path], force :bool = False) -> None:
+		"""
+		Saves the state if enough pieces changed or enough time passed since the last save.
+		Any writes to paths has to be flushed to the OS before calling this,
+		otherwise the recorded mtime will be older than the actual file.
+		"""
+		if not force:
+			if self._dirty == 0:
+				return None
+			if self._dirty < self.flush_every_pieces and time.time() - self._last_flush < self.flush_every_seconds:
+				return None
+
+		self.save(paths)
+
+	def save(self, paths :typing.List[pathlib.Path]) -> None:
+		from ..parsers.torrent import torrent_encode
+
+		self.size, self.mtime_ns = fingerprint(paths)
+
+		temporary_location = self.location.with_name(f"{self.location.name}.{os.getpid()}.tmp")
+		try:
+			with temporary_location.open('wb') as fh:
+				fh.write(torrent_encode({
+					'version' : RESUME_VERSION,
+					'info_hash' : self.info_hash,
+					'piece_count' : self.piece_count,
+					'size' : self.size,
+					'mtime_ns' : self.mtime_ns,
+					'bitfield' : self.bitfield
+				}))
+
+			os.replace(temporary_location, self.location)
+		except OSError as error:
+			log(f"Could not save resume state to {self.location}: {error}", level=logging.WARNING, fg="orange")
+			return None
+
+		self._dirty = 0
+		self._last_flush = time.time()
@@ -1,71 +1,388 @@
-import random
+import heapq
 import typing
+import threading
+import urllib.parse
+import multiprocessing.managers
 from dataclasses import dataclass
 
 @dataclass
-class Priority:
-	connectivity :float
-	chunk_speed :float
+class Peer:
+	target :str
+	piece :typing.Optional[int] = None # What it was picked for, see Scoreboard.pick()
 
-	def __hash__(self):
-		return hash((self.chunk_speed, self.connectivity))
+	def url_for(self, name :bytes, path :typing.Optional[typing.List[bytes]] = None) -> urllib.parse.ParseResult:
+		"""
+		Web seeds ending with a slash are directories (BEP 19),
+		the file is then expected to be found under its torrent name.
+		Files of multi-file torrents (path) are expected under <seed>/<name>/<path>,
+		a seed without the trailing slash is then taken to point at the <name> directory itself.
+		"""
+		if path:
+			quoted = '/'.join(urllib.parse.quote(part) for part in path)
+			if self.target.endswith('/'):
+				return urllib.parse.urlparse(f"{self.target}{urllib.parse.quote(name)}/{quoted}")
+			return urllib.parse.urlparse(f"{self.target}/{quoted}")
+
+		if self.target.endswith('/'):
+			return urllib.parse.urlparse(self.target + name.decode('UTF-8', errors='replace'))
+		return urllib.parse.urlparse(self.target)
 
 @dataclass
-class Peer:
-	target :str
+class Timeouts:
+	"""
+	How long a request against a seed may take: to connect, from sending
+	the request until the response arrives, and to transfer the body.
+	"""
+	connect :float
+	first_byte :float
+	transfer :float
+
+	def __str__(self) -> str:
+		return f"connect {self.connect:.2f}s, first byte {self.first_byte:.2f}s, transfer {self.transfer:.2f}s"
 
 @dataclass
-class Peers:
-	peers :typing.Optional[typing.Dict[Priority, typing.List[Peer]]] = None
+class SeedScore:
+	"""
+	Exponentially weighted moving averages of how a seed has performed.
+	"""
+	target :str
+	throughput :float = 0.0 # bytes/s of a single request
+	aggregate :float = 0.0 # bytes/s of all requests running against the seed
+	latency :float = 0.0 # seconds until the request was sent
+	samples :int = 0
+	errors :int = 0
+	consecutive_errors :int = 0
+	active :int = 0
+	window :float = 2.0 # AIMD limit of concurrent requests
+	# Round-trip time estimate (RFC 6298 style) from the time until the response arrived
+	srtt :float = 0.0
+	rttvar :float = 0.0
+	rtt_samples :int = 0
+
+	def expected_time(self, size :int) -> float:
+		"""
+		How long a request of size bytes is expected to take if it's started now.
+		Seeds we know nothing about are tried first.
+		"""
+		if self.samples == 0:
+			return 0.0 if self.consecutive_errors == 0 else float(2 ** min(self.consecutive_errors, 16))
+
+		expected = self.latency + size / max(self.throughput, 1.0)
+
+		# Requests already running against the seed share its bandwidth,
+		# and seeds that keep failing are backed off exponentially.
+		return expected * (1 + self.active) * 2 ** min(self.consecutive_errors, 16)
+
+	def add_rtt_sample(self, rtt :float) -> None:
+		if self.rtt_samples == 0:
+			self.srtt, self.rttvar = rtt, rtt / 2
+		else:
+			self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+			self.srtt = 0.875 * self.srtt + 0.125 * rtt
+		self.rtt_samples += 1
+
+	def timeouts(self, size :int, initial :float = 1.0, minimum :float = 0.2, maximum :float = 60.0, assumed_throughput :float = 256 * 1024) -> Timeouts:
+		"""
+		Timeouts the way TCP calculates its retransmission timeout: the smoothed RTT plus
+		four times its variance, doubled for every error in a row. The transfer gets
+		twice the time the seed's throughput says size bytes should take on top of that.
+		Seeds without measurements get initial, and assumed_throughput for the transfer.
+		"""
+		if self.rtt_samples:
+			rto = self.srtt + max(4 * self.rttvar, 0.01)
+		else:
+			rto = initial
+		rto = min(max(rto * 2 ** min(self.consecutive_errors, 6), minimum), maximum)
+
+		expected_transfer = size / (self.throughput if self.samples and self.throughput > 0 else assumed_throughput)
+		return Timeouts(
+			connect=rto,
+			first_byte=rto,
+			transfer=min(max(rto + 2 * expected_transfer, minimum), maximum)
+		)
 
-	def add_peer(self, priority :Priority, peer :Peer):
-		if not priority in self.peers:
-			self.peers[priority] = []
+class Scoreboard:
+	"""
+	Keeps a SeedScore per web seed in a min-heap ordered by expected_time(),
+	together with each seed's position in the heap. That way both picking the best
+	seed and re-scoring a single seed after a download are O(log n).
 
-		self.peers[priority].append(peer)
+	Every seed has an AIMD window of how many requests may run against it
+	at the same time (never more than max_active). It grows while the seed's
+	combined throughput keeps improving and is halved on every error.
+	Seeds with a full window are taken out of the heap until one of
+	their requests finishes, so pick() never has to look past the top.
+	All methods hold a lock, and the whole object can be shared between
+	processes through a SeedManager without ever copying the table.
+	Seeds picked for a piece are remembered until they're handed back,
+	so a second copy of the piece can be sent elsewhere (see seeds_of()).
+	"""
+	def __init__(self, reference_size :int = 1024 * 1024, max_active :typing.Optional[int] = None, alpha :float = 0.3, timeout_limits :typing.Optional[typing.Dict[str, float]] = None):
+		self.reference_size = reference_size
+		self.max_active = max_active
+		self.alpha = alpha
+		# Passed on to SeedScore.timeouts(), e.g. {'initial': 1, 'minimum': 0.2, 'maximum': 60}
+		self.timeout_limits = timeout_limits or {}
 
-	def __iter__(self):
-		for priority in self.peers:
-			yield priority
+		self._scores :typing.Dict[str, SeedScore] = {}
+		self._heap :typing.List[SeedScore] = []
+		self._positions :typing.Dict[str, int] = {}
+		self._pieces :typing.Dict[int, typing.List[str]] = {}
+		self._lock = threading.RLock()
 
-	def __setitem__(self, key, val):
-		if type(key) != Priority or (type(val) != Peer and type(val) != list):
-			raise ValueError(f"'Peers[key] = val' requires that key is Priority() not {type(key)}, and val being Peer()/list() not {type(val)}.")
+	def __len__(self) -> int:
+		return len(self._scores)
 
-		if key not in self.peers:
-			if type(val) != list:
-				self.peers[key] = []
+	def add_seed(self, target :str) -> None:
+		with self._lock:
+			if target in self._scores:
+				return None
+
+			self._scores[target] = SeedScore(target=target)
+			self._push(self._scores[target])
+
+	def remove_seed(self, target :str) -> None:
+		with self._lock:
+			if target in self._positions:
+				self._remove(self._scores[target])
+			self._scores.pop(target, None)
+
+			# Nothing is going to hand it back for the pieces it was working on
+			for piece in [piece for piece, targets in self._pieces.items() if target in targets]:
+				while target in self._pieces.get(piece, ()):
+					self._forget_piece(target, piece)
+
+	def pick(self, exclude :typing.Optional[typing.Collection[str]] = None, piece :typing.Optional[int] = None) -> typing.Optional[str]:
+		"""
+		Marks the best seed (that isn't in exclude) as busy with one more request and returns it,
+		or None if every such seed already has as many requests running as it's allowed.
+		If exclude is every seed there is, it's ignored. The seed is remembered
+		as working on piece until it's handed back with the same piece.
+		"""
+		with self._lock:
+			if not self._heap:
+				return None
+
+			if exclude and all(target in exclude for target in self._scores):
+				exclude = None
+
+			position = 0
+			if exclude and self._heap[0].target in exclude:
+				if (position := self._best_position(exclude)) is None:
+					return None
+
+			score = self._heap[position]
+			score.active += 1
+			if piece is not None:
+				self._pieces.setdefault(piece, []).append(score.target)
+
+			if score.active >= self._limit(score):
+				self._remove(score)
 			else:
-				self.peers[key] = val
-		elif type(val) == list:
-			self.peers[key] = val
+				self._sift_down(position)
+
+			return score.target
+
+	def seeds_of(self, piece :int) -> typing.List[str]:
+		"""
+		The seeds that were picked for piece and haven't been handed back yet.
+		"""
+		with self._lock:
+			return list(self._pieces.get(piece, ()))
+
+	def release(self, target :str, piece :typing.Optional[int] = None) -> None:
+		"""
+		Hands a picked seed back without any new measurement.
+		"""
+		with self._lock:
+			self._forget_piece(target, piece)
+			if (score := self._scores.get(target)) is None:
+				return None
+
+			score.active = max(score.active - 1, 0)
+			self._rescore(score)
+
+	def report(self, target :str, size :int, connect_time :float, transfer_time :float, first_byte_time :typing.Optional[float] = None, piece :typing.Optional[int] = None) -> None:
+		"""
+		Hands a picked seed back after it successfully transferred size bytes.
+		first_byte_time (request sent until response received) is what the seed's timeouts are based on.
+		"""
+		with self._lock:
+			self._forget_piece(target, piece)
+			if (score := self._scores.get(target)) is None:
+				return None
+
+			if first_byte_time is not None:
+				score.add_rtt_sample(first_byte_time)
+
+			throughput = size / max(transfer_time, 0.000001)
+			aggregate = throughput * max(score.active, 1)
+			if score.samples == 0:
+				score.throughput, score.aggregate, score.latency = throughput, aggregate, connect_time
+			else:
+				# Additive increase, about one more request per window of successful ones
+				if aggregate > score.aggregate * 1.02:
+					score.window = min(score.window + 1 / score.window, float(self.max_active or 1 << 16))
+
+				score.throughput += self.alpha * (throughput - score.throughput)
+				score.aggregate += self.alpha * (aggregate - score.aggregate)
+				score.latency += self.alpha * (connect_time - score.latency)
+
+			score.samples += 1
+			score.consecutive_errors = 0
+			score.active = max(score.active - 1, 0)
+			self._rescore(score)
+
+	def report_error(self, target :str, piece :typing.Optional[int] = None) -> None:
+		"""
+		Hands a picked seed back after its request failed.
+		"""
+		with self._lock:
+			self._forget_piece(target, piece)
+			if (score := self._scores.get(target)) is None:
+				return None
+
+			score.errors += 1
+			score.consecutive_errors += 1
+			score.window = max(score.window / 2, 1.0)
+			score.active = max(score.active - 1, 0)
+			self._rescore(score)
+
+	def timeouts(self, target :str, size :int) -> Timeouts:
+		"""
+		How long a request of size bytes against target may take, see SeedScore.timeouts().
+		"""
+		with self._lock:
+			if (score := self._scores.get(target)) is None:
+				return SeedScore(target=target).timeouts(size, **self.timeout_limits)
+			return score.timeouts(size, **self.timeout_limits)
+
+	def describe(self) -> str:
+		with self._lock:
+			return ', '.join(
+				f"{score.target}={score.active}/{self._limit(score)} (srtt {score.srtt * 1000:.0f}ms, rttvar {score.rttvar * 1000:.0f}ms, rto {score.timeouts(self.reference_size, **self.timeout_limits).first_byte:.2f}s)"
+				for score in self._scores.values()
+			)
+
+	def scores(self) -> typing.List[SeedScore]:
+		"""
+		A copy of every seed's score, best first.
+		"""
+		with self._lock:
+			return sorted(
+				(SeedScore(**score.__dict__) for score in self._scores.values()),
+				key=lambda score: score.expected_time(self.reference_size)
+			)
+
+	def top(self, count :int) -> typing.List[str]:
+		"""
+		The count seeds pick() would hand out first, best first. Seeds with a full window aren't among them.
+		"""
+		with self._lock:
+			best = []
+			candidates = [(self._key(self._heap[0]), 0)] if self._heap else []
+			while candidates and len(best) < count:
+				key, position = heapq.heappop(candidates)
+				best.append(self._heap[position].target)
+
+				for child in (2 * position + 1, 2 * position + 2):
+					if child < len(self._heap):
+						heapq.heappush(candidates, (self._key(self._heap[child]), child))
+
+			return best
+
+	def _forget_piece(self, target :str, piece :typing.Optional[int]) -> None:
+		if (targets := self._pieces.get(piece)) is None or target not in targets:
+			return None
+
+		targets.remove(target)
+		if not targets:
+			del self._pieces[piece]
+
+	def _best_position(self, exclude :typing.Collection[str]) -> typing.Optional[int]:
+		# Best-first walk down the heap, only as deep as the excluded seeds at the top force us to go.
+		candidates = [(self._key(self._heap[0]), 0)]
+		while candidates:
+			key, position = heapq.heappop(candidates)
+			if self._heap[position].target not in exclude:
+				return position
+
+			for child in (2 * position + 1, 2 * position + 2):
+				if child < len(self._heap):
+					heapq.heappush(candidates, (self._key(self._heap[child]), child))
+
+		return None
+
+	def _key(self, score :SeedScore) -> float:
+		return score.expected_time(self.reference_size)
+
+	def _limit(self, score :SeedScore) -> int:
+		limit = max(int(score.window), 1)
+		if self.max_active is not None:
+			limit = min(limit, self.max_active)
+		return limit
+
+	def _rescore(self, score :SeedScore) -> None:
+		if score.target not in self._positions:
+			if score.active < self._limit(score):
+				self._push(score)
+			return None
+
+		if score.active >= self._limit(score):
+			# The window shrunk below what's already running
+			self._remove(score)
+			return None
+
+		position = self._positions[score.target]
+		self._sift_up(position)
+		self._sift_down(self._positions[score.target])
+
+	def _push(self, score :SeedScore) -> None:
+		self._heap.append(score)
+		self._positions[score.target] = len(self._heap) - 1
+		self._sift_up(len(self._heap) - 1)
+
+	def _remove(self, score :SeedScore) -> None:
+		position = self._positions.pop(score.target)
+		last = self._heap.pop()
 
-		elif val not in self.peers[key]:
-			self.peers[key].append(val)
+		if position < len(self._heap):
+			self._heap[position] = last
+			self._positions[last.target] = position
+			self._sift_up(position)
+			self._sift_down(self._positions[last.target])
 
-	def __getitem__(self, key):
-		return self.peers[key]
+	def _swap(self, a :int, b :int) -> None:
+		self._heap[a], self._heap[b] = self._heap[b], self._heap[a]
+		self._positions[self._heap[a].target] = a
+		self._positions[self._heap[b].target] = b
 
-	def keys(self):
-		return self.peers.keys()
+	def _sift_up(self, position :int) -> None:
+		while position > 0:
+			parent = (position - 1) // 2
+			if self._key(self._heap[position]) >= self._key(self._heap[parent]):
+				break
+			self._swap(position, parent)
+			position = parent
 
-	def items(self):
-		return self.peers.items()
+	def _sift_down(self, position :int) -> None:
+		while True:
+			smallest = position
+			for child in (2 * position + 1, 2 * position + 2):
+				if child < len(self._heap) and self._key(self._heap[child]) < self._key(self._heap[smallest]):
+					smallest = child
 
-	def init(self):
-		self.peers = {}
+			if smallest == position:
+				break
 
-	def get_fastest_peers(self):
-		first_10 = {}
-		# Sort based on download speed (chunk speed)
-		for priority in sorted(self.peers.keys(), key=lambda prio: prio.chunk_speed):
-			if len(self.peers[priority]):
-				first_10[priority] = self.peers[priority]
-				if len(first_10) == 10:
-					break
+			self._swap(position, smallest)
+			position = smallest
 
-		# Then sort on whoever has the highest connectivity
-		for priority in sorted(first_10.keys(), key=lambda prio: prio.connectivity):
-			return priority, first_10[priority]
+class SeedManager(multiprocessing.managers.BaseManager):
+	"""
+	Hosts Scoreboard()'s in a server process, worker processes talk to them through proxies.
+	Only the arguments and return values of each call cross the process boundary.
+	"""
+	pass
 
-		return None, []
\ No newline at end of file
+SeedManager.register('Scoreboard', Scoreboard)
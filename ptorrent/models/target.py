@@ -0,0 +1,155 @@
+import os
+import typing
+import pathlib
+import collections
+from dataclasses import dataclass, field
+from .files import FileIndex
+
+@dataclass
+class TargetFile:
+	"""
+	A file a torrent is downloaded into.
+	It's created sparse at its final size when opened, so pieces
+	can be written at their offset in whatever order they arrive.
+	"""
+	path :pathlib.Path
+	length :int
+	_fd :typing.Optional[int] = None
+
+	def __getstate__(self):
+		# File descriptors are process local, workers re-open the file when they need it.
+		return {**self.__dict__, '_fd': None}
+
+	@property
+	def is_open(self) -> bool:
+		return self._fd is not None
+
+	def open(self) -> bool:
+		"""
+		Opens (and creates) the target, returns True if it had to be resized.
+		"""
+		if self._fd is not None:
+			return False
+
+		self.path.parent.mkdir(exist_ok=True, parents=True)
+		self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+		if os.fstat(self._fd).st_size != self.length:
+			# ftruncate() leaves the new space as a hole, so this is cheap
+			# and doesn't use any disk until the pieces are actually written.
+			os.ftruncate(self._fd, self.length)
+			return True
+
+		return False
+
+	def write_at(self, offset :int, data :typing.Union[bytes, memoryview]) -> None:
+		if self._fd is None:
+			self.open()
+
+		view = memoryview(data)
+		while len(view):
+			written = os.pwrite(self._fd, view, offset)
+			view = view[written:]
+			offset += written
+
+	def read_at(self, offset :int, size :int) -> bytes:
+		if self._fd is None:
+			self.open()
+
+		return os.pread(self._fd, size, offset)
+
+	def close(self) -> None:
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+@dataclass
+class TargetFiles:
+	"""
+	All the files a torrent is downloaded into, pieces are split over
+	them using the torrent's FileIndex(). Torrents can have thousands of files,
+	so only the max_open most recently used ones are kept open.
+	"""
+	root :pathlib.Path
+	file_index :FileIndex
+	piece_length :int
+	max_open :int = 64
+	created :bool = False
+	files :typing.List[TargetFile] = field(default_factory=list)
+	_open :typing.OrderedDict[int, TargetFile] = field(default_factory=collections.OrderedDict)
+
+	def __post_init__(self):
+		if not self.files:
+			self.files = [
+				TargetFile(path=path, length=entry.length)
+				for path, entry in zip(self.file_index.paths(self.root), self.file_index)
+			]
+
+	def __getstate__(self):
+		return {**self.__dict__, '_open': collections.OrderedDict()}
+
+	@property
+	def paths(self) -> typing.List[pathlib.Path]:
+		return [target.path for target in self.files]
+
+	def open(self) -> bool:
+		"""
+		Creates every file at its final size, returns True if any of them had to be resized.
+		"""
+		if self.created:
+			return False
+
+		resized = False
+		for target in self.files:
+			if target.path.exists() and target.path.stat().st_size == target.length:
+				continue
+
+			resized = target.open() or resized
+			target.close()
+
+		self.created = True
+		return resized
+
+	def _target(self, file_index :int) -> TargetFile:
+		if (target := self._open.get(file_index)) is not None:
+			self._open.move_to_end(file_index)
+			return target
+
+		target = self.files[file_index]
+		target.open()
+		self._open[file_index] = target
+
+		while len(self._open) > self.max_open:
+			file_index, least_recently_used = self._open.popitem(last=False)
+			least_recently_used.close()
+
+		return target
+
+	def write_piece(self, index :int, data :typing.Union[bytes, memoryview]) -> None:
+		view = memoryview(data)
+		for span in self.file_index.spans(index * self.piece_length, len(view)):
+			self._target(span.file_index).write_at(span.offset, view[span.range_offset:span.range_offset + span.length])
+
+	def read_piece(self, index :int, size :int) -> bytes:
+		"""
+		Reads a piece without creating or keeping any files open, which makes it
+		safe to call from several threads. Missing files simply make the piece come up short.
+		"""
+		parts = []
+		for span in self.file_index.spans(index * self.piece_length, size):
+			try:
+				fd = os.open(self.files[span.file_index].path, os.O_RDONLY)
+			except OSError:
+				break
+
+			try:
+				parts.append(os.pread(fd, span.length, span.offset))
+			finally:
+				os.close(fd)
+
+		return b''.join(parts)
+
+	def close(self) -> None:
+		while self._open:
+			file_index, target = self._open.popitem()
+			target.close()
@@ -1,6 +1,10 @@
+import os
+import mmap
 import typing
 import pathlib
 import hashlib
+import collections
+import concurrent.futures
 import random
 import multiprocessing.queues
 import time
@@ -10,25 +14,88 @@ from dataclasses import dataclass
 if typing.TYPE_CHECKING:
 	from .chunk import Chunk, BrokenChunk
 
-from .seeders import Peers, Priority, Peer
+from .seeders import Peer, Timeouts
+from .resume import ResumeState
+from .target import TargetFiles
+from .files import FileEntry, FileIndex, FileSpan
 from ..storage import storage
 from ..logger import log
+from .. import metrics
 
 @dataclass
 class TorrentInfo:
-	length :int
 	name :str
 	piece_length :int
 	pieces :bytes
+	length :int = 0
+	# Multi-file torrents list their files here instead of having a length
+	files :typing.Optional[typing.List[FileEntry]] = None
+	info_hash :typing.Optional[bytes] = None
+
+	def __post_init__(self):
+		if self.files is not None:
+			self.file_index = FileIndex.from_lengths(
+				(entry['length'], entry.get('path', [])) if type(entry) == dict else (entry.length, entry.path)
+				for entry in self.files
+			)
+			self.files = self.file_index.files
+			self.length = self.file_index.length
+		else:
+			self.file_index = FileIndex([FileEntry(length=self.length)])
+
+		if self.info_hash is None:
+			self.info_hash = self.calculate_info_hash()
 
 	def __json__(self):
 		return {
-			'length' : self.length,
+			**({'files' : self.files} if self.is_multi_file else {'length' : self.length}),
 			'name' : self.name,
 			'piece_length' : self.piece_length,
+			'pieces' : self.pieces,
+			'info_hash' : self.info_hash.hex()
+		}
+
+	def __bencode__(self):
+		# The parser normalizes keys ('piece length' -> 'piece_length'),
+		# so we need to restore the names used in the actual .torrent spec.
+		return {
+			**({'files' : self.files} if self.is_multi_file else {'length' : self.length}),
+			'name' : self.name,
+			'piece length' : self.piece_length,
 			'pieces' : self.pieces
 		}
 
+	@property
+	def is_multi_file(self) -> bool:
+		return self.files is not None
+
+	def piece_spans(self, index :int) -> typing.List[FileSpan]:
+		"""
+		The (file, offset, length) parts a piece is made of, found with a bisect over the file offsets.
+		"""
+		return self.file_index.spans(index * self.piece_length, self.piece_size(index))
+
+	def calculate_info_hash(self) -> bytes:
+		"""
+		Re-encodes the info dictionary to calculate the info-hash.
+		load_torrent() calculates it from the raw .torrent instead,
+		which is the only reliable way if the info dictionary has keys we don't model.
+		"""
+		from ..parsers.torrent import torrent_encode
+
+		return hashlib.sha1(torrent_encode(self)).digest()
+
+	@property
+	def piece_count(self) -> int:
+		return len(self.pieces) // 20
+
+	def piece_hash(self, index :int) -> bytes:
+		return self.pieces[index*20:index*20+20]
+
+	def piece_size(self, index :int) -> int:
+		# All pieces are piece_length long, except (usually) the last one.
+		return min(self.piece_length, self.length - index * self.piece_length)
+
 @dataclass
 class Torrent:
 	info :TorrentInfo
@@ -40,6 +107,8 @@ class Torrent:
 	created_by :typing.Optional[str] = None
 	comment :typing.Optional[str] = None
 	url_list :typing.Optional[typing.List[str]] = None
+	resume :typing.Optional[ResumeState] = None
+	target_files :typing.Optional[TargetFiles] = None
 	_url_index = 0
 
 	def __repr__(self) -> str:
@@ -54,77 +123,278 @@ class Torrent:
 			'url-list' : self.url_list
 		}
 
-	def close(self):
-		# Close any open queues
-		storage['torrents'][self.uuid]['peers'].close()
-		storage['torrents'][self.uuid]['chunks'].close()
+	def close(self, queues :bool = True):
+		# Close any open queues (queue.Queue() used by in-process engines has nothing to close),
+		# unless they're shared with other torrents.
+		for queue_name in ('peers', 'chunks') if queues else ():
+			if hasattr(storage['torrents'][self.uuid][queue_name], 'close'):
+				storage['torrents'][self.uuid][queue_name].close()
+
+		if self.target_files:
+			self.target_files.close()
+
+		if self.resume:
+			self.resume.save(self.target_paths)
 
-	def get_fastest_peer(self):
-		# Pop the peer-list out from thread-safe queue
-		last_output = time.time()
-		while storage['torrents'][self.uuid]['peers'].empty() is True:
-			time.sleep(random.random())
+	def get_fastest_peer(self, exclude :typing.Optional[typing.Collection[str]] = None, piece :typing.Optional[int] = None) -> typing.Optional[Peer]:
+		"""
+		Picks the seed expected to finish a piece the soonest (other than those in exclude) and marks it busy.
+		Every picked peer has to be handed back with update_score() or peer_failed().
+		Returns None if all seeds are as busy as they're allowed to be.
+		"""
+		if (target := storage['torrents'][self.uuid]['peers'].pick(exclude, piece)) is None:
+			return None
 
-			if time.time() - last_output > 15:
-				log(f"Can not get fastest peer because peer list is checked out in another thread for too long.", level=logging.WARNING, fg="orange")
-				last_output = time.time()
+		return Peer(target=target, piece=piece)
 
-		peers = storage['torrents'][self.uuid]['peers'].get(block=True)
+	def update_score(self, peer :Peer, size :int, connect_time :float, transfer_time :float, first_byte_time :typing.Optional[float] = None) -> None:
+		storage['torrents'][self.uuid]['peers'].report(peer.target, size, connect_time, transfer_time, first_byte_time, peer.piece)
 
-		priority, peers_list = peers.get_fastest_peers()
-		if len(peers_list) == 0:
-			storage['torrents'][self.uuid]['peers'].put(peers, block=True)
-			return None, None
+	def seed_timeouts(self, peer :Peer, size :int) -> Timeouts:
+		return storage['torrents'][self.uuid]['peers'].timeouts(peer.target, size)
 
-		peer_index = random.randint(0, len(peers_list)-1)
-		peer = peers_list.pop(peer_index)
+	def peer_failed(self, peer :Peer) -> None:
+		storage['torrents'][self.uuid]['peers'].report_error(peer.target, peer.piece)
 
-		# Pop the peer-list back into the thread safe queue
-		storage['torrents'][self.uuid]['peers'].put(peers, block=True)
+	def set_download_location(self, path :pathlib.Path):
+		self.download_location = path.expanduser().resolve()
 
-		return priority, peer
+	@property
+	def target_path(self) -> pathlib.Path:
+		"""
+		The file the torrent is downloaded to, or the directory its files are put in if it has several.
+		"""
+		return self.download_location / self.info.name.decode('UTF-8', errors='replace')
 
-	def update_priority(self, priority :Priority, peer :Peer):
-		# Pop the peer-list out from thread-safe queue
-		last_output = time.time()
-		while storage['torrents'][self.uuid]['peers'].empty() is True:
-			time.sleep(random.random())
-			
-			if time.time() - last_output > 15:
-				log(f"Can not update priority on peer {peer} due to stuck loop.", level=logging.WARNING, fg="orange")
-				last_output = time.time()
+	@property
+	def target_paths(self) -> typing.List[pathlib.Path]:
+		return self.info.file_index.paths(self.target_path)
 
-		peers = storage['torrents'][self.uuid]['peers'].get(block=True)
+	def open_target(self) -> TargetFiles:
+		"""
+		Opens the target for writing, preallocating every file (sparse) to its length.
+		"""
+		if self.target_files is None or self.target_files.root != self.target_path:
+			self.target_files = TargetFiles(root=self.target_path, file_index=self.info.file_index, piece_length=self.info.piece_length)
 
-		if priority not in peers:
-			peers[priority] = []
+		if self.target_files.open() and self.resume:
+			# Resizing changed the fingerprint the resume state was saved with.
+			self.resume.save(self.target_paths)
 
-		peers[priority].append(peer)
+		return self.target_files
 
-		# Pop the peer-list back into the thread safe queue
-		storage['torrents'][self.uuid]['peers'].put(peers, block=True)
+	def write_chunk(self, chunk :'Chunk') -> None:
+		"""
+		Writes a verified chunk to its place in the target and marks it in the
+		resume state. The chunk's data is released afterwards, it lives on disk from here on.
+		"""
+		from .chunk import BrokenChunk
 
-	def set_download_location(self, path :pathlib.Path):
-		self.download_location = path.expanduser().resolve()
+		if type(chunk) == BrokenChunk:
+			raise ValueError(f"Torrent.write_chunk() can only eat Chunk(), BrokenChunk() is considered damaged goods.")
+
+		if chunk.data is None:
+			return None
+
+		self.open_target().write_piece(chunk.index, chunk.data)
+		chunk.data = None
+
+		self._piece_written(chunk.index)
 
-	def verify_local_data(self) -> typing.Union['Chunk', 'BrokenChunk']:
+	def store_result(self, result :'PieceResult') -> None:
+		"""
+		Same as write_chunk() but for what a download reported back.
+		Pieces the download already wrote to the target are only marked in the resume state.
+		"""
+		if not result.ok:
+			raise ValueError(f"Torrent.store_result() can only store good pieces, got {result}.")
+
+		if not result.written:
+			if result.data is None:
+				raise ValueError(f"{result} was neither written nor carries any data.")
+
+			self.open_target().write_piece(result.index, result.data)
+			result.data = None
+			result.written = True
+
+		self._piece_written(result.index)
+
+	def _piece_written(self, index :int) -> None:
+		if self.resume:
+			self.resume.set_piece(index)
+			self.resume.flush(self.target_paths)
+
+	def load_local_data(self, workers :int = 1, recheck :bool = False) -> typing.Iterator[typing.Union['Chunk', 'BrokenChunk']]:
+		"""
+		Same as verify_local_data(), except that the resume state next to the
+		target is trusted if the target still has the size and mtime it had when the state was saved.
+		If only the mtime changed (pieces were written after the last save, e.g. before a crash),
+		the pieces the resume state has are still trusted and only the others are re-checked.
+		Otherwise the whole target is re-checked and the resume state is rebuilt from the result.
+		"""
 		from .chunk import Chunk, BrokenChunk
 
-		if (target := self.download_location / self.info.name.decode('UTF-8', errors='replace')).exists():
-			with target.open('rb') as target_file:
-				for _index in range(0, len(self.info.pieces), 20):
-					chunk_expected_hash = self.info.pieces[_index:_index+20]
-					target_data = target_file.read(self.info.piece_length)
-					chunk_actual_hash = hashlib.sha1(target_data).digest()
-
-					if chunk_expected_hash != chunk_actual_hash:
-						yield BrokenChunk(torrent=self, index=_index//20, data=None, expected_hash=chunk_expected_hash, actual_hash=chunk_actual_hash)
-					else:
-						yield Chunk(torrent=self, index=_index//20, data=target_data, expected_hash=chunk_expected_hash, actual_hash=chunk_actual_hash)
+		self.resume = ResumeState.load(self.target_path, self.info.info_hash, self.info.piece_count)
+
+		if recheck is False and self.resume.matches(self.target_paths):
+			log(f"Resuming with {self.resume.completed}/{self.info.piece_count} pieces already verified according to {self.resume.location}")
+
+			for index in range(self.info.piece_count):
+				expected_hash = self.info.piece_hash(index)
+				if self.resume.has_piece(index):
+					yield Chunk(torrent=self, index=index, data=None, expected_hash=expected_hash, actual_hash=expected_hash)
+				else:
+					yield BrokenChunk(torrent=self, index=index, data=None, expected_hash=expected_hash, actual_hash=None)
+			return
+
+		if recheck is False and self.resume.size_matches(self.target_paths):
+			missing = self.resume.missing()
+			log(f"Resuming with {self.resume.completed}/{self.info.piece_count} pieces already verified according to {self.resume.location}, re-checking the other {len(missing)}")
+
+			index = 0
+			for chunk in self.verify_local_data(workers=workers, indexes=missing):
+				for index in range(index, chunk.index):
+					yield Chunk(torrent=self, index=index, data=None, expected_hash=self.info.piece_hash(index), actual_hash=self.info.piece_hash(index))
+
+				if type(chunk) == Chunk:
+					self.resume.set_piece(chunk.index)
+				yield chunk
+				index = chunk.index + 1
+
+			for index in range(index, self.info.piece_count):
+				yield Chunk(torrent=self, index=index, data=None, expected_hash=self.info.piece_hash(index), actual_hash=self.info.piece_hash(index))
+
+			self.resume.save(self.target_paths)
+			return
+
+		self.resume.reset()
+		for chunk in self.verify_local_data(workers=workers):
+			if type(chunk) == Chunk:
+				self.resume.set_piece(chunk.index)
+			yield chunk
+
+		self.resume.save(self.target_paths)
+
+	def verify_local_data(self, workers :int = 1, indexes :typing.Optional[typing.Sequence[int]] = None) -> typing.Iterator[typing.Union['Chunk', 'BrokenChunk']]:
+		"""
+		Hashes the local copy of the torrent and yields a Chunk() for every
+		piece that matches its expected hash and a BrokenChunk() for the rest, in index order.
+		Only the pieces in indexes (in index order) are hashed if given.
+		With workers > 1 the file is memory mapped and pieces are hashed
+		in a thread pool, hashlib releases the GIL on buffers this size.
+		"""
+		from .chunk import BrokenChunk
+
+		if indexes is None:
+			indexes = range(self.info.piece_count)
+
+		if (target := self.target_path).exists() is False:
+			for index in indexes:
+				yield BrokenChunk(torrent=self, index=index, data=None, expected_hash=self.info.piece_hash(index), actual_hash=None)
+			return
+
+		started = time.time()
+		verified_bytes = 0
+
+		if self.info.is_multi_file:
+			for chunk in self._verify_files(workers, indexes):
+				verified_bytes += self.info.piece_length
+				yield chunk
 		else:
-			for _index in range(0, len(self.info.pieces), 20):
-				chunk_expected_hash = self.info.pieces[_index:_index+20]
-				yield BrokenChunk(torrent=self, index=_index//20, data=None, expected_hash=chunk_expected_hash, actual_hash=None)
+			with target.open('rb') as target_file:
+				if workers > 1 and os.fstat(target_file.fileno()).st_size > 0:
+					verified = self._verify_mapped(target_file, workers, indexes)
+				else:
+					verified = self._verify_sequential(target_file, indexes)
+
+				for chunk in verified:
+					verified_bytes += self.info.piece_length
+					yield chunk
+
+		verified_bytes = min(verified_bytes, self.info.length)
+		elapsed = max(time.time() - started, 0.000001)
+		metrics.VERIFY_BYTES.inc(verified_bytes)
+		metrics.VERIFY_SECONDS.inc(elapsed)
+		log(f"Verified {verified_bytes / 1024 / 1024:.2f}MB of local data in {elapsed:.2f}s ({verified_bytes / 1024 / 1024 / elapsed:.2f}MB/s, {max(workers, 1)} worker(s))")
+
+	def _verified_chunk(self, index :int, actual_hash :bytes) -> typing.Union['Chunk', 'BrokenChunk']:
+		from .chunk import Chunk, BrokenChunk
+
+		expected_hash = self.info.piece_hash(index)
+		if expected_hash != actual_hash:
+			return BrokenChunk(torrent=self, index=index, data=None, expected_hash=expected_hash, actual_hash=actual_hash)
+
+		# Verified pieces are already on disk, there's no need to keep their data around.
+		return Chunk(torrent=self, index=index, data=None, expected_hash=expected_hash, actual_hash=actual_hash)
+
+	def _verify_sequential(self, target_file :typing.BinaryIO, indexes :typing.Sequence[int]) -> typing.Iterator[typing.Union['Chunk', 'BrokenChunk']]:
+		position = 0
+		for index in indexes:
+			if index != position:
+				target_file.seek(index * self.info.piece_length)
+			position = index + 1
+			yield self._verified_chunk(index, hashlib.sha1(target_file.read(self.info.piece_length)).digest())
+
+	def _verify_mapped(self, target_file :typing.BinaryIO, workers :int, indexes :typing.Sequence[int]) -> typing.Iterator[typing.Union['Chunk', 'BrokenChunk']]:
+		def sha1_range(start :int, end :int) -> bytes:
+			with view[start:end] as piece:
+				return hashlib.sha1(piece).digest()
+
+		# Keep a bounded window of pieces in flight so we can yield
+		# in index order without hashing the whole file up front.
+		in_flight = collections.deque()
+		with mmap.mmap(target_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+			concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+
+			view = memoryview(mapped)
+			try:
+				for index in indexes:
+					start = index * self.info.piece_length
+					end = start + self.info.piece_length
+					in_flight.append((index, pool.submit(sha1_range, start, end)))
+
+					if len(in_flight) >= workers * 4:
+						index, future = in_flight.popleft()
+						yield self._verified_chunk(index, future.result())
+
+				while in_flight:
+					index, future = in_flight.popleft()
+					yield self._verified_chunk(index, future.result())
+			finally:
+				for index, future in in_flight:
+					future.cancel()
+				concurrent.futures.wait([future for index, future in in_flight])
+				in_flight.clear()
+				view.release()
+
+	def _verify_files(self, workers :int, indexes :typing.Sequence[int]) -> typing.Iterator[typing.Union['Chunk', 'BrokenChunk']]:
+		# Pieces of multi-file torrents can span several files, so they're read with
+		# pread() through the file index instead. Missing files make their pieces come up short.
+		target_files = TargetFiles(root=self.target_path, file_index=self.info.file_index, piece_length=self.info.piece_length)
+		workers = max(workers, 1)
+
+		def sha1_piece(index :int) -> bytes:
+			return hashlib.sha1(target_files.read_piece(index, self.info.piece_size(index))).digest()
+
+		in_flight = collections.deque()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+			try:
+				for index in indexes:
+					in_flight.append((index, pool.submit(sha1_piece, index)))
+
+					if len(in_flight) >= workers * 4:
+						index, future = in_flight.popleft()
+						yield self._verified_chunk(index, future.result())
+
+				while in_flight:
+					index, future = in_flight.popleft()
+					yield self._verified_chunk(index, future.result())
+			finally:
+				for index, future in in_flight:
+					future.cancel()
+				concurrent.futures.wait([future for index, future in in_flight])
+				in_flight.clear()
+				target_files.close()
 
 	def next_seed(self):
 		target = self.url_list[self._url_index % len(self.url_list)]
@@ -135,11 +405,12 @@ class Torrent:
 		return random.choice(self.url_list).decode('UTF-8', errors='replace')
 
 	def feed(self, chunks :typing.List['Chunk']):
-		from .chunk import BrokenChunk
+		"""
+		Writes every Chunk() that still holds data to the target,
+		chunks without data are assumed to already be on disk.
+		"""
+		for chunk in sorted(chunks, key=lambda chunk_obj: chunk_obj.index):
+			self.write_chunk(chunk)
 
-		with (self.download_location/self.info.name.decode('UTF-8', errors='replace')).open('wb') as destination_file:
-			for chunk in sorted(chunks, key=lambda chunk_obj: chunk_obj.index):
-				if type(chunk) == BrokenChunk:
-					raise ValueError(f"Torrent.feed() can only eat Chunk(), BrokenChunk() is considered damaged goods.")
-				
-				destination_file.write(chunk.data)
\ No newline at end of file
+		if self.resume:
+			self.resume.save(self.target_paths)
@@ -0,0 +1,14 @@
+from .pool import (
+	ConnectionPool,
+	HTTPConnectionPool,
+	PoolExhausted,
+	http_pool
+)
+
+from .ratelimit import (
+	TokenBucket,
+	Shaper,
+	RateLimits,
+	rate_limits,
+	seed_host
+)
\ No newline at end of file
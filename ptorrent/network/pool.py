@@ -0,0 +1,184 @@
+import os
+import time
+import select
+import typing
+import logging
+import threading
+import collections
+import http.client
+import urllib.parse
+from ..storage import storage
+from ..logger import log
+
+class PoolExhausted(Exception):
+	pass
+
+class ConnectionPool:
+	"""
+	Keeps idle keep-alive connections around per seed (scheme + netloc),
+	so consecutive requests to the same web seed can skip the TCP/TLS handshake.
+	Connections are borrowed with checkout() and handed back with checkin(),
+	or discard() if they are no longer usable.
+
+	Subclasses decide what a connection is by implementing
+	_is_alive() and _close() (and whatever creates them).
+	"""
+	def __init__(self, max_per_host :int = 8, idle_timeout :float = 30.0):
+		self.max_per_host = max_per_host
+		self.idle_timeout = idle_timeout
+
+		self.created = 0
+		self.reused = 0
+		self.pid = os.getpid()
+
+		self._idle :typing.Dict[str, typing.Deque[typing.Tuple[typing.Any, float]]] = collections.defaultdict(collections.deque)
+		self._open :typing.Dict[str, int] = collections.defaultdict(int)
+		self._lock = threading.Condition()
+
+	@staticmethod
+	def key_for(url :urllib.parse.ParseResult) -> str:
+		return f"{url.scheme}://{url.netloc}"
+
+	@property
+	def reuse_rate(self) -> float:
+		if self.created + self.reused == 0:
+			return 0.0
+		return self.reused / (self.created + self.reused)
+
+	def stats(self) -> str:
+		return f"{self.created} connection(s) opened, {self.reused} reused ({self.reuse_rate * 100:.1f}% reuse)"
+
+	def _is_alive(self, connection :typing.Any) -> bool:
+		raise NotImplementedError()
+
+	def _close(self, connection :typing.Any) -> None:
+		raise NotImplementedError()
+
+	def checkout(self, key :str) -> typing.Optional[typing.Any]:
+		"""
+		Returns an idle connection to key that is still alive, or None if there is none.
+		When None is returned and reserve() says so, the caller opens a new connection.
+		"""
+		with self._lock:
+			idle = self._idle[key]
+			while idle:
+				connection, last_used = idle.pop()
+
+				if time.monotonic() - last_used < self.idle_timeout and self._is_alive(connection):
+					self.reused += 1
+					return connection
+
+				self._forget(key, connection)
+
+		return None
+
+	def reserve(self, key :str, timeout :typing.Optional[float] = None) -> None:
+		"""
+		Reserves room for a new connection to key, waiting up to timeout
+		for one to be freed if there are already max_per_host open.
+		"""
+		with self._lock:
+			if not self._lock.wait_for(lambda: self._open[key] < self.max_per_host or len(self._idle[key]), timeout=timeout):
+				raise PoolExhausted(f"There are already {self.max_per_host} connections open to {key}")
+
+			# Rather close an idle connection than to exceed the limit.
+			if self._open[key] >= self.max_per_host:
+				connection, last_used = self._idle[key].popleft()
+				self._forget(key, connection)
+
+			self._open[key] += 1
+			self.created += 1
+
+	def checkin(self, key :str, connection :typing.Any) -> None:
+		with self._lock:
+			self._idle[key].append((connection, time.monotonic()))
+			self._lock.notify()
+
+	def discard(self, key :str, connection :typing.Any) -> None:
+		with self._lock:
+			self._forget(key, connection)
+			self._lock.notify()
+
+	def _forget(self, key :str, connection :typing.Optional[typing.Any]) -> None:
+		self._open[key] = max(self._open[key] - 1, 0)
+		if connection is None:
+			# Only a reservation, the connection was never opened.
+			return None
+
+		try:
+			self._close(connection)
+		except Exception:
+			pass
+
+	def evict_idle(self) -> None:
+		now = time.monotonic()
+		with self._lock:
+			for key, idle in self._idle.items():
+				for connection, last_used in [entry for entry in idle if now - entry[1] >= self.idle_timeout]:
+					idle.remove((connection, last_used))
+					self._forget(key, connection)
+			self._lock.notify_all()
+
+	def close(self) -> None:
+		with self._lock:
+			for key, idle in self._idle.items():
+				while idle:
+					connection, last_used = idle.pop()
+					self._forget(key, connection)
+			self._lock.notify_all()
+
+		if storage['arguments'].debug:
+			log(f"Connection pool closed: {self.stats()}", level=logging.INFO, fg="gray")
+
+class HTTPConnectionPool(ConnectionPool):
+	"""
+	A ConnectionPool of http.client connections, used by BrokenChunk.download().
+	"""
+	def connect(self, url :urllib.parse.ParseResult, timeout :float) -> typing.Tuple[http.client.HTTPConnection, bool]:
+		"""
+		Returns a pooled connection to url's seed if there's one, otherwise a new one.
+		The second value tells if the connection was reused.
+		"""
+		key = self.key_for(url)
+		if (connection := self.checkout(key)) is not None:
+			connection.timeout = timeout
+			if connection.sock is not None:
+				connection.sock.settimeout(timeout)
+			return connection, True
+
+		self.reserve(key, timeout=timeout)
+		if url.scheme == 'https':
+			return http.client.HTTPSConnection(url.hostname, url.port, timeout=timeout), False
+		elif url.scheme == 'http':
+			return http.client.HTTPConnection(url.hostname, url.port, timeout=timeout), False
+
+		self.discard(key, None)
+		raise ValueError(f"Unknown schema: {url.scheme}")
+
+	def _is_alive(self, connection :http.client.HTTPConnection) -> bool:
+		if connection.sock is None:
+			# Not connected yet (or closed by http.client), it will (re)connect on the next request.
+			return True
+
+		# An idle keep-alive connection should have nothing to read.
+		# If it's readable, the server either closed it (EOF) or sent something we didn't ask for.
+		try:
+			readable, _, _ = select.select([connection.sock], [], [], 0)
+		except (OSError, ValueError):
+			return False
+
+		return not readable
+
+	def _close(self, connection :http.client.HTTPConnection) -> None:
+		connection.close()
+
+def http_pool() -> HTTPConnectionPool:
+	"""
+	Returns the HTTPConnectionPool of the current process.
+	Worker processes inherit storage from their parent, but must never share its sockets.
+	"""
+	if (pool := storage.get('http_pool')) is None or pool.pid != os.getpid():
+		pool = HTTPConnectionPool()
+		storage['http_pool'] = pool
+
+	return pool
@@ -0,0 +1,201 @@
+import time
+import typing
+import urllib.parse
+import multiprocessing
+from ..storage import storage
+
+# Rate limits are enforced where the body is read (see read_into() and fetch_range()):
+# after every block the reader sleeps off what it took beyond the limits. The socket
+# buffer fills up in the meantime, and TCP flow control slows the seed down for us.
+
+# How many bytes may be taken at once after a quiet period, in seconds of the rate
+BURST_SECONDS = 0.25
+MINIMUM_BURST = 64 * 1024
+
+# How far ahead of a limit it's worth requesting, in seconds of the rate. Anything requested
+# beyond that only waits in the buckets, and makes every piece take that much longer.
+BACKLOG_SECONDS = 1.0
+
+RATE, BURST, TOKENS, UPDATED = range(4)
+
+def format_rate(rate :float) -> str:
+	return f"{rate / 1024 / 1024:.2f}MB/s" if rate else "unlimited"
+
+def seed_host(target :str) -> str:
+	return urllib.parse.urlparse(target).netloc.lower()
+
+class TokenBucket:
+	"""
+	Hands out rate bytes/s, letting up to burst bytes through at once after a quiet period.
+	A rate of 0 is unlimited. The state lives in shared memory, so the bucket is shared
+	with every process forked after it was created, and set_rate() applies to all of them.
+
+	Takers run into debt rather than waiting for tokens to be available, and reserve() tells
+	them how long to sleep it off. Whoever asks first is served first, so everything that
+	takes from the same bucket in blocks of the same size gets the same share of it.
+	"""
+	def __init__(self, rate :float = 0.0, burst :typing.Optional[float] = None):
+		self._state = multiprocessing.RawArray('d', 4)
+		self._lock = multiprocessing.Lock()
+		self.set_rate(rate, burst)
+
+	@property
+	def rate(self) -> float:
+		return self._state[RATE]
+
+	@property
+	def burst(self) -> float:
+		return self._state[BURST]
+
+	def set_rate(self, rate :float, burst :typing.Optional[float] = None) -> None:
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+
+			self._state[RATE] = max(float(rate), 0.0)
+			self._state[BURST] = float(burst) if burst else max(self._state[RATE] * BURST_SECONDS, MINIMUM_BURST)
+			self._state[TOKENS] = min(self._state[TOKENS], self._state[BURST]) if rate else 0.0
+			self._state[UPDATED] = now
+
+	def _refill(self, now :float) -> None:
+		if self._state[RATE] > 0:
+			self._state[TOKENS] = min(self._state[BURST], self._state[TOKENS] + (now - self._state[UPDATED]) * self._state[RATE])
+		self._state[UPDATED] = now
+
+	def reserve(self, size :int) -> float:
+		"""
+		Takes size bytes, and returns how many seconds to wait before taking more.
+		"""
+		if self._state[RATE] <= 0:
+			return 0.0
+
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			self._state[TOKENS] -= size
+
+			if self._state[TOKENS] >= 0 or self._state[RATE] <= 0:
+				return 0.0
+			return -self._state[TOKENS] / self._state[RATE]
+
+	def describe(self) -> str:
+		return format_rate(self.rate)
+
+class Shaper:
+	"""
+	What a request reads with, see RateLimits.shaper(). Called with the bytes just read, it takes
+	them from every bucket they count against and returns how many seconds to wait before reading more.
+	The rates are looked at on every call, so limits changed while the request runs apply to it right away.
+	"""
+	def __init__(self, buckets :typing.List[TokenBucket]):
+		self.buckets = buckets
+
+	@property
+	def limited(self) -> bool:
+		return any(bucket.rate for bucket in self.buckets)
+
+	def __call__(self, size :int) -> float:
+		return max(bucket.reserve(size) for bucket in self.buckets)
+
+class RateLimits:
+	"""
+	The buckets every downloaded byte is taken from: one for everything,
+	one per torrent and one per seed host (host:port, as connections are pooled per seed).
+	New torrent and seed buckets get torrent_rate and seed_rate.
+
+	Buckets have to exist before the worker processes are forked to be shared with them,
+	so the coordinator creates them with register() as soon as a torrent is loaded.
+	Worker processes that come across a seed nobody registered create a bucket of their own.
+	"""
+	def __init__(self, rate :float = 0.0, torrent_rate :float = 0.0, seed_rate :float = 0.0):
+		self.total = TokenBucket(rate)
+		self.torrent_rate = torrent_rate
+		self.seed_rate = seed_rate
+		self.torrents :typing.Dict[typing.Any, TokenBucket] = {}
+		self.seeds :typing.Dict[str, TokenBucket] = {}
+
+	def torrent(self, torrent_uuid :typing.Any) -> TokenBucket:
+		if (bucket := self.torrents.get(torrent_uuid)) is None:
+			bucket = self.torrents[torrent_uuid] = TokenBucket(self.torrent_rate)
+		return bucket
+
+	def seed(self, host :str) -> TokenBucket:
+		if (bucket := self.seeds.get(host)) is None:
+			bucket = self.seeds[host] = TokenBucket(self.seed_rate)
+		return bucket
+
+	def register(self, torrent_uuid :typing.Any, seeds :typing.Iterable[str]) -> None:
+		self.torrent(torrent_uuid)
+		for target in seeds:
+			self.seed(seed_host(target))
+
+	def forget(self, torrent_uuid :typing.Any) -> None:
+		self.torrents.pop(torrent_uuid, None)
+
+	def set_torrent_rate(self, rate :float, torrent_uuid :typing.Optional[typing.Any] = None) -> None:
+		"""
+		Limits a single torrent, or every torrent (including those loaded later) if none is given.
+		"""
+		if torrent_uuid is not None:
+			return self.torrent(torrent_uuid).set_rate(rate)
+
+		self.torrent_rate = rate
+		for bucket in self.torrents.values():
+			bucket.set_rate(rate)
+
+	def set_seed_rate(self, rate :float, host :typing.Optional[str] = None) -> None:
+		"""
+		Limits a single seed host, or every one of them (including those seen later) if none is given.
+		"""
+		if host is not None:
+			return self.seed(host).set_rate(rate)
+
+		self.seed_rate = rate
+		for bucket in self.seeds.values():
+			bucket.set_rate(rate)
+
+	def limited(self, torrent_uuid :typing.Any, host :str) -> bool:
+		return bool(self.total.rate or self.torrent(torrent_uuid).rate or self.seed(host).rate)
+
+	def reserve(self, size :int, torrent_uuid :typing.Any, host :str) -> float:
+		"""
+		Takes size bytes from every bucket they count against, and returns how many seconds to wait before reading more.
+		"""
+		return max(self.total.reserve(size), self.torrent(torrent_uuid).reserve(size), self.seed(host).reserve(size))
+
+	def shaper(self, torrent_uuid :typing.Any, host :str) -> Shaper:
+		return Shaper([self.total, self.torrent(torrent_uuid), self.seed(host)])
+
+	def backlog(self, torrent_uuid :typing.Optional[typing.Any] = None) -> typing.Optional[float]:
+		"""
+		How many bytes are worth having requested at a time (BACKLOG_SECONDS of the tightest limit),
+		of a torrent, or without one of every torrent together. None if nothing limits them.
+		Seed limits are left out, the other seeds can take up what a limited one doesn't.
+		"""
+		rates = [self.total.rate]
+		if torrent_uuid is not None:
+			rates.append(self.torrent(torrent_uuid).rate)
+
+		if not (rates := [rate for rate in rates if rate > 0]):
+			return None
+		return min(rates) * BACKLOG_SECONDS
+
+	def status(self) -> typing.Dict[str, typing.Any]:
+		return {
+			'total' : self.total.rate,
+			'torrent' : self.torrent_rate,
+			'seed' : self.seed_rate,
+			'torrents' : {str(torrent_uuid) : bucket.rate for torrent_uuid, bucket in self.torrents.items() if bucket.rate != self.torrent_rate},
+			'seeds' : {host : bucket.rate for host, bucket in self.seeds.items() if bucket.rate != self.seed_rate}
+		}
+
+	def describe(self) -> str:
+		return f"total {self.total.describe()}, per torrent {format_rate(self.torrent_rate)}, per seed {format_rate(self.seed_rate)}"
+
+def rate_limits() -> RateLimits:
+	"""
+	The RateLimits of the coordinator, inherited by the worker processes forked from it.
+	"""
+	if (limits := storage.get('rate_limits')) is None:
+		limits = storage['rate_limits'] = RateLimits()
+	return limits
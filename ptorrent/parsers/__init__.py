@@ -1,5 +1,9 @@
 from .torrent import (
 	load_torrent,
-	parse_torrent
+	open_torrent,
+	parse_torrent,
+	read_torrent,
+	torrent_encode
 )
+from .size import parse_size
 from .jsonizer import JSON
\ No newline at end of file
@@ -0,0 +1,90 @@
+import os
+import pathlib
+import hashlib
+import typing
+import logging
+from ..storage import storage
+from ..logger import log
+
+# Layout of a cache entry:
+#   <bencoded header dictionary><raw piece-hash table>
+# The header holds the fingerprint of the source .torrent (path, size, mtime)
+# and everything parse_torrent() returned except info['pieces'], which is
+# stored verbatim after the header so it can be sliced out without decoding.
+CACHE_VERSION = 1
+
+def cache_directory() -> pathlib.Path:
+	return pathlib.Path(storage.get('CACHE_PATH', '~/.cache/ptorrent')).expanduser()
+
+def cache_location(path :pathlib.Path) -> pathlib.Path:
+	return cache_directory() / f"{hashlib.sha1(str(path).encode('UTF-8')).hexdigest()}.torrent-cache"
+
+def load_cached_torrent(path :pathlib.Path) -> typing.Optional[typing.Dict[str, typing.Any]]:
+	"""
+	Returns the same structure as read_torrent() would for path,
+	or None if there is no cache entry matching the current size and mtime of path.
+	"""
+	from .torrent import torrent_data_to_dict
+
+	try:
+		source_stat = path.stat()
+		with cache_location(path).open('rb') as fh:
+			data = memoryview(fh.read())
+
+		header, pieces_start = torrent_data_to_dict(data, 0)
+	except (OSError, ValueError):
+		return None
+
+	if header.get('version') != CACHE_VERSION \
+		or header.get('source') != str(path).encode('UTF-8') \
+		or header.get('size') != source_stat.st_size \
+		or header.get('mtime_ns') != source_stat.st_mtime_ns:
+		return None
+
+	if len(data) - pieces_start != header.get('pieces_length'):
+		return None
+
+	result = header['torrent']
+	result['info']['pieces'] = data[pieces_start:].tobytes()
+
+	if getattr(storage.get('arguments'), 'debug', False):
+		log(f"Loaded cached metadata for {path}", level=logging.INFO, fg="gray")
+
+	return result
+
+def store_cached_torrent(path :pathlib.Path, result :typing.Dict[str, typing.Any]) -> None:
+	from .torrent import torrent_encode
+
+	if type(result.get('info')) != dict or type(result['info'].get('pieces')) != bytes:
+		return None
+
+	pieces = result['info']['pieces']
+	location = cache_location(path)
+	temporary_location = location.with_suffix(f".{os.getpid()}.tmp")
+
+	try:
+		source_stat = path.stat()
+		header = torrent_encode({
+			'version' : CACHE_VERSION,
+			'source' : str(path),
+			'size' : source_stat.st_size,
+			'mtime_ns' : source_stat.st_mtime_ns,
+			'pieces_length' : len(pieces),
+			'torrent' : {
+				**result,
+				'info' : {key: val for key, val in result['info'].items() if key != 'pieces'}
+			}
+		})
+
+		location.parent.mkdir(exist_ok=True, parents=True)
+		with temporary_location.open('wb') as fh:
+			fh.write(header)
+			fh.write(pieces)
+
+		os.replace(temporary_location, location)
+	except (OSError, ValueError) as error:
+		log(f"Could not cache metadata for {path}: {error}", level=logging.WARNING, fg="orange")
+		try:
+			temporary_location.unlink()
+		except OSError:
+			pass
@@ -0,0 +1,10 @@
+SIZE_SUFFIXES = {'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3}
+
+def parse_size(value :str) -> int:
+	"""
+	Turns "64M", "256K" or "1048576" into bytes.
+	"""
+	value = value.strip().upper().removesuffix('B').removesuffix('I')
+	if value and value[-1] in SIZE_SUFFIXES:
+		return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+	return int(float(value))
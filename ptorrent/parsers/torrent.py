@@ -1,137 +1,243 @@
 import pathlib
 import typing
+import hashlib
 import json
 import multiprocessing
 import random
 import uuid
 from .jsonizer import JSON
-from ..models import Torrent, TorrentInfo, Peers, Peer, Priority
+from .cache import load_cached_torrent, store_cached_torrent
+from ..models import Torrent, TorrentInfo, Scoreboard
 from ..storage import storage
 
-def torrent_data_to_string(data :bytes) -> typing.Tuple[bytes, int]:
-	if data[:1].isdigit() is False:
-		raise ValueError(f"torrent_data_to_string() requires first part to be digits only, got: {data[:1]}")
+# The decoder walks a single memoryview using integer offsets.
+# Every torrent_data_to_*() takes the view and the offset where its value
+# starts, and returns the decoded value together with the offset directly
+# after it. Only the final string values are copied out of the buffer.
+BENCODE_DICT = ord('d')
+BENCODE_LIST = ord('l')
+BENCODE_INTEGER = ord('i')
+BENCODE_END = ord('e')
+BENCODE_SEPARATOR = ord(':')
+BENCODE_DIGITS = frozenset(b'0123456789')
 
-	_index = 0
-	_index += len(string_length := data[_index:].split(b':', 1)[0])+1
-	_index += len(string := data[_index:_index+int(string_length)])
-	return string, _index
+def _as_view(data :typing.Union[bytes, bytearray, memoryview]) -> memoryview:
+	if isinstance(data, memoryview):
+		return data
+	return memoryview(data)
 
-def torrent_data_to_integer(data :bytes) -> typing.Tuple[int, int]:
-	if data[:1] != b'i':
-		raise ValueError(f"torrent_data_to_integer() requires first part to be 'i', got: {data[:1]}")
+def _first_byte(data :memoryview, _index :int) -> bytes:
+	return data[_index:_index+1].tobytes()
 
-	integer_end_pos = data.find(b'e')
-	if integer_end_pos == -1:
+def torrent_data_to_string(data :memoryview, _index :int = 0) -> typing.Tuple[bytes, int]:
+	data = _as_view(data)
+
+	if _index >= len(data) or data[_index] not in BENCODE_DIGITS:
+		raise ValueError(f"torrent_data_to_string() requires first part to be digits only, got: {_first_byte(data, _index)!r}")
+
+	length_end = _index
+	while length_end < len(data) and data[length_end] in BENCODE_DIGITS:
+		length_end += 1
+
+	if length_end >= len(data) or data[length_end] != BENCODE_SEPARATOR:
+		raise ValueError(f"Could not reliably determaine the string length at offset {_index}, expected b':' after the digits but found {_first_byte(data, length_end)!r}")
+
+	string_start = length_end + 1
+	string_end = string_start + int(data[_index:length_end].tobytes())
+	if string_end > len(data):
+		raise ValueError(f"String at offset {_index} claims {string_end - string_start} bytes but only {len(data) - string_start} remain.")
+
+	return data[string_start:string_end].tobytes(), string_end
+
+def torrent_data_to_integer(data :memoryview, _index :int = 0) -> typing.Tuple[int, int]:
+	data = _as_view(data)
+
+	if _index >= len(data) or data[_index] != BENCODE_INTEGER:
+		raise ValueError(f"torrent_data_to_integer() requires first part to be 'i', got: {_first_byte(data, _index)!r}")
+
+	integer_end = _index + 1
+	while integer_end < len(data) and data[integer_end] != BENCODE_END:
+		integer_end += 1
+
+	if integer_end >= len(data):
 		raise ValueError(f"Could not reliably determaine the end of the integer, expected b'e' at some point but could not find it.")
 
-	integer = data[1:integer_end_pos]
+	return int(data[_index+1:integer_end].tobytes()), integer_end+1
 
-	return int(integer), integer_end_pos+1
+def torrent_data_to_value(data :memoryview, _index :int = 0) -> typing.Tuple[typing.Any, int]:
+	data = _as_view(data)
 
-def torrent_data_to_list(data :bytes) -> typing.Tuple[int, int]:
-	if data[:1] != b'l':
-		raise ValueError(f"torrent_data_to_integer() requires first part to be 'l', got: {data[:1]}")
+	if _index >= len(data):
+		raise ValueError(f"Unexpected end of data at offset {_index}, expected a value.")
 
-	result = []
-	_index = 1
-	while _index <= len(data) and data[_index:_index+1] != b'e':
-		_index += len(value_length := data[_index:].split(b':', 1)[0])+1
-		_index += len(value := data[_index:_index+int(value_length)])
+	first_byte = data[_index]
+	if first_byte == BENCODE_DICT:
+		return torrent_data_to_dict(data, _index)
+	elif first_byte == BENCODE_LIST:
+		return torrent_data_to_list(data, _index)
+	elif first_byte == BENCODE_INTEGER:
+		return torrent_data_to_integer(data, _index)
+	elif first_byte in BENCODE_DIGITS:
+		return torrent_data_to_string(data, _index)
+
+	raise ValueError(f"Could not interpret {_first_byte(data, _index)!r} at offset {_index}")
+
+def torrent_data_to_list(data :memoryview, _index :int = 0) -> typing.Tuple[typing.List[typing.Any], int]:
+	data = _as_view(data)
 
+	if _index >= len(data) or data[_index] != BENCODE_LIST:
+		raise ValueError(f"torrent_data_to_list() requires first part to be 'l', got: {_first_byte(data, _index)!r}")
+
+	result = []
+	_index += 1
+	while _index < len(data) and data[_index] != BENCODE_END:
+		value, _index = torrent_data_to_value(data, _index)
 		result.append(value)
 
-	if data[_index:_index+1] != b'e':
-		raise ValueError(f"Could not reliably determaine the end of the dictionary, expected b'e' but found {data[_index:_index+1]!r}")
+	if _index >= len(data):
+		raise ValueError(f"Could not reliably determaine the end of the list, expected b'e' but reached the end of data.")
 
 	return result, _index+1
 
-def torrent_data_to_dict(data :bytes):
-	if data[:1] != b'd':
-		raise ValueError(f"Data is not a torrent dictionary, expected first byte to be b'd', but got {data[:1]!r}")
+def torrent_data_to_dict(data :memoryview, _index :int = 0, spans :typing.Optional[typing.Dict[str, typing.Tuple[int, int]]] = None) -> typing.Tuple[typing.Dict[str, typing.Any], int]:
+	"""
+	Decodes a dictionary starting at _index.
+	If spans is given, the (start, end) offsets of every value in this
+	dictionary are stored in it under the same key as the value.
+	"""
+	data = _as_view(data)
+
+	if _index >= len(data) or data[_index] != BENCODE_DICT:
+		raise ValueError(f"Data is not a torrent dictionary, expected first byte to be b'd', but got {_first_byte(data, _index)!r}")
 
 	result = {}
-	_index = 1
-	while _index <= len(data) and data[_index:_index+1] != b'e':
-		_index += len(key_length := data[_index:].split(b':', 1)[0])+1
-		_index += len(key := data[_index:_index+int(key_length)])
-
-		match (first_byte := data[_index:_index+1]):
-			case b'd':
-				value, _index_moved = torrent_data_to_dict(data[_index:])
-			case b'l':
-				value, _index_moved = torrent_data_to_list(data[_index:])
-			case b'i':
-				value, _index_moved = torrent_data_to_integer(data[_index:])
-			case _:
-				if first_byte.isdigit():
-					value, _index_moved = torrent_data_to_string(data[_index:])
-				else:
-					raise ValueError(f"Could not interpret {first_byte}")
-		_index += _index_moved
-
-		# _index += len(value_length := data[_index:].split(b':', 1)[0])+1
-		# _index += len(value := data[_index:_index+int(value_length)])
-
-		result[key.decode('UTF-8').replace(' ', '_').replace('-', '_')] = value
-
-	if data[_index:_index+1] != b'e':
-		raise ValueError(f"Could not reliably determaine the end of the dictionary, expected b'e' but found {data[_index:_index+1]!r}")
+	_index += 1
+	while _index < len(data) and data[_index] != BENCODE_END:
+		key, _index = torrent_data_to_string(data, _index)
+		key = key.decode('UTF-8').replace(' ', '_').replace('-', '_')
+
+		value_start = _index
+		value, _index = torrent_data_to_value(data, _index)
+
+		result[key] = value
+		if spans is not None:
+			spans[key] = (value_start, _index)
+
+	if _index >= len(data):
+		raise ValueError(f"Could not reliably determaine the end of the dictionary, expected b'e' but reached the end of data.")
 
 	return result, _index+1
 
-def parse_torrent(data :bytes) -> typing.Any:
-	first_byte = data[0:1]
+def parse_torrent(data :typing.Union[bytes, memoryview], spans :typing.Optional[typing.Dict[str, typing.Tuple[int, int]]] = None) -> typing.Any:
+	"""
+	Decodes a bencoded torrent in a single pass without copying the remaining data.
+	If spans is given and the torrent is a dictionary, the raw (start, end) offsets of
+	each top level value are stored in it. data[slice(*spans['info'])] is the
+	exact info dictionary as it was encoded, which is what the info-hash is calculated on.
+	"""
+	data = _as_view(data)
+
+	first_byte = _first_byte(data, 0)
 	if first_byte not in (b'd', b'l', b'i') and first_byte.isdigit() is False:
 		raise ValueError(f"Improper encoding on torrent file staart, expected d, l, i or number but got: {first_byte!r}")
 
-	_index = 0
-	while _index <= len(data):
-		match (first_byte := data[_index:_index+1]):
-			case b'd':
-				result, _index_moved = torrent_data_to_dict(data)
-			case b'l':
-				result, _index_moved = torrent_data_to_list(data)
-			case b'i':
-				result, _index_moved = torrent_data_to_integer(data)
-			case _:
-				if first_byte.isdigit():
-					value, _index_moved = torrent_data_to_string(data[_index:])
-				elif len(first_byte) == 0:
-					break
-				else:
-					raise ValueError(f"Could not interpret {first_byte}")
-
-		_index += _index_moved
+	if data[0] == BENCODE_DICT:
+		result, _index = torrent_data_to_dict(data, 0, spans=spans)
+	else:
+		result, _index = torrent_data_to_value(data, 0)
 
 	return result
 
+def torrent_encode(value :typing.Any) -> bytes:
+	"""
+	Bencodes value, the reverse of parse_torrent().
+	str keys and values are encoded as UTF-8 and dictionaries are
+	written with their keys sorted as raw bytes, as the spec requires.
+	"""
+	parts = []
+	_encode_into(value, parts)
+	return b''.join(parts)
+
+def _encode_into(value :typing.Any, parts :typing.List[bytes]) -> None:
+	if isinstance(value, bool):
+		raise ValueError(f"torrent_encode() can not encode booleans, got: {value!r}")
+	elif isinstance(value, int):
+		parts.append(b'i%de' % value)
+	elif isinstance(value, (bytes, bytearray, memoryview, str)):
+		if isinstance(value, str):
+			value = value.encode('UTF-8')
+		parts.append(b'%d:' % len(value))
+		parts.append(bytes(value))
+	elif isinstance(value, (list, tuple)):
+		parts.append(b'l')
+		for item in value:
+			_encode_into(item, parts)
+		parts.append(b'e')
+	elif isinstance(value, dict):
+		encoded_keys = {(key.encode('UTF-8') if isinstance(key, str) else bytes(key)): val for key, val in value.items()}
+
+		parts.append(b'd')
+		for key in sorted(encoded_keys):
+			_encode_into(key, parts)
+			_encode_into(encoded_keys[key], parts)
+		parts.append(b'e')
+	elif hasattr(value, '__bencode__'):
+		_encode_into(value.__bencode__(), parts)
+	else:
+		raise ValueError(f"torrent_encode() does not know how to encode {type(value)}")
+
+def read_torrent(path :pathlib.Path) -> typing.Dict[str, typing.Any]:
+	"""
+	Parses the torrent at path and calculates the info-hash
+	from the raw info dictionary, which is stored as info['info_hash'].
+	"""
+	with path.open('rb') as fh:
+		data = fh.read()
+
+	spans = {}
+	result = parse_torrent(data, spans=spans)
+
+	if type(result.get('info')) == dict and 'info' in spans:
+		result['info']['info_hash'] = hashlib.sha1(memoryview(data)[slice(*spans['info'])]).digest()
 
-def load_torrent(path :pathlib.Path, chunks :multiprocessing.queues.Queue, peers:multiprocessing.queues.Queue) -> Torrent:
+	return result
+
+def open_torrent(path :pathlib.Path, use_cache :bool = True) -> typing.Dict[str, typing.Any]:
+	"""
+	Reads the torrent at path (or its cached metadata) without registering it anywhere, see load_torrent().
+	"""
 	if (actual_path := path.expanduser().resolve()).exists() is False:
 		raise FileNotFoundError(f"Could not locate Torrent {actual_path}")
 
-	with actual_path.open('rb') as fh:
-		data = fh.read()
+	result = None
+	if use_cache:
+		result = load_cached_torrent(actual_path)
+
+	if result is None:
+		result = read_torrent(actual_path)
 
-	result = parse_torrent(data)
+		if use_cache:
+			store_cached_torrent(actual_path, result)
 
 	if result.get('info'):
 		result['info'] = TorrentInfo(**result['info'])
 
-	Peers, Peer, Priority
+	return result
+
+def load_torrent(path :pathlib.Path, chunks :multiprocessing.queues.Queue, peers :Scoreboard, use_cache :bool = True, opened :typing.Optional[typing.Dict[str, typing.Any]] = None) -> Torrent:
+	"""
+	Registers the torrent at path in storage['torrents'] and returns its uuid.
+	opened is what open_torrent() returned for it, if it was already read.
+	"""
+	result = opened if opened is not None else open_torrent(path, use_cache)
 
-	peer_handle = Peers()
-	peer_handle.init()
 	peer_list_unsorted = [*result['url_list']]
 
+	# Seeds without any measurements yet are tried in the order they were added
 	random.shuffle(peer_list_unsorted)
 	for dl_location in peer_list_unsorted:
-		peer = Peer(target=dl_location.decode('UTF-8', errors='replace'))
-		prio = Priority(connectivity=1, chunk_speed=1)
-		peer_handle.add_peer(priority=prio, peer=peer)
-	
-	peers.put(peer_handle)
+		peers.add_seed(dl_location.decode('UTF-8', errors='replace'))
+
 	uid = uuid.uuid4()
 	result['uuid'] = uid
 
@@ -1,53 +1,11 @@
 import resource
-import multiprocessing
-from ..storage import storage
-
-def close_all_workers():
-	for worker in storage.get('workers', []):
-		try:
-			worker.kill()
-		except:
-			pass
-		try:
-			worker.close()
-		except:
-			pass
-
-def create_worker(func) -> int:
-	if not 'workers' in storage:
-		storage['workers'] = []
-
-	storage['workers'].append(multiprocessing.Process(target=func))
-
-	return len(storage['workers'])
-
-def get_number_of_workers_running():
-	alive = 0
-	lowest_non_started_thread = len(storage['workers'])+1
-	
-	for index, process in enumerate(storage['workers']):
-		try:
-			if process.exitcode is None and process.is_alive():
-				alive += 1
-			elif process.is_alive() is False and process.exitcode is None:
-				if index < lowest_non_started_thread:
-					lowest_non_started_thread = index
-			elif process.is_alive() is False and process.exitcode is not None:
-				try:
-					process.join()
-					process.close()
-				except:
-					pass
-		except ValueError:
-			continue
-
-	return alive, lowest_non_started_thread if lowest_non_started_thread < len(storage['workers'])+1 else None
-
-def start_next_worker(worker_id):
-	storage['workers'][worker_id].start()
+from .aimd import AIMDController
 
 def max_threads():
 	"""
+	The most worker processes that can ever run at the same time,
+	how many actually do is decided by an AIMDController() below this ceiling.
+
 	ulimit -n returns 1024
 	But we can only use half of those, minus 5 for buffert.
 	on a ulimit of 1024, 509 is useable.
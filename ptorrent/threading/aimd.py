@@ -0,0 +1,112 @@
+import time
+import threading
+
+class AIMDController:
+	"""
+	Decides how many downloads may be in flight, based on how the downloads are actually doing.
+
+	The completed bytes are measured per interval. The window doubles every interval
+	while the throughput keeps improving (slow start), and after that grows by increase
+	every interval without failures, so it keeps probing for more even at a plateau.
+	It only holds when the throughput actually dropped (by more than drop).
+	Errors and timeouts shrink the window multiplicatively, at most once per
+	interval so a burst of failures only counts once.
+	"""
+	def __init__(self, initial :int = 4, minimum :int = 1, maximum :int = 512, increase :float = 1, decrease :float = 0.5, interval :float = 1.0, drop :float = 0.1):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.increase = increase
+		self.decrease = decrease
+		self.interval = interval
+		self.drop = drop
+
+		self.window = float(max(minimum, min(initial, maximum)))
+		self.throughput = 0.0
+		self.failures = 0
+
+		self._slow_start = True
+		self._last_throughput = 0.0
+		self._interval_bytes = 0
+		self._interval_started = time.monotonic()
+		self._backoff_until = 0.0
+		self._interval_failed = False
+		self._lock = threading.Lock()
+
+	@property
+	def limit(self) -> int:
+		return int(self.window)
+
+	def describe(self) -> str:
+		return f"window {self.limit}/{self.maximum}, {self.throughput / 1024 / 1024:.2f}MB/s"
+
+	def set_maximum(self, maximum :int) -> None:
+		"""
+		Changes the cap while running, the window shrinks right away if it's above it.
+		"""
+		with self._lock:
+			self.maximum = max(maximum, self.minimum)
+			self.window = min(self.window, float(self.maximum))
+
+	def completed(self, size :int) -> bool:
+		"""
+		Records a successful download of size bytes.
+		Returns True if the window grew.
+		"""
+		with self._lock:
+			self._interval_bytes += size
+			return self._evaluate()
+
+	def failed(self) -> bool:
+		"""
+		Records a failed or timed out download.
+		Returns True if the window shrunk.
+		"""
+		with self._lock:
+			self.failures += 1
+			self._slow_start = False
+			self._interval_failed = True
+
+			now = time.monotonic()
+			if now < self._backoff_until:
+				return False
+
+			previous = self.limit
+			self.window = max(float(self.minimum), self.window * self.decrease)
+			self._backoff_until = now + self.interval
+
+			# Start measuring anew, the old rate was reached with a bigger window
+			self._last_throughput = 0.0
+			self._interval_bytes = 0
+			self._interval_started = now
+			self._interval_failed = False
+
+			return self.limit != previous
+
+	def _evaluate(self) -> bool:
+		now = time.monotonic()
+		if (elapsed := now - self._interval_started) < self.interval:
+			return False
+
+		self.throughput = self._interval_bytes / elapsed
+		improved = self.throughput > self._last_throughput * 1.02
+		dropped = self.throughput < self._last_throughput * (1 - self.drop)
+		failed = self._interval_failed
+
+		self._last_throughput = self.throughput
+		self._interval_bytes = 0
+		self._interval_started = now
+		self._interval_failed = False
+
+		# Failures the backoff ignored still mean this interval wasn't loss-free
+		if failed or dropped or now < self._backoff_until:
+			return False
+
+		previous = self.limit
+		if self._slow_start and improved:
+			self.window = min(float(self.maximum), self.window * 2)
+		else:
+			# The throughput levelled off, from here on it's probed one step at a time
+			self._slow_start = False
+			self.window = min(float(self.maximum), self.window + self.increase)
+
+		return self.limit != previous
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import atexit
+import typing
+import pathlib
+import threading
+import contextlib
+import multiprocessing.util
+
+# Chrome trace events (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU),
+# which Perfetto (https://ui.perfetto.dev) and chrome://tracing both load.
+# Every process buffers its own events and appends them to <trace>.parts/<pid>.jsonl,
+# the coordinator merges all of them into the trace file when it's done.
+# Timestamps are wall clock microseconds, so events of different processes line up.
+
+FLUSH_EVENTS = 4096
+
+_path :typing.Optional[pathlib.Path] = None
+_process_name = 'ptorrent'
+_events :typing.List[typing.Dict[str, typing.Any]] = []
+_lock = threading.Lock()
+_named_threads :typing.Set[int] = set()
+_started_pid :typing.Optional[int] = None
+
+def enabled() -> bool:
+	return _path is not None
+
+def now() -> float:
+	return time.time()
+
+def _parts() -> pathlib.Path:
+	return _path.with_name(f"{_path.name}.parts")
+
+def start(path :pathlib.Path, process_name :str = 'ptorrent coordinator') -> None:
+	"""
+	Starts recording in this process and in every process forked from it from here on.
+	"""
+	global _path, _process_name
+	_path = pathlib.Path(path).resolve()
+	_process_name = process_name
+
+	_parts().mkdir(parents=True, exist_ok=True)
+	for part in _parts().glob('*.jsonl'):
+		part.unlink()
+
+def _after_fork() -> None:
+	# Forked processes start with an empty buffer (the parent writes its own) and a name of their own.
+	global _events, _lock, _named_threads, _process_name, _started_pid
+	_events, _lock, _named_threads, _started_pid = [], threading.Lock(), set(), None
+	_process_name = f"ptorrent worker {os.getpid()}"
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _start_process() -> None:
+	# Done on the first event rather than right after the fork, multiprocessing
+	# clears the finalizers of a new process before running its target.
+	global _started_pid
+	_started_pid = os.getpid()
+	_events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : _started_pid, 'tid' : 0, 'args' : {'name' : _process_name}})
+	# multiprocessing children skip atexit, but run their finalizers
+	multiprocessing.util.Finalize(None, flush, exitpriority=0)
+	atexit.register(flush)
+
+def _record(event :typing.Dict[str, typing.Any]) -> None:
+	thread_id = threading.get_native_id()
+	event = {'pid' : os.getpid(), 'tid' : thread_id, **event}
+
+	with _lock:
+		if _started_pid != event['pid']:
+			_start_process()
+		if thread_id not in _named_threads:
+			_named_threads.add(thread_id)
+			_events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : event['pid'], 'tid' : thread_id, 'args' : {'name' : threading.current_thread().name}})
+		_events.append(event)
+		full = len(_events) >= FLUSH_EVENTS
+
+	if full:
+		flush()
+
+def complete(name :str, started :float, ended :float, category :str = 'ptorrent', **args) -> None:
+	"""
+	A span that has already happened, started and ended being now() values.
+	"""
+	if _path is None:
+		return None
+	_record({'name' : name, 'cat' : category, 'ph' : 'X', 'ts' : int(started * 1_000_000), 'dur' : max(int((ended - started) * 1_000_000), 0), 'args' : args})
+
+@contextlib.contextmanager
+def span(name :str, category :str = 'ptorrent', **args) -> typing.Iterator[None]:
+	if _path is None:
+		yield
+		return
+
+	started = now()
+	try:
+		yield
+	finally:
+		complete(name, started, now(), category, **args)
+
+def instant(name :str, category :str = 'ptorrent', **args) -> None:
+	if _path is None:
+		return None
+	_record({'name' : name, 'cat' : category, 'ph' : 'i', 's' : 't', 'ts' : int(now() * 1_000_000), 'args' : args})
+
+def begin(name :str, identifier :typing.Any, category :str = 'piece', at :typing.Optional[float] = None, **args) -> None:
+	"""
+	Starts an async span, one that can end on another thread (see end()) and overlap others on the same thread.
+	Every identifier gets a track of its own, which is how a piece's life from request to done is shown.
+	at is a now() value, for spans that started before they're recorded.
+	"""
+	if _path is None:
+		return None
+	_record({'name' : name, 'cat' : category, 'ph' : 'b', 'id' : str(identifier), 'ts' : int((now() if at is None else at) * 1_000_000), 'args' : args})
+
+def end(name :str, identifier :typing.Any, category :str = 'piece', at :typing.Optional[float] = None, **args) -> None:
+	if _path is None:
+		return None
+	_record({'name' : name, 'cat' : category, 'ph' : 'e', 'id' : str(identifier), 'ts' : int((now() if at is None else at) * 1_000_000), 'args' : args})
+
+def flush() -> None:
+	"""
+	Appends the buffered events of this process to its part file.
+	"""
+	global _events
+	if _path is None:
+		return None
+
+	with _lock:
+		events, _events = _events, []
+
+	if events:
+		with (_parts() / f"{os.getpid()}.jsonl").open('a') as fh:
+			fh.write(''.join(json.dumps(event) + '\n' for event in events))
+
+def finish() -> typing.Optional[pathlib.Path]:
+	"""
+	Merges the events of every process into the trace file, and returns where it is.
+	"""
+	if _path is None:
+		return None
+
+	flush()
+	events = []
+	for part in sorted(_parts().glob('*.jsonl')):
+		with part.open() as fh:
+			events += [json.loads(line) for line in fh if line.strip()]
+		part.unlink()
+
+	with contextlib.suppress(OSError):
+		_parts().rmdir()
+
+	with _path.open('w') as fh:
+		json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, fh)
+
+	return _path